@@ -0,0 +1,360 @@
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    Job executors: submit scripts to the SGE cluster, to a pool of local
+            processes or serially. All fork functions go through here.
+
+            The executor is chosen by the environment variable
+            HIVWHOLESEQ_EXECUTOR (sge, local, serial); by default SGE is used
+            if qsub is found, else local processes.
+'''
+# Modules
+import os
+import sys
+import time
+import subprocess as sp
+from abc import ABCMeta, abstractmethod
+
+from . import JOBLOGERR, JOBLOGOUT
+
+
+
+# Globals
+executor_env = 'HIVWHOLESEQ_EXECUTOR'
+executor = None
+
+
+
+# Classes
+class Executor(object):
+    '''Base class for job executors
+
+    Jobs are command lines, the first item being the script. Executors differ
+    in where the job runs, but share this interface:
+       - submit: queue a job, return its job ID
+       - poll: None if the job is still queued or running, else its exit code
+       - wait: block until jobs are finished, return their exit codes
+       - get_runtime: wall time of a finished job, if known
+
+    Subclasses implement submit and poll.
+    '''
+    __metaclass__ = ABCMeta
+
+
+    @abstractmethod
+    def submit(self, call_list, name='job', cluster_time='0:59:59', vmem='1G',
+               threads=1):
+        '''Submit a job, return its job ID'''
+        pass
+
+
+    @abstractmethod
+    def poll(self, jobid):
+        '''Check a job, return None if unfinished, else its exit code'''
+        pass
+
+
+    def wait(self, jobids=None, time_wait=10):
+        '''Wait for jobs to finish
+
+        Parameters:
+           jobids (list): jobs to wait for (default: all jobs submitted)
+           time_wait (float): seconds between polls
+
+        Returns:
+           exitcodes (dict): exit code of each job
+        '''
+        if jobids is None:
+            jobids = self.jobids
+        exitcodes = {}
+        while True:
+            for jobid in jobids:
+                if jobid not in exitcodes:
+                    exitcode = self.poll(jobid)
+                    if exitcode is not None:
+                        exitcodes[jobid] = exitcode
+            if len(exitcodes) == len(jobids):
+                return exitcodes
+            time.sleep(time_wait)
+
+
+    def get_runtime(self, jobid):
+        '''Get the wall time of a finished job in seconds (None if unknown)'''
+        return self.runtimes.get(jobid, None)
+
+
+class SGEExecutor(Executor):
+    '''Submit jobs to a Sun Grid Engine cluster via qsub'''
+    def __init__(self):
+        self.jobids = []
+        self.runtimes = {}
+
+
+    def __repr__(self):
+        return 'SGEExecutor()'
+
+
+    def submit(self, call_list, name='job', cluster_time='0:59:59', vmem='1G',
+               threads=1):
+        '''Submit a job via qsub'''
+        qsub_list = ['qsub','-cwd',
+                     '-b', 'y',
+                     '-S', '/bin/bash',
+                     '-o', JOBLOGOUT,
+                     '-e', JOBLOGERR,
+                     '-N', name,
+                     '-l', 'h_rt='+cluster_time,
+                     '-l', 'h_vmem='+vmem,
+                    ] + list(call_list)
+        qsub_list = map(str, qsub_list)
+        output = sp.check_output(qsub_list)
+        # Your job <jobid> ("<name>") has been submitted
+        jobid = output.split()[2]
+        self.jobids.append(jobid)
+        return jobid
+
+
+    def poll(self, jobid):
+        '''Check whether a job is finished
+
+        NOTE: the exit code is read from the accounting (qacct). If that is not
+        available, finished jobs are assumed successful.
+        '''
+        qstat_output = sp.check_output(['qstat'])
+        qstat_output = qstat_output.split('\n')[2:]
+        if str(jobid) in [line.split()[0] for line in qstat_output if line.strip()]:
+            return None
+
+        try:
+            qacct_output = sp.check_output(['qacct', '-j', str(jobid)],
+                                           stderr=sp.STDOUT)
+        except (OSError, sp.CalledProcessError):
+            return 0
+        for line in qacct_output.split('\n'):
+            fields = line.split()
+            if (len(fields) >= 2) and (fields[0] == 'exit_status'):
+                return int(fields[1])
+        return 0
+
+
+class LocalExecutor(Executor):
+    '''Run jobs as a pool of local processes within a budget of cores and memory
+
+    Jobs are started as soon as their threads and memory fit in the budget. A
+    job larger than the whole budget runs alone. Queued jobs are started on
+    submit and poll calls, and the remaining ones are waited for at exit.
+    The cluster time limit is ignored.
+    '''
+    def __init__(self, cores=None, vmem=None):
+        import atexit
+        from multiprocessing import cpu_count
+
+        if cores is None:
+            cores = cpu_count()
+        if vmem is None:
+            vmem = get_physical_memory()
+
+        self.cores = int(cores)
+        self.vmem = parse_memory(vmem)
+        self.jobs = {}
+        self.jobids = []
+        self.queue = []
+        self.exitcodes = {}
+        self.runtimes = {}
+
+        atexit.register(self.wait, time_wait=1)
+
+
+    def __repr__(self):
+        return 'LocalExecutor(cores='+str(self.cores)+', vmem='+str(self.vmem)+')'
+
+
+    def submit(self, call_list, name='job', cluster_time='0:59:59', vmem='1G',
+               threads=1):
+        '''Queue a local job'''
+        jobid = str(os.getpid())+'.'+str(len(self.jobids) + 1)
+        self.jobids.append(jobid)
+        self.queue.append({'jobid': jobid,
+                           'name': name,
+                           'call_list': map(str, call_list),
+                           'threads': max(1, int(threads)),
+                           'vmem': parse_memory(vmem)})
+        self.update()
+        return jobid
+
+
+    def update(self):
+        '''Collect finished jobs and start queued ones within the budget'''
+        for jobid, job in self.jobs.items():
+            exitcode = job['process'].poll()
+            if exitcode is not None:
+                self.exitcodes[jobid] = exitcode
+                self.runtimes[jobid] = time.time() - job['start']
+                for f in job['logs']:
+                    f.close()
+                del self.jobs[jobid]
+
+        cores_used = sum(job['threads'] for job in self.jobs.itervalues())
+        vmem_used = sum(job['vmem'] for job in self.jobs.itervalues())
+        while len(self.queue):
+            job = self.queue[0]
+            if len(self.jobs) and ((cores_used + job['threads'] > self.cores) or
+                                   (vmem_used + job['vmem'] > self.vmem)):
+                break
+
+            self.queue.pop(0)
+            call_list = job['call_list']
+            if call_list[0].endswith('.py'):
+                call_list = [sys.executable] + call_list
+            job['logs'] = [open(fn, 'w') for fn in get_log_filenames(job['name'],
+                                                                     job['jobid'])]
+            job['process'] = sp.Popen(call_list,
+                                      stdout=job['logs'][0],
+                                      stderr=job['logs'][1])
+            job['start'] = time.time()
+            self.jobs[job['jobid']] = job
+            cores_used += job['threads']
+            vmem_used += job['vmem']
+
+
+    def poll(self, jobid):
+        '''Check whether a job is finished'''
+        self.update()
+        return self.exitcodes.get(jobid, None)
+
+
+class SerialExecutor(Executor):
+    '''Run jobs one by one in the foreground'''
+    def __init__(self):
+        self.jobids = []
+        self.exitcodes = {}
+        self.runtimes = {}
+
+
+    def __repr__(self):
+        return 'SerialExecutor()'
+
+
+    def submit(self, call_list, name='job', cluster_time='0:59:59', vmem='1G',
+               threads=1):
+        '''Run a job and wait for it'''
+        jobid = str(os.getpid())+'.'+str(len(self.jobids) + 1)
+        self.jobids.append(jobid)
+
+        call_list = map(str, call_list)
+        if call_list[0].endswith('.py'):
+            call_list = [sys.executable] + call_list
+        (fn_out, fn_err) = get_log_filenames(name, jobid)
+        start = time.time()
+        with open(fn_out, 'w') as fout, open(fn_err, 'w') as ferr:
+            self.exitcodes[jobid] = sp.call(call_list, stdout=fout, stderr=ferr)
+        self.runtimes[jobid] = time.time() - start
+        return jobid
+
+
+    def poll(self, jobid):
+        '''Get the exit code of a job'''
+        return self.exitcodes[jobid]
+
+
+
+# Functions
+def parse_memory(vmem):
+    '''Parse a memory string like 8G into bytes'''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    vmem = str(vmem).upper().rstrip('B')
+    if vmem[-1] in units:
+        return int(float(vmem[:-1]) * units[vmem[-1]])
+    return int(vmem)
+
+
+def get_physical_memory():
+    '''Get the total physical memory of this machine in bytes'''
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def get_log_filenames(name, jobid):
+    '''Get the stdout and stderr log filenames of a job (same as SGE)'''
+    name = name.replace(' ', '_')
+    return (JOBLOGOUT+name+'.o'+str(jobid), JOBLOGERR+name+'.e'+str(jobid))
+
+
+def set_executor(name, **kwargs):
+    '''Set the executor used by all fork functions
+
+    Parameters:
+       name (str): sge, local, or serial
+       **kwargs: passed to the executor (e.g. cores and vmem for local)
+    '''
+    global executor
+    executors = {'sge': SGEExecutor,
+                 'local': LocalExecutor,
+                 'serial': SerialExecutor}
+    if name not in executors:
+        raise ValueError('Executor not found: '+str(name))
+    executor = executors[name](**kwargs)
+    return executor
+
+
+def get_executor():
+    '''Get the current executor, picking the default on first use'''
+    if executor is None:
+        if executor_env in os.environ:
+            set_executor(os.environ[executor_env].lower())
+        else:
+            from ..utils.generic import which
+            if len(which('qsub')):
+                set_executor('sge')
+            else:
+                set_executor('local')
+    return executor
+
+
+def submit(call_list, name='job', cluster_time='0:59:59', vmem='1G', threads=1):
+    '''Submit a job to the current executor
+
+    Parameters:
+       call_list (list): the script and its arguments
+       name (str): name of the job (used for the log files)
+       cluster_time (str): time limit of the job (SGE only)
+       vmem (str): memory required, e.g. 8G
+       threads (int): number of cores used by the job
+
+    Returns:
+       jobid (str): the ID of the job, for poll and wait
+    '''
+    return get_executor().submit(call_list, name=name,
+                                 cluster_time=cluster_time,
+                                 vmem=vmem, threads=threads)
+
+
+def wait(jobids=None, time_wait=10):
+    '''Wait for jobs submitted to the current executor'''
+    return get_executor().wait(jobids=jobids, time_wait=time_wait)
+
+
+def wait_report(jobids, labels, time_wait=1, VERBOSE=1):
+    '''Wait for jobs and report the exit code and wall time of each
+
+    Parameters:
+       labels (list): a label for each job (e.g. sample and fragment)
+
+    Returns:
+       failed (list): the labels of the failed jobs
+    '''
+    exitcodes = wait(jobids=jobids, time_wait=time_wait)
+
+    failed = []
+    for jobid, label in zip(jobids, labels):
+        if exitcodes[jobid] != 0:
+            failed.append(label)
+
+        if VERBOSE >= 1:
+            runtime = get_executor().get_runtime(jobid)
+            print '{:<30}'.format(label),
+            print 'OK  ' if exitcodes[jobid] == 0 else 'FAIL',
+            if runtime is not None:
+                print '{:>8.1f} secs'.format(runtime),
+            print ''
+
+    return failed
@@ -3,12 +3,12 @@
 author:     Fabio Zanini
 date:       06/12/13
 content:    Module with all submit functions for the cluster. With this we can
-            keep all cluster-specific code in one place.
+            keep all cluster-specific code in one place. Jobs go through the
+            executor in cluster/executors.py (SGE, local processes, serial).
 '''
 # Globals
-import subprocess as sp
-
 from . import JOBDIR, JOBLOGERR, JOBLOGOUT
+from .executors import submit
 
 
 
@@ -40,15 +40,7 @@ def fork_check_pipeline(seq_runs, adaIDs=None, pats=False,
     JOBSCRIPT = JOBDIR+'sequencing/check_pipeline.py'
     cluster_time = '00:59:59'
     vmem = '1G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'pipe',
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--runs', seq_runs,
                  '--adaIDs', adaIDs,
                  '--detail', detail,
@@ -59,7 +51,8 @@ def fork_check_pipeline(seq_runs, adaIDs=None, pats=False,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='pipe',
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_quality_along_read(seq_run, VERBOSE=0, maxreads=-1, savefig=True):
@@ -70,15 +63,7 @@ def fork_quality_along_read(seq_run, VERBOSE=0, maxreads=-1, savefig=True):
     JOBSCRIPT = JOBDIR+'sequencing/check_quality_along_read.py'
     cluster_time = '00:59:59'
     vmem = '1G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'quaalo',
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--verbose', VERBOSE,
                  '--maxreads', maxreads,
@@ -88,36 +73,35 @@ def fork_quality_along_read(seq_run, VERBOSE=0, maxreads=-1, savefig=True):
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='quaalo',
+                  cluster_time=cluster_time, vmem=vmem)
 
 
-def fork_demultiplex(seq_run, VERBOSE=0, maxreads=-1, summary=True):
+def fork_demultiplex(seq_run, VERBOSE=0, maxreads=-1, summary=True,
+                     mismatches=1, threads=1, compresslevel=9):
     '''Submit demultiplex script to the cluster'''
     if VERBOSE:
         print 'Forking to the cluster'
 
-    JOBSCRIPT = JOBDIR+'demultiplex.py'
+    JOBSCRIPT = JOBDIR+'sequencing/demultiplex.py'
     cluster_times = ['0:59:59', '23:59:59']
     vmem = '8G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'demux',
-                 '-l', 'h_rt='+cluster_times[not (0 < maxreads < 1e6)],
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--verbose', VERBOSE,
                  '--maxreads', maxreads,
+                 '--mismatches', mismatches,
+                 '--threads', threads,
+                 '--compresslevel', compresslevel,
                 ]
     if not summary:
         call_list.append('--no-summary')
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='demux',
+                  cluster_time=cluster_times[not (0 < maxreads < 1e6)], vmem=vmem,
+                  threads=threads)
 
 
 def fork_trim(seq_run, adaID, VERBOSE=0, summary=True):
@@ -128,15 +112,7 @@ def fork_trim(seq_run, adaID, VERBOSE=0, summary=True):
     JOBSCRIPT = JOBDIR+'sequencing/trim_reads_lowq.py'
     cluster_time = '3:59:59'
     vmem = '1G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'pm '+adaID,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--verbose', VERBOSE,
@@ -146,7 +122,8 @@ def fork_trim(seq_run, adaID, VERBOSE=0, summary=True):
     call_list = map(str, call_list)
     if VERBOSE >= 2:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='pm '+adaID,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_premap(seq_run, adaID, VERBOSE=0, threads=1, maxreads=-1,
@@ -161,15 +138,7 @@ def fork_premap(seq_run, adaID, VERBOSE=0, threads=1, maxreads=-1,
     # quite some time. So for now give up and require 2h.
     cluster_time = ['71:59:59', '3:59:59']
     vmem = '8G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'pm '+adaID,
-                 '-l', 'h_rt='+cluster_time[threads >= 30],
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--verbose', VERBOSE,
@@ -189,7 +158,9 @@ def fork_premap(seq_run, adaID, VERBOSE=0, threads=1, maxreads=-1,
     call_list = map(str, call_list)
     if VERBOSE >= 2:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='pm '+adaID,
+                  cluster_time=cluster_time[threads >= 30], vmem=vmem,
+                  threads=threads)
 
 
 def fork_premapped_coverage(samplename, VERBOSE=0, maxreads=-1):
@@ -200,15 +171,7 @@ def fork_premapped_coverage(samplename, VERBOSE=0, maxreads=-1):
     JOBSCRIPT = JOBDIR+'sequencing/check_premapped_coverage.py'
     cluster_time = '00:59:59'
     vmem = '1G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'pcov '+samplename,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--samples', samplename,
                  '--verbose', VERBOSE,
                  '--maxreads', maxreads,
@@ -217,11 +180,12 @@ def fork_premapped_coverage(samplename, VERBOSE=0, maxreads=-1):
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='pcov '+samplename,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_trim_and_divide(seq_run, adaID, VERBOSE=0, maxreads=-1, minisize=100,
-                         summary=True):
+                         summary=True, threads=1):
     '''Submit trim and divide script to the cluster for each adapter ID'''
     if VERBOSE:
         print 'Forking to the cluster: adaID '+adaID
@@ -229,27 +193,22 @@ def fork_trim_and_divide(seq_run, adaID, VERBOSE=0, maxreads=-1, minisize=100,
     JOBSCRIPT = JOBDIR+'sequencing/trim_and_divide.py'
     cluster_time = '2:59:59'
     vmem = '1G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'trdv '+adaID,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--verbose', VERBOSE,
                  '--maxreads', maxreads,
                  '--minisize', minisize,
+                 '--threads', threads,
                 ]
     if not summary:
         call_list.append('--no-summary')
     call_list = map(str, call_list)
     if VERBOSE >= 2:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='trdv '+adaID,
+                  cluster_time=cluster_time, vmem=vmem,
+                  threads=threads)
 
 
 def fork_build_consensus_iterative(seq_run, adaID, fragment, n_reads=1000,
@@ -261,15 +220,7 @@ def fork_build_consensus_iterative(seq_run, adaID, fragment, n_reads=1000,
     JOBSCRIPT = JOBDIR+'build_consensus_iterative.py'
     cluster_time = '0:59:59'
     vmem = '2G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'cb '+adaID+' '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--fragments', fragment,
@@ -282,7 +233,8 @@ def fork_build_consensus_iterative(seq_run, adaID, fragment, n_reads=1000,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='cb '+adaID+' '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_build_consensus(seq_run, adaID, fragment,
@@ -300,15 +252,7 @@ def fork_build_consensus(seq_run, adaID, fragment,
         cluster_time = '0:59:59'
 
     vmem = '2G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'c '+adaID+' '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--fragments', fragment,
@@ -323,7 +267,8 @@ def fork_build_consensus(seq_run, adaID, fragment,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='c '+adaID+' '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_map_to_consensus(seq_run, adaID, fragment, VERBOSE=3,
@@ -341,15 +286,7 @@ def fork_map_to_consensus(seq_run, adaID, fragment, VERBOSE=3,
     JOBSCRIPT = JOBDIR+'sequencing/map_to_consensus.py'
     cluster_time = ['23:59:59', '0:59:59']
     vmem = '8G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'm '+adaID+' '+fragment,
-                 '-l', 'h_rt='+cluster_time[0 < maxreads <= 10000],
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--fragments', fragment,
@@ -366,7 +303,9 @@ def fork_map_to_consensus(seq_run, adaID, fragment, VERBOSE=3,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='m '+adaID+' '+fragment,
+                  cluster_time=cluster_time[0 < maxreads <= 10000], vmem=vmem,
+                  threads=threads)
 
 
 def fork_filter_mapped(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1,
@@ -378,15 +317,7 @@ def fork_filter_mapped(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1,
     JOBSCRIPT = JOBDIR+'sequencing/filter_mapped_reads.py'
     cluster_time = '71:59:59'
     vmem = '2G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'f '+adaID+' '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--fragments', fragment,
@@ -401,7 +332,8 @@ def fork_filter_mapped(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='f '+adaID+' '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_get_allele_counts(seq_run, adaID, fragment, VERBOSE=3):
@@ -412,15 +344,7 @@ def fork_get_allele_counts(seq_run, adaID, fragment, VERBOSE=3):
     JOBSCRIPT = JOBDIR+'sequencing/get_allele_counts.py'
     cluster_time = '0:59:59'
     vmem = '4G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'acn '+adaID+' '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--fragments', fragment,
@@ -429,7 +353,8 @@ def fork_get_allele_counts(seq_run, adaID, fragment, VERBOSE=3):
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='acn '+adaID+' '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_filter_allele_frequencies(seq_run, adaID, fragment, VERBOSE=3, summary=True):
@@ -440,15 +365,7 @@ def fork_filter_allele_frequencies(seq_run, adaID, fragment, VERBOSE=3, summary=
     JOBSCRIPT = JOBDIR+'sequencing/filter_allele_frequencies.py'
     cluster_time = '0:59:59'
     vmem = '2G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'faf '+adaID+' '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--fragments', fragment,
@@ -459,7 +376,8 @@ def fork_filter_allele_frequencies(seq_run, adaID, fragment, VERBOSE=3, summary=
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='faf '+adaID+' '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_extract_mutations(seq_run, adaID, VERBOSE=0, summary=True):
@@ -470,15 +388,7 @@ def fork_extract_mutations(seq_run, adaID, VERBOSE=0, summary=True):
     JOBSCRIPT = JOBDIR+'sequencing/extract_mutations.py'
     cluster_time = '0:59:59'
     vmem = '8G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'exm_'+adaID,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaID', adaID,
                 ]
@@ -487,7 +397,8 @@ def fork_extract_mutations(seq_run, adaID, VERBOSE=0, summary=True):
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='exm_'+adaID,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_get_coallele_counts(data_folder, adaID, fragment, VERBOSE=3, summary=True):
@@ -498,15 +409,7 @@ def fork_get_coallele_counts(data_folder, adaID, fragment, VERBOSE=3, summary=Tr
     JOBSCRIPT = JOBDIR+'sequencing/get_coallele_counts.py'
     cluster_time = '0:59:59'
     vmem = '8G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'ca '+adaID+' '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--adaIDs', adaID,
                  '--fragments', fragment,
                  '--verbose', VERBOSE,
@@ -516,7 +419,8 @@ def fork_get_coallele_counts(data_folder, adaID, fragment, VERBOSE=3, summary=Tr
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='ca '+adaID+' '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_split_for_mapping(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1, chunk_size=10000):
@@ -527,15 +431,7 @@ def fork_split_for_mapping(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1, chu
     JOBSCRIPT = JOBDIR+'sequencing/split_reads_for_mapping.py'
     cluster_time = '0:59:59'
     vmem = '8G'
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'sfm '+adaID+' '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--adaIDs', adaID,
                  '--fragments', fragment,
@@ -546,7 +442,8 @@ def fork_split_for_mapping(seq_run, adaID, fragment, VERBOSE=0, maxreads=-1, chu
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='sfm '+adaID+' '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 # PHIX
@@ -559,15 +456,7 @@ def fork_get_allele_counts_phix(seq_run, maxreads=-1, VERBOSE=0, qual_min=None):
     if VERBOSE:
         print 'Forking to the cluster'
 
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'acpX'+seq_run,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--run', seq_run,
                  '--maxreads', maxreads,
                  '--verbose', VERBOSE,
@@ -577,7 +466,8 @@ def fork_get_allele_counts_phix(seq_run, maxreads=-1, VERBOSE=0, qual_min=None):
     call_list = map(str, call_list)
     if VERBOSE >= 2:
         print ' '.join(call_list)
-    sp.call(call_list)
+    return submit(call_list, name='acpX'+seq_run,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 # PATIENTS
@@ -595,15 +485,7 @@ def fork_map_to_initial_reference(samplename, fragment,
     cluster_time = ['23:59:59', '0:59:59']
     vmem = '8G'
 
-    call_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'm '+samplename[:4]+' '+fragment,
-                 '-l', 'h_rt='+cluster_time[(only_chunks != [None]) or (0 < n_pairs <= 10000)],
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    call_list = [JOBSCRIPT,
                  '--samples', samplename,
                  '--fragments', fragment,
                  '--verbose', VERBOSE,
@@ -622,7 +504,9 @@ def fork_map_to_initial_reference(samplename, fragment,
     call_list = map(str, call_list)
     if VERBOSE:
         print ' '.join(call_list)
-    return sp.check_output(call_list)
+    return submit(call_list, name='m '+samplename[:4]+' '+fragment,
+                  cluster_time=cluster_time[(only_chunks != [None]) or (0 < n_pairs <= 10000)], vmem=vmem,
+                  threads=threads)
 
 
 def fork_filter_mapped_init(samplename, fragment,
@@ -637,15 +521,7 @@ def fork_filter_mapped_init(samplename, fragment,
     cluster_time = '23:59:59'
     vmem = '8G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'fmi '+samplename+' '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--samples', samplename,
                  '--fragments', fragment,
                  '--verbose', VERBOSE,
@@ -657,7 +533,8 @@ def fork_filter_mapped_init(samplename, fragment,
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='fmi '+samplename+' '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_build_consensus_patient(samplename_pat, fragment, VERBOSE=0, PCR=1,
@@ -670,15 +547,7 @@ def fork_build_consensus_patient(samplename_pat, fragment, VERBOSE=0, PCR=1,
     cluster_time = '0:59:59'
     vmem = '2G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'ci'+fragment+samplename_pat,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--samples', samplename_pat,
                  '--fragments', fragment,
                  '--verbose', VERBOSE,
@@ -690,7 +559,8 @@ def fork_build_consensus_patient(samplename_pat, fragment, VERBOSE=0, PCR=1,
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='ci'+fragment+samplename_pat,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_get_allele_counts_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_min=30):
@@ -702,15 +572,7 @@ def fork_get_allele_counts_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_
     cluster_time = '0:59:59'
     vmem = '2G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'ac'+fragment+samplename,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--samples', samplename,
                  '--fragments', fragment,
                  '--verbose', VERBOSE,
@@ -721,7 +583,8 @@ def fork_get_allele_counts_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='ac'+fragment+samplename,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_get_insertions_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_min=30):
@@ -733,15 +596,7 @@ def fork_get_insertions_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_min
     cluster_time = '0:59:59'
     vmem = '2G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'in'+fragment+samplename,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--samples', samplename,
                  '--fragments', fragment,
                  '--verbose', VERBOSE,
@@ -752,7 +607,8 @@ def fork_get_insertions_patient(samplename, fragment, VERBOSE=0, PCR=1, qual_min
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='in'+fragment+samplename,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_get_allele_counts_aa_patient(samplename, protein, VERBOSE=0, PCR=1, qual_min=30):
@@ -764,15 +620,7 @@ def fork_get_allele_counts_aa_patient(samplename, protein, VERBOSE=0, PCR=1, qua
     cluster_time = '0:59:59'
     vmem = '2G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'aac'+protein+samplename,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--samples', samplename,
                  '--proteins', protein,
                  '--verbose', VERBOSE,
@@ -783,12 +631,14 @@ def fork_get_allele_counts_aa_patient(samplename, protein, VERBOSE=0, PCR=1, qua
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='aac'+protein+samplename,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_get_cocounts_patient(samplename, fragment, VERBOSE=0,
                               PCR=1, qual_min=30,
-                              maxreads=-1, use_tests=False):
+                              maxreads=-1, use_tests=False,
+                              sparse=True):
     '''Fork to the cluster for each patient, sample, and fragment'''
     if VERBOSE:
         print 'Forking to the cluster: sample '+samplename+', fragment '+fragment
@@ -797,15 +647,7 @@ def fork_get_cocounts_patient(samplename, fragment, VERBOSE=0,
     cluster_time = '23:59:59'
     vmem = '8G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'cc'+fragment+samplename,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--fragments', fragment,
                  '--samples', samplename,
                  '--verbose', VERBOSE,
@@ -816,14 +658,17 @@ def fork_get_cocounts_patient(samplename, fragment, VERBOSE=0,
                 ]
     if use_tests:
         qsub_list.append('--tests')
+    if not sparse:
+        qsub_list.append('--dense')
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='cc'+fragment+samplename,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_compress_cocounts_patient(samplename, fragment, VERBOSE=0,
-                                   PCR=1, qual_min=30):
+                                   PCR=1, qual_min=30, sparse=False):
     '''Fork to the cluster for each patient, sample, and fragment'''
     if VERBOSE:
         print 'Forking to the cluster: sample '+samplename+', fragment '+fragment
@@ -832,30 +677,26 @@ def fork_compress_cocounts_patient(samplename, fragment, VERBOSE=0,
     cluster_time = '23:59:59'
     vmem = '8G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'ccc'+fragment+samplename,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--fragments', fragment,
                  '--samples', samplename,
                  '--verbose', VERBOSE,
                  '--qualmin', qual_min,
                  '--PCR', PCR,
                 ]
+    if sparse:
+        qsub_list.append('--sparse')
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='ccc'+fragment+samplename,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 
 def fork_decontaminate_reads_patient(samplename, fragment, VERBOSE=0, PCR=None,
-                                     maxreads=-1, summary=True):
+                                     maxreads=-1, summary=True, sort=False,
+                                     n_candidates=0):
     '''Fork to the cluster the decontamination of reads'''
     if VERBOSE:
         print 'Fork to cluster: sample', samplename, fragment
@@ -864,15 +705,7 @@ def fork_decontaminate_reads_patient(samplename, fragment, VERBOSE=0, PCR=None,
     cluster_time = '71:59:59'
     vmem = '2G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'de'+fragment+samplename,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--samples', samplename,
                  '--fragments', fragment,
                  '--verbose', VERBOSE,
@@ -883,10 +716,15 @@ def fork_decontaminate_reads_patient(samplename, fragment, VERBOSE=0, PCR=None,
         qsub_list.extend(['--maxreads', maxreads])
     if not summary:
         qsub_list.append('--no-summary')
+    if sort:
+        qsub_list.append('--sorted')
+    if n_candidates:
+        qsub_list.extend(['--kmer-candidates', n_candidates])
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='de'+fragment+samplename,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_get_allele_frequency_trajectory(pname, fragment, VERBOSE=0):
@@ -898,15 +736,7 @@ def fork_get_allele_frequency_trajectory(pname, fragment, VERBOSE=0):
     cluster_time = '0:59:59'
     vmem = '2G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'aft '+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--patient', pname,
                  '--fragments', fragment,
                  '--verbose', VERBOSE,
@@ -915,7 +745,29 @@ def fork_get_allele_frequency_trajectory(pname, fragment, VERBOSE=0):
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='aft '+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
+
+
+def fork_store_trajectories(pname, VERBOSE=0, qual_min=30):
+    '''Fork to the cluster the trajectory store of a patient'''
+    if VERBOSE:
+        print 'Forking to the cluster: patient '+pname
+
+    JOBSCRIPT = JOBDIR+'store/store_trajectories.py'
+    cluster_time = '0:59:59'
+    vmem = '4G'
+
+    qsub_list = [JOBSCRIPT,
+                 '--patients', pname,
+                 '--verbose', VERBOSE,
+                 '--qualmin', qual_min,
+                ]
+    qsub_list = map(str, qsub_list)
+    if VERBOSE:
+        print ' '.join(qsub_list)
+    return submit(qsub_list, name='traj'+pname,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_store_haplotypes_scan(pname, width, gap, start, end, VERBOSE=0,
@@ -927,15 +779,7 @@ def fork_store_haplotypes_scan(pname, width, gap, start, end, VERBOSE=0,
     cluster_time = '23:59:59'
     vmem = '2G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'scan '+pname,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--patients', pname,
                  '--width', width,
                  '--gap', gap,
@@ -949,7 +793,8 @@ def fork_store_haplotypes_scan(pname, width, gap, start, end, VERBOSE=0,
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='scan '+pname,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 # WEBSITE
@@ -962,22 +807,15 @@ def fork_store_haplotypes_website(pname, region, VERBOSE=0):
     cluster_time = '23:59:59'
     vmem = '8G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'spa'+pname+region,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--patients', pname,
                  '--regions', region,
                 ]
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='spa'+pname+region,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 def fork_store_cocounts_website(pname, samplenumber, fragment, VERBOSE=0):
@@ -989,15 +827,7 @@ def fork_store_cocounts_website(pname, samplenumber, fragment, VERBOSE=0):
     cluster_time = '0:59:59'
     vmem = '16G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'cc'+pname+str(samplenumber)+fragment,
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--patients', pname,
                  '--samplenumbers', samplenumber,
                  '--fragments', fragment,
@@ -1005,7 +835,8 @@ def fork_store_cocounts_website(pname, samplenumber, fragment, VERBOSE=0):
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='cc'+pname+str(samplenumber)+fragment,
+                  cluster_time=cluster_time, vmem=vmem)
 
 
 
@@ -1019,15 +850,7 @@ def fork_calculate_beta_SFS(alpha, N, VERBOSE=0):
     cluster_time = '23:59:59'
     vmem = '4G'
 
-    qsub_list = ['qsub','-cwd',
-                 '-b', 'y',
-                 '-S', '/bin/bash',
-                 '-o', JOBLOGOUT,
-                 '-e', JOBLOGERR,
-                 '-N', 'SFS '+str(alpha)+' '+str(N),
-                 '-l', 'h_rt='+cluster_time,
-                 '-l', 'h_vmem='+vmem,
-                 JOBSCRIPT,
+    qsub_list = [JOBSCRIPT,
                  '--alphas', alpha,
                  '--Ns', N,
                  '--verbose', VERBOSE,
@@ -1035,5 +858,6 @@ def fork_calculate_beta_SFS(alpha, N, VERBOSE=0):
     qsub_list = map(str, qsub_list)
     if VERBOSE:
         print ' '.join(qsub_list)
-    return sp.check_output(qsub_list)
+    return submit(qsub_list, name='SFS '+str(alpha)+' '+str(N),
+                  cluster_time=cluster_time, vmem=vmem)
 
@@ -54,6 +54,7 @@ else:
 tmp_folder = root_data_folder+'tmp/'
 reference_folder = root_data_folder+'reference/'
 theory_folder = root_data_folder+'theory/'
+cache_folder = root_data_folder+'cache/'
 table_folder = self.__path__[0] + '/data/'
 table_filename = table_folder+'HIV_reservoir_all.xlsx'
 
@@ -72,3 +73,21 @@ def get_custom_alignment_filename(aliname, format='fasta'):
     filename = 'alignments/'+aliname
     filename = filename+'.'+format
     return reference_folder+filename
+
+
+def get_table_cache_filename(filename, sheetname, index_col=None):
+    '''Get the filename of the binary snapshot of a sheet of a table'''
+    folder = os.path.dirname(filename)+'/cache/'
+    fn = os.path.basename(filename).split('.')[0]
+    fn = fn+'_'+sheetname.replace(' ', '_')
+    if index_col is not None:
+        fn = fn+'_index'+str(index_col)
+    fn = fn+'.pickle'
+    return folder+fn
+
+
+def get_muscle_cache_filename(key, folder=None):
+    '''Get the filename of a cached MUSCLE alignment by its key'''
+    if folder is None:
+        folder = cache_folder+'muscle/'
+    return folder.rstrip('/')+'/'+key[:2]+'/'+key+'.fasta'
@@ -41,6 +41,13 @@ def get_initial_reference_filename(pname, fragment, format='fasta'):
     return filename
 
 
+def get_fragment_maps_filename(pname):
+    '''Get the filename of the maps from fragment to genomewide initial reference'''
+    filename = 'reference_initial_maps_fragments_genomewide.npz'
+    filename = get_initial_reference_foldername(pname)+filename
+    return filename
+
+
 def get_primers_filename(pname, format='fasta'):
     '''Get the filename with the patient-specific primers'''
     filename = 'primers_'+pname+'.'+format
@@ -73,11 +80,17 @@ def get_mapped_to_initial_filename(pname, samplename_pat,
 
 
 def get_mapped_filtered_filename(pname, samplename_pat, fragment, type='bam', PCR=1,
-                                 decontaminated=True):
-    '''Get the filename of the mapped and filtered reads to initial reference'''
+                                 decontaminated=True, sort=False):
+    '''Get the filename of the mapped and filtered reads to initial reference
+
+    Parameters:
+       sort (bool): the coordinate-sorted, indexed twin for region queries
+    '''
     filename = fragment
     if not decontaminated:
         filename = filename+'_to_decontaminate'
+    if sort:
+        filename = filename+'_sorted'
     filename = filename+'.'+type
     filename = get_mapped_to_initial_foldername(pname, samplename_pat, PCR=PCR)+filename
     return filename
@@ -181,22 +194,56 @@ def get_allele_counts_filename(pname, samplename_pat, fragment, PCR=1, qual_min=
     return filename
 
 
+def get_trajectory_store_foldername(pname, qual_min=30):
+    '''Get the folder of the consolidated trajectory store of a patient'''
+    foldername = 'trajectories_qual'+str(qual_min)+'+/'
+    foldername = get_foldername(pname)+foldername
+    return foldername
+
+
+def get_trajectory_store_filename(pname, qual_min=30):
+    '''Get the filename of the index of the trajectory store of a patient'''
+    filename = 'index.json'
+    filename = get_trajectory_store_foldername(pname, qual_min=qual_min)+filename
+    return filename
+
+
+def get_pipeline_manifest_filename(pname):
+    '''Get the filename of the pipeline manifest of a patient'''
+    filename = 'pipeline_manifest.json'
+    filename = get_foldername(pname)+filename
+    return filename
+
+
 def get_insertions_filename(pname, samplename_pat, fragment, PCR=1, qual_min=30,
-                            type='nuc'):
-    '''Get the filename of the insertions for a patient sample'''
+                            type='nuc', format='pickle'):
+    '''Get the filename of the insertions for a patient sample
+    
+    Parameters:
+       format (str): 'pickle' for Counters, 'npz' for the columnar format (see
+       InsertionTable)
+    '''
     filename = 'insertions_'
     if type != 'nuc':
         filename = filename+type+'_'
-    filename = filename+fragment+'_qual'+str(qual_min)+'+'+'.pickle'
+    filename = filename+fragment+'_qual'+str(qual_min)+'+'+'.'+format
     filename = get_sample_foldername(pname, samplename_pat, PCR=PCR)+filename
     return filename
 
 
 def get_allele_cocounts_filename(pname, samplename_pat, fragment, PCR=1, qual_min=30,
-                                 compressed=True):
-    '''Get the matrix of allele cocounts on the initial reference'''
-    filename = 'allele_cocounts_'+fragment+'_qual'+str(qual_min)+'+'+'.'
-    if compressed:
+                                 compressed=True, sparse=False):
+    '''Get the matrix of allele cocounts on the initial reference
+    
+    Parameters:
+       sparse (bool): the sparse, symmetric format (see CocountMatrix), which
+       is never compressed to allow memory mapping
+    '''
+    filename = 'allele_cocounts_'
+    if sparse:
+        filename = filename+'sparse_'
+    filename = filename+fragment+'_qual'+str(qual_min)+'+'+'.'
+    if compressed and (not sparse):
         filename = filename+'npz'
     else:
         filename = filename+'npy'
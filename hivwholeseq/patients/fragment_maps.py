@@ -0,0 +1,150 @@
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    Coordinate maps from the fragment references of a patient to the
+            genomewide reference. They are computed once per patient and stored
+            next to the initial references, so genomewide merging is a matter
+            of fancy indexing.
+'''
+# Modules
+import os
+import numpy as np
+
+
+
+# Globals
+fragments = ['F'+str(i) for i in xrange(1, 7)]
+
+
+
+# Functions
+def build_fragment_map(ref_genomewide, ref_fragment, VERBOSE=0):
+    '''Map the positions of a fragment reference onto the genomewide one
+
+    Returns:
+       mapfr (int array): genomewide position of each fragment position, -1 if
+       the fragment position is a gap in the genomewide reference
+    '''
+    from seqanpy import align_overlap
+
+    (score, ali1, ali2) = align_overlap(ref_genomewide, ref_fragment)
+    ali1 = np.fromstring(ali1, 'S1')
+    ali2 = np.fromstring(ali2, 'S1')
+
+    # Alignment columns of all fragment positions, and the genomewide position
+    # of each column (the fragment starts within the genomewide reference)
+    cols = (ali2 != '-').nonzero()[0]
+    pos_gw = np.cumsum(ali1 != '-') - 1
+
+    mapfr = pos_gw[cols]
+    mapfr[ali1[cols] == '-'] = -1
+
+    if VERBOSE >= 2:
+        print 'Fragment map:', mapfr[mapfr >= 0][[0, -1]]
+
+    return mapfr
+
+
+def build_fragment_maps(ref_genomewide, refs_fragments, VERBOSE=0, margin=1000):
+    '''Map all fragment references onto the genomewide one
+
+    Parameters:
+       ref_genomewide (str): genomewide reference
+       refs_fragments (list): pairs of (fragment, reference) in genomic order
+       margin (int): each fragment is searched from this far before the end of
+       the previous one (as in the original merge)
+
+    Returns:
+       maps (dict): the map of each fragment (see build_fragment_map)
+    '''
+    ref_genomewide = ''.join(ref_genomewide)
+
+    maps = {}
+    pos_ref = margin
+    for (fragment, ref) in refs_fragments:
+        offset = max(0, pos_ref - margin)
+        mapfr = build_fragment_map(ref_genomewide[offset:], ''.join(ref),
+                                   VERBOSE=VERBOSE)
+        mapfr[mapfr >= 0] += offset
+        maps[fragment] = mapfr
+
+        mapped = mapfr[mapfr >= 0]
+        if len(mapped):
+            pos_ref = mapped[-1] + 1
+
+        if VERBOSE >= 1:
+            print fragment, (mapped[0], mapped[-1] + 1) if len(mapped) else None
+
+    return maps
+
+
+def get_insertion_map(mapfr):
+    '''Map insertion positions of a fragment onto the genomewide reference
+
+    Insertions are keyed by the position of the base that follows them, which
+    can be one past the end of the fragment.
+
+    Returns:
+       mapins (int array): genomewide position for each insertion position,
+       positions that are gaps in the genomewide take the next mapped one
+    '''
+    mapped = mapfr >= 0
+    mapins = np.append(mapfr, mapfr[mapped][-1] + 1 if mapped.any() else 0)
+    mapins[:-1][~mapped] = np.iinfo(mapins.dtype).max
+    mapins = np.minimum.accumulate(mapins[::-1])[::-1]
+    return mapins
+
+
+def get_reference_hash(seq):
+    '''Get the SHA1 of a reference sequence'''
+    import hashlib
+    return hashlib.sha1(''.join(seq)).hexdigest()
+
+
+def load_fragment_maps(pname, VERBOSE=0, save=True):
+    '''Load the fragment to genomewide maps of a patient
+
+    The maps are computed and stored if missing or if any reference changed
+    (the stored maps carry the hashes of the references they came from).
+
+    Parameters:
+       save (bool): store newly computed maps to file
+
+    Returns:
+       maps (dict): the map of each fragment with a reference
+    '''
+    from hivwholeseq.patients.filenames import get_initial_reference_filename, \
+            get_fragment_maps_filename
+    from hivwholeseq.patients.reference_cache import load_reference_cached
+
+    ref_genomewide = ''.join(load_reference_cached(
+        get_initial_reference_filename(pname, 'genomewide')))
+    refs = []
+    for fragment in fragments:
+        fn = get_initial_reference_filename(pname, fragment)
+        if os.path.isfile(fn):
+            refs.append((fragment, ''.join(load_reference_cached(fn))))
+
+    hashes = dict([('genomewide', get_reference_hash(ref_genomewide))] +
+                  [(fragment, get_reference_hash(ref)) for (fragment, ref) in refs])
+
+    fn_maps = get_fragment_maps_filename(pname)
+    if os.path.isfile(fn_maps):
+        data = np.load(fn_maps)
+        if all(('hash_'+key in data.files) and (str(data['hash_'+key]) == h)
+               for key, h in hashes.iteritems()):
+            return dict((fragment, data['map_'+fragment]) for (fragment, _) in refs)
+
+    if VERBOSE >= 1:
+        print 'Building fragment maps:', pname
+
+    maps = build_fragment_maps(ref_genomewide, refs, VERBOSE=VERBOSE)
+
+    if save:
+        arrs = dict([('map_'+fragment, mapfr) for fragment, mapfr in maps.iteritems()] +
+                    [('hash_'+key, np.array(h)) for key, h in hashes.iteritems()])
+        fn_tmp = fn_maps[:-len('.npz')]+'_tmp_'+str(os.getpid())+'.npz'
+        np.savez(fn_tmp, **arrs)
+        os.rename(fn_tmp, fn_maps)
+
+    return maps
@@ -58,4 +58,4 @@ if __name__ == '__main__':
             if VERBOSE >= 1:
                 print region, samplename
 
-            cocount = np.load(fn_out)['cocounts']
+            cocount = sample.get_allele_cocounts(region, qual_min=qual_min)
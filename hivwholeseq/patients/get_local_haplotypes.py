@@ -119,25 +119,57 @@ def trim_read_roi(read, start, end):
 
 
 def get_local_haplotypes(bamfilename, start, end, VERBOSE=0, maxreads=-1,
-                         label=''):
+                         label='', indexed=False):
     '''Extract reads fully covering the region, discarding insertions'''
+    return get_local_haplotypes_windows(bamfilename, [(start, end)],
+                                        VERBOSE=VERBOSE,
+                                        maxreads=maxreads,
+                                        label=label,
+                                        indexed=indexed)[0]
+
+
+def get_local_haplotypes_windows(bamfilename, windows, VERBOSE=0, maxreads=-1,
+                                 label='', indexed=False):
+    '''Extract local haplotypes in many windows with a single pass over the reads
+
+    Parameters:
+       bamfilename (str): path to the BAM with the reads
+       windows (list): (start, end) pairs of the windows
+       indexed (bool): the BAM is coordinate-sorted and indexed, so only the
+       pairs overlapping the windows are read (maxreads then picks among those)
+
+    Returns:
+       haplotypes (list of Counters): the haplotypes in each window
+    '''
     import sys
+    from bisect import bisect_left
     import pysam
-    from hivwholeseq.utils.mapping import pair_generator
+    from hivwholeseq.utils.mapping import pair_generator, pair_generator_region
     from hivwholeseq.utils.mapping import extract_mapped_reads_subsample_open
+    from hivwholeseq.utils.mapping import reservoir_sample
 
     from collections import Counter
-    haplotypes = Counter()
+    haplotypes = [Counter() for window in windows]
+
+    # Sort windows by start to find the ones within each read pair quickly
+    ind_windows = sorted(xrange(len(windows)), key=lambda i: windows[i])
+    starts = [windows[i][0] for i in ind_windows]
 
     with pysam.Samfile(bamfilename, 'rb') as bamfile:
 
-        if maxreads == -1:
+        if indexed:
+            reads_iter = pair_generator_region(bamfile, starts[0],
+                                               max(end for (start, end) in windows))
+            if maxreads != -1:
+                reads_iter = reservoir_sample(reads_iter, maxreads)
+        elif maxreads == -1:
             reads_iter = pair_generator(bamfile)
         else:
             reads_iter =  extract_mapped_reads_subsample_open(bamfile, maxreads,
                                                               VERBOSE=VERBOSE,
                                                               pairs=True)
 
+        irp = -1
         for irp, reads in enumerate(reads_iter):
             if VERBOSE >= 2:
                 if not ((irp + 1) % 10000):
@@ -160,30 +192,36 @@ def get_local_haplotypes(bamfilename, start, end, VERBOSE=0, maxreads=-1,
             end_rev = start_rev + sum(bl for (bt, bl) in reads[1].cigar if bt in (0, 2))
             overlap_len = max(0, end_fwd - start_rev)
 
-            # Various scenarios possible
-            if start_fwd > start:
-                continue
+            # Only windows starting after the fwd read can be covered
+            for iws in xrange(bisect_left(starts, start_fwd), len(starts)):
+                (start, end) = windows[ind_windows[iws]]
+
+                # Windows are sorted by start, so no later one is covered either
+                if start >= end_rev:
+                    break
+
+                # Various scenarios possible
+                if end_rev < end:
+                    continue
 
-            if end_rev < end:
-                continue
+                # No single read covers the whole region AND (the insert has a whole
+                # OR a very short overlap)
+                if (end_fwd < end) and (start_rev > start) and (overlap_len < 20):
+                    continue
 
-            # No single read covers the whole region AND (the insert has a whole
-            # OR a very short overlap)
-            if (end_fwd < end) and (start_rev > start) and (overlap_len < 20):
-                continue
+                # Now the good cases
+                if (start_fwd <= start) and (end_fwd >= end):
+                    seq = trim_read_roi(reads[0], start, end)
 
-            # Now the good cases
-            if (start_fwd <= start) and (end_fwd >= end):
-                seq = trim_read_roi(reads[0], start, end)
+                elif (start_rev <= start) and (end_rev >= end):
+                    seq = trim_read_roi(reads[1], start, end)
 
-            elif (start_rev <= start) and (end_rev >= end):
-                seq = trim_read_roi(reads[1], start, end)
+                else:
+                    seqs = [trim_read_roi(read, start, end) for read in reads]
+                    seq = merge_read_pair(*seqs)
 
-            else:
-                seqs = [trim_read_roi(read, start, end) for read in reads]
-                seq = merge_read_pair(*seqs)
+                haplotypes[ind_windows[iws]][seq] += 1
 
-            haplotypes[seq] += 1
             if VERBOSE >= 4:
                 import ipdb; ipdb.set_trace()
 
@@ -195,6 +233,46 @@ def get_local_haplotypes(bamfilename, start, end, VERBOSE=0, maxreads=-1,
     return haplotypes
 
 
+def filter_haplotypes(haplo, filters):
+    '''Filter local haplotypes in place
+
+    Parameters:
+       haplo (Counter): the haplotypes
+       filters (list): any of 'noN', 'nosingletons', 'mincount=<int>',
+       'freqmin=<float>'
+    '''
+    if 'noN' in filters:
+        hnames = [hname for hname in haplo.iterkeys() if 'N' in hname]
+        for hname in hnames:
+            del haplo[hname]
+
+    if 'nosingletons' in filters:
+        hnames = [hname for hname, c in haplo.iteritems() if c <= 1]
+        for hname in hnames:
+            del haplo[hname]
+
+    if any('mincount=' in ft for ft in filters):
+        for ft in filters:
+            if 'mincount=' in ft:
+                break
+        cmin = int(ft[len('mincount='):])
+        hnames = [hname for hname, c in haplo.iteritems() if c < cmin]
+        for hname in hnames:
+            del haplo[hname]
+    
+    if any('freqmin=' in ft for ft in filters):
+        for ft in filters:
+            if 'freqmin=' in ft:
+                break
+        fmin = float(ft[len('minfreq='):])
+        csum = sum(haplo.itervalues())
+        hnames = [hname for hname, c in haplo.iteritems() if c < fmin * csum]
+        for hname in hnames:
+            del haplo[hname]
+
+    return haplo
+
+
 def plot_haplotype_frequencies(times, hft, figax=None, title='',
                                picker=None):
     '''Plot haplotype frequencies'''
@@ -10,35 +10,41 @@ from hivwholeseq.patients.patients import load_patient
 from hivwholeseq.patients.samples import SamplePat
 from hivwholeseq.utils.exceptions import RoiError
 from hivwholeseq.utils.argparse import RoiAction
+from hivwholeseq.patients.reference_cache import ReferenceIndex
 
 
 
 # Functions
 def get_fragmented_roi(refseq, roi, VERBOSE=0, include_genomewide=False):
-    '''From a Region Of Interest, get fragment(s), start and end coordinates'''
-    def find_fragment(fea_frags, start, end, include_genomewide=False):
-        for fea in fea_frags:
-            fr_start = fea.location.nofuzzy_start
-            fr_end = fea.location.nofuzzy_end
-
-            if (fr_start <= start) and (fr_end >= end):
-                return (fea.id, start - fr_start, end - fr_start)
+    '''From a Region Of Interest, get fragment(s), start and end coordinates
+
+    Parameters:
+       refseq (SeqRecord or ReferenceIndex): annotated genomewide reference, or
+       its index (see patients/reference_cache.py)
+    '''
+    def find_fragment(index, start, end, include_genomewide=False):
+        frag = index.find_fragment(start, end)
+        if frag is not None:
+            (name, fr_start, _) = frag
+            return (name, start - fr_start, end - fr_start)
         
         if not include_genomewide:
             raise RoiError('No fragment found that fully covers this roi')
         else:
             return ('genomewide', start, end)
 
-    fea_frags = [fea for fea in refseq.features if fea.type == 'fragment']
-    feanames = [fea.id for fea in refseq.features]
+    if isinstance(refseq, ReferenceIndex):
+        index = refseq
+    else:
+        index = ReferenceIndex(refseq)
 
     if roi[0] in ['F'+str(i) for i in xrange(1, 7)]:
         start = roi[1]
         if roi[2] != '+oo':
             end = roi[2]
         else:
-            fea = refseq.features[feanames.index(roi[0])]
-            end = fea.location.nofuzzy_end - fea.location.nofuzzy_start
+            (fr_start, fr_end) = index.get_feature_coordinates(roi[0])
+            end = fr_end - fr_start
         roi = (roi[0], start, end)
 
         if VERBOSE >= 3:
@@ -50,22 +56,22 @@ def get_fragmented_roi(refseq, roi, VERBOSE=0, include_genomewide=False):
         if roi[2] != '+oo':
             end = roi[2]
         else:
-            end = len(refseq)
+            end = index.length
 
-        roi = find_fragment(fea_frags, start, end, include_genomewide=include_genomewide)
+        roi = find_fragment(index, start, end, include_genomewide=include_genomewide)
         if VERBOSE >= 3:
             print 'Genomewide selected', roi
         return roi
 
-    elif roi[0] in feanames:
-        fea = refseq.features[feanames.index(roi[0])]
-        start = roi[1] + fea.location.nofuzzy_start
+    elif roi[0] in index:
+        (fea_start, fea_end) = index.get_feature_coordinates(roi[0])
+        start = roi[1] + fea_start
         if roi[2] != '+oo':
-            end = roi[2] + fea.location.nofuzzy_start
+            end = roi[2] + fea_start
         else:
-            end = fea.location.nofuzzy_end
+            end = fea_end
 
-        roi = find_fragment(fea_frags, start, end, include_genomewide=include_genomewide)
+        roi = find_fragment(index, start, end, include_genomewide=include_genomewide)
         if VERBOSE >= 3:
             print 'Feature selected', roi
         return roi
@@ -94,24 +100,20 @@ def get_fragments_covered(patsam, roi, VERBOSE=0, include_coordinates=False):
                     'fragment': (start, end),
                    }]
 
-    refseq = patsam.get_reference('genomewide', 'gb')
+    index = patsam.get_reference_index()
     frags_cov = []
-    for fea in refseq.features:
-        if fea.type == 'fragment':
-            start_fr = fea.location.nofuzzy_start
-            end_fr = fea.location.nofuzzy_end
-            if (start_fr < end) & (end_fr > start):
-                if not include_coordinates:
-                    datum = fea.id
-                else:
-                    datum = {'name': fea.id,
-                             'roi': (max(start, start_fr) - start,
-                                     min(end, end_fr) - start),
-                             'fragment': (max(start, start_fr) - start_fr,
-                                          min(end, end_fr) - start_fr),
-                            }
-
-                frags_cov.append(datum)
+    for (name, start_fr, end_fr) in index.get_fragments_overlapping(start, end):
+        if not include_coordinates:
+            datum = name
+        else:
+            datum = {'name': name,
+                     'roi': (max(start, start_fr) - start,
+                             min(end, end_fr) - start),
+                     'fragment': (max(start, start_fr) - start_fr,
+                                  min(end, end_fr) - start_fr),
+                    }
+
+        frags_cov.append(datum)
 
     return frags_cov
 
@@ -17,16 +17,54 @@ from hivwholeseq.utils.miseq import alpha
 
 
 # Functions
+def load_allele_counts(filename, start=None, end=None):
+    '''Load allele counts of a sample, optionally only a region
+
+    Parameters:
+       start (int): first position to load (default: region start)
+       end (int): position after the last to load (default: region end)
+
+    Returns:
+       counts (ndarray): read types x alphabet x (end - start)
+
+    NOTE: .npy files are memory mapped and only [start, end) is read from
+    disk. Older files pickled via ndarray.dump are read whole (convert them
+    with store/convert_allele_counts.py).
+    '''
+    from hivwholeseq.utils.generic import is_npy_file
+
+    if is_npy_file(filename):
+        return np.load(filename, mmap_mode='r')[:, :, start: end]
+
+    import cPickle as pickle
+    from warnings import warn
+    from hivwholeseq.utils.exceptions import OldFormatWarning
+    warn('Pickled allele counts, convert with convert_allele_counts.py: '+filename,
+         OldFormatWarning)
+    with open(filename, 'rb') as f:
+        return pickle.load(f)[:, :, start: end]
+
+
 def get_allele_count_trajectories(pname, samplenames, fragment, use_PCR1=1,
+                                  start=None, end=None, use_store=True,
                                   VERBOSE=0):
-    '''Get allele counts for a single patient sample'''
+    '''Get allele counts for a single patient sample
+    
+    Parameters:
+       start (int): first position to load (default: fragment start)
+       end (int): position after the last to load (default: fragment end)
+       use_store (bool): read from the patient trajectory store if it has all
+       samples found on disk, up to date, else from the per-sample files
+
+    NOTE: only the [start, end) region of the count files is read from disk
+    before summing over read types (see load_allele_counts).
+    '''
     if VERBOSE >= 1:
         print 'Getting allele counts:', pname, fragment
 
     from hivwholeseq.patients.filenames import get_initial_reference_filename, \
             get_allele_counts_filename
 
-    refseq = SeqIO.read(get_initial_reference_filename(pname, fragment), 'fasta')
     fns = []
     samplenames_out = []
     for samplename_pat in samplenames:
@@ -60,15 +98,28 @@ def get_allele_count_trajectories(pname, samplenames, fragment, use_PCR1=1,
                 if VERBOSE >= 3:
                     print samplename_pat, 1
 
-    act = np.zeros((len(fns), len(alpha), len(refseq)), int)
+    if use_store:
+        from hivwholeseq.patients.trajectory_store import load_trajectory_store
+        store = load_trajectory_store(pname)
+        if (store is not None) and store.has_samples(fragment, samplenames_out,
+                                                     filenames=fns):
+            if VERBOSE >= 2:
+                print 'Reading from trajectory store'
+            return store.get_counts(fragment, samplenames, use_PCR1=use_PCR1,
+                                    start=start, end=end)
+
+    refseq = SeqIO.read(get_initial_reference_filename(pname, fragment), 'fasta')
+    (start, end, _) = slice(start, end).indices(len(refseq))
+    act = np.zeros((len(fns), len(alpha), max(0, end - start)), int)
     for i, fn in enumerate(fns):
         # Average directly over read types?
-        act[i] = np.load(fn).sum(axis=0)
+        act[i] = load_allele_counts(fn, start=start, end=end).sum(axis=0)
 
     return (samplenames_out, act)
 
 
-def get_allele_count_trajectories_aa(pname, samplenames, protein, VERBOSE=0):
+def get_allele_count_trajectories_aa(pname, samplenames, protein,
+                                     use_store=True, VERBOSE=0):
     '''Get allele counts for a single patient sample
     
     NOTE: we use only PCR1.
@@ -89,10 +140,19 @@ def get_allele_count_trajectories_aa(pname, samplenames, protein, VERBOSE=0):
             if VERBOSE >= 3:
                 print samplename_pat, 1
 
+    if use_store:
+        from hivwholeseq.patients.trajectory_store import load_trajectory_store
+        store = load_trajectory_store(pname)
+        if (store is not None) and store.has_samples(protein, samplenames_out,
+                                                     type='aa', filenames=fns):
+            if VERBOSE >= 2:
+                print 'Reading from trajectory store'
+            return store.get_counts(protein, samplenames, type='aa', use_PCR1=2)
+
     act = []
     for i, fn in enumerate(fns):
         # Average directly over read types?
-        act.append(np.load(fn).sum(axis=0))
+        act.append(load_allele_counts(fn).sum(axis=0))
     act = np.array(act)
 
     return (samplenames_out, act)
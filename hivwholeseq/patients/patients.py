@@ -143,8 +143,8 @@ class Patient(pd.Series):
         from .get_roi import get_fragmented_roi
         if isinstance(roi, basestring):
             roi = (roi, 0, '+oo')
-        refseq = self.get_reference('genomewide', 'gb')
-        return get_fragmented_roi(refseq, roi, VERBOSE=VERBOSE, **kwargs)
+        return get_fragmented_roi(self.get_reference_index(), roi,
+                                  VERBOSE=VERBOSE, **kwargs)
 
     
     def get_fragments_covered(self, roi, VERBOSE=0):
@@ -159,9 +159,15 @@ class Patient(pd.Series):
         return get_initial_reference_filename(self.name, fragment, format)
 
 
+    def get_reference_index(self):
+        '''Get the feature and fragment index of the annotated reference'''
+        from .reference_cache import load_reference_index
+        return load_reference_index(self.get_reference_filename('genomewide', 'gb'))
+
+
     def get_reference(self, region, format='fasta'):
-        '''Get the reference for a genomic region'''
-        from Bio import SeqIO
+        '''Get the reference for a genomic region (cached in memory)'''
+        from .reference_cache import load_reference_cached
         fragments = ['F'+str(i) for i in xrange(1, 7)] + ['genomewide']
 
         if region in fragments:
@@ -170,12 +176,9 @@ class Patient(pd.Series):
             (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                              include_genomewide=True)
 
-        refseq = SeqIO.read(self.get_reference_filename(fragment, format=format),
-                            format)
-
-        if format in ('gb', 'genbank'):
-            from hivwholeseq.utils.sequence import correct_genbank_features_load
-            correct_genbank_features_load(refseq)
+        refseq = load_reference_cached(self.get_reference_filename(fragment,
+                                                                   format=format),
+                                       format)
 
         if region not in fragments:
             refseq = refseq[start: end]
@@ -382,13 +385,55 @@ class Patient(pd.Series):
         return (aft, ind)
 
 
-    def get_insertion_trajectories(self, region, **kwargs):
+    def get_insertion_trajectories(self, region, use_store=True, **kwargs):
         '''Get the trajectory of insertions'''
+        import os
         from collections import Counter
+        from .trajectory_store import load_trajectory_store
         (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                          include_genomewide=True)
         ind = []
         ics = Counter()
+
+        # The store has PCR1 insertions with read types merged
+        PCR = kwargs.get('PCR', 1)
+        qual_min = kwargs.get('qual_min', 30)
+        if use_store and (PCR == 1) and kwargs.get('merge_read_types', True) \
+           and (not kwargs.get('table', False)):
+            store = load_trajectory_store(self.name, qual_min=qual_min)
+        else:
+            store = None
+
+        if store is not None:
+            sns_disk = []
+            fns_disk = []
+            for sample in self.itersamples():
+                for format in ('npz', 'pickle'):
+                    fn = sample.get_insertions_filename(fragment, PCR=PCR,
+                                                        qual_min=qual_min,
+                                                        format=format)
+                    if os.path.isfile(fn):
+                        sns_disk.append((sample.name, PCR))
+                        fns_disk.append(fn)
+                        break
+            if not store.has_samples(fragment, sns_disk, type='ins',
+                                     filenames=fns_disk):
+                store = None
+
+        if store is not None:
+            (sns, icss) = store.get_insertions(fragment, self.samples.index,
+                                               use_PCR1=2)
+            sns = [sn for (sn, _) in sns]
+            for i, sample in enumerate(self.itersamples()):
+                if sample.name not in sns:
+                    continue
+                time = sample['days since infection']
+                ind.append(i)
+                for (position, insertion), value in icss[sns.index(sample.name)].iteritems():
+                    if start <= position < end:
+                        ics[(time, position - start, insertion)] = value
+            return (ics, ind)
+
         for i, sample in enumerate(self.itersamples()):
             time = sample['days since infection']
             try:
@@ -445,8 +490,9 @@ class Patient(pd.Series):
                 end = part.nofuzzy_end - fea_frag.location.nofuzzy_start
                 (sns, act) = get_allele_count_trajectories(self.name, self.samples.index,
                                                            fragment,
-                                                           use_PCR1=2, **kwargs)
-                act = act[:, :, start: end]
+                                                           use_PCR1=2,
+                                                           start=start, end=end,
+                                                           **kwargs)
                 ind = np.array([i for i, (_, sample) in enumerate(self.samples.iterrows())
                                 if sample.name in map(itemgetter(0), sns)], int)
                 acts.append(act)
@@ -467,11 +513,12 @@ class Patient(pd.Series):
             # Fall back on genomewide counts if no single fragment is enough
             (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                              include_genomewide=True)
+            # Select genomic region (only that bit is read from disk)
             (sns, act) = get_allele_count_trajectories(self.name, self.samples.index,
                                                        fragment,
-                                                       use_PCR1=2, **kwargs)
-            # Select genomic region
-            act = act[:, :, start: end]
+                                                       use_PCR1=2,
+                                                       start=start, end=end,
+                                                       **kwargs)
 
             # Select time points
             ind = np.array([i for i, (_, sample) in enumerate(self.samples.iterrows())
@@ -479,10 +526,10 @@ class Patient(pd.Series):
 
             # If safe, take only samples tagged with 'OK'
             if safe:
+                frags = self.get_fragments_covered((fragment, start, end))
                 ind_safe = np.zeros(len(ind), bool)
                 for ii, i in enumerate(ind):
                     sample = self.samples.iloc[i]
-                    frags = self.get_fragments_covered((fragment, start, end))
                     ind_safe[ii] = all(getattr(sample, fr).upper() == 'OK'
                                        for fr in frags)
 
@@ -515,10 +562,10 @@ class Patient(pd.Series):
         # If safe, take only samples tagged with 'OK'
         if safe:
             (fragment, start, end) = self.get_fragmented_roi(protein, VERBOSE=VERBOSE)
+            frags = self.get_fragments_covered((fragment, start, end))
             ind_safe = np.zeros(len(ind), bool)
             for ii, i in enumerate(ind):
                 sample = self.samples.iloc[i]
-                frags = self.get_fragments_covered((fragment, start, end))
                 ind_safe[ii] = all(getattr(sample, fr).upper() == 'OK'
                                    for fr in frags)
 
@@ -687,6 +734,82 @@ class Patient(pd.Series):
                                                               start, end,
                                                               VERBOSE=VERBOSE,
                                                               **kwargs)
+        return self.build_haplotype_count_trajectories(haplos, ind,
+                                                       align=align,
+                                                       return_dict=return_dict)
+
+
+    def get_local_haplotype_count_trajectories_windows(self,
+                                                       region, windows,
+                                                       VERBOSE=0,
+                                                       align=False,
+                                                       return_dict=False,
+                                                       **kwargs):
+        '''Get trajectories of local haplotypes counts in many windows
+
+        Each sample and fragment is scanned only once for all windows.
+
+        Parameters:
+           region (str): genomic region or fragment
+           windows (list): (start, end) pairs of the windows in region
+
+        Returns:
+           data (list): the output of get_local_haplotype_count_trajectories
+           for each window, or None if no fragment fully covers the window
+        '''
+        from operator import itemgetter
+        from itertools import izip
+        from ..utils.exceptions import RoiError
+
+        # Resolve the windows to fragments
+        windows_frag = {}
+        for iw, (start, end) in enumerate(windows):
+            if region in ['F'+str(i) for i in xrange(1, 7)]:
+                fragment = region
+            else:
+                try:
+                    (fragment, start, end) = self.get_fragmented_roi((region, start, end),
+                                                                     VERBOSE=VERBOSE)
+                except RoiError:
+                    continue
+
+            if fragment not in windows_frag:
+                windows_frag[fragment] = []
+            windows_frag[fragment].append((iw, (start, end)))
+
+        inds = [[] for window in windows]
+        haplos = [[] for window in windows]
+        for i, sample in enumerate(self.itersamples()):
+            for fragment, windows_i in windows_frag.iteritems():
+                try:
+                    haplos_sample = sample.get_local_haplotypes_windows(fragment,
+                                                                        map(itemgetter(1), windows_i),
+                                                                        VERBOSE=VERBOSE,
+                                                                        **kwargs)
+                except IOError:
+                    continue
+
+                # Discard time points with zero coverage
+                for (iw, window), haplo in izip(windows_i, haplos_sample):
+                    if len(haplo):
+                        haplos[iw].append(haplo)
+                        inds[iw].append(i)
+
+        data = [None for window in windows]
+        for windows_i in windows_frag.itervalues():
+            for (iw, window) in windows_i:
+                data[iw] = self.build_haplotype_count_trajectories(haplos[iw],
+                                                                   inds[iw],
+                                                                   align=align,
+                                                                   return_dict=return_dict)
+
+        return data
+
+
+    @staticmethod
+    def build_haplotype_count_trajectories(haplos, ind, align=False,
+                                           return_dict=False):
+        '''Build trajectories of haplotype counts from the single time points'''
         # Make trajectories of counts
         seqs_set = set()
         for haplo in haplos:
@@ -707,7 +830,7 @@ class Patient(pd.Series):
 
         if align:
             from ..utils.sequence import align_muscle
-            ali = align_muscle(*seqs_set, sort=True)
+            ali = align_muscle(*seqs_set, sort=True, cache=True)
             alim = np.array(ali)
             
             if return_dict:
@@ -939,7 +1062,8 @@ def iterpatient(patients):
 
 def load_patients(pnames=None):
     '''Load patients from general table'''
-    patients = pd.read_excel(table_filename, 'Patients', index_col=1)
+    from hivwholeseq.utils.pandas import read_excel_cached
+    patients = read_excel_cached(table_filename, 'Patients', index_col=1)
     patients.index = pd.Index(map(str, patients.index))
 
     if pnames is not None:
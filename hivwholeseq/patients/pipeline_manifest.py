@@ -0,0 +1,379 @@
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    Manifest of the patient pipeline: for each output (target), the
+            content hashes of its inputs and the parameters it was made with.
+            Targets are up to date if neither changed since, so the store
+            scripts can recompute only stale targets (make-style).
+'''
+# Modules
+import os
+import json
+import hashlib
+
+
+
+# Globals
+# Steps in dependency order, with the steps they require
+pipeline_steps = [('map', []),
+                  ('filter', ['map']),
+                  ('decontaminate', ['filter']),
+                  ('consensus', ['decontaminate']),
+                  ('allele counts', ['decontaminate']),
+                  ('allele cocounts', ['decontaminate']),
+                  ('trajectories', ['allele counts']),
+                 ]
+step_names = [step for (step, _) in pipeline_steps]
+
+
+
+# Classes
+class PipelineManifest(object):
+    '''Pipeline manifest of a patient
+
+    The manifest is a JSON file with two tables:
+       - files: size, modification time and SHA1 of every file seen, so files
+         are hashed again only if they changed on disk
+       - targets: for each output, its step, parameters, SHA1, and the SHA1 of
+         its inputs when it was made
+    '''
+    def __init__(self, pname):
+        self.pname = pname
+        self.changed = False
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as f:
+                self.data = json.load(f)
+        else:
+            self.data = {'files': {}, 'targets': {}}
+
+
+    def __repr__(self):
+        return 'PipelineManifest('+repr(self.pname)+')'
+
+
+    @property
+    def filename(self):
+        '''Filename of the manifest'''
+        from hivwholeseq.patients.filenames import get_pipeline_manifest_filename
+        return get_pipeline_manifest_filename(self.pname)
+
+
+    def get_file_hash(self, filename, blocksize=1 << 20):
+        '''Get the SHA1 of a file, hashing it only if it changed on disk'''
+        st = os.stat(filename)
+        rec = self.data['files'].get(filename, None)
+        if (rec is not None) and (rec['size'] == st.st_size) and \
+           (rec['mtime'] == st.st_mtime):
+            return rec['sha1']
+
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), ''):
+                h.update(block)
+        self.data['files'][filename] = {'size': st.st_size,
+                                        'mtime': st.st_mtime,
+                                        'sha1': h.hexdigest()}
+        self.changed = True
+        return h.hexdigest()
+
+
+    def get_input_hashes(self, inputs):
+        '''Get the SHA1 of the existing inputs'''
+        return dict((fn, self.get_file_hash(fn))
+                    for fn in inputs if os.path.isfile(fn))
+
+
+    def get_target_status(self, target, inputs, params=None):
+        '''Get the status of a target
+
+        Parameters:
+           target (str): output filename
+           inputs (list): input filenames (missing ones are ignored)
+           params (dict): parameters of the step, None not to check them
+
+        Returns:
+           status (str): MISS if the target does not exist, OLD if inputs or
+           parameters changed since it was made, else OK
+
+        NOTE: targets made before the manifest existed are OK if they are newer
+        than all their inputs (as make does).
+        '''
+        if not os.path.isfile(target):
+            return 'MISS'
+
+        rec = self.data['targets'].get(target, None)
+        if rec is None:
+            md = os.path.getmtime(target)
+            if all(md >= os.path.getmtime(fn) for fn in inputs if os.path.isfile(fn)):
+                return 'OK'
+            return 'OLD'
+
+        if rec['sha1'] != self.get_file_hash(target):
+            return 'OLD'
+
+        if (params is not None) and (rec['params'] is not None) and \
+           (rec['params'] != normalize_params(params)):
+            return 'OLD'
+
+        if rec['inputs'] != self.get_input_hashes(inputs):
+            return 'OLD'
+
+        return 'OK'
+
+
+    def record(self, target, step, inputs, params=None):
+        '''Record that a target has just been made from its inputs'''
+        self.data['targets'][target] = {'step': step,
+                                        'params': normalize_params(params),
+                                        'sha1': self.get_file_hash(target),
+                                        'inputs': self.get_input_hashes(inputs)}
+        self.changed = True
+
+
+    def save(self):
+        '''Save the manifest to file (atomically)'''
+        fn = self.filename
+        fn_tmp = fn+'_tmp_'+str(os.getpid())
+        with open(fn_tmp, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.rename(fn_tmp, fn)
+        self.changed = False
+
+
+
+# Functions
+def normalize_params(params):
+    '''Normalize parameters as they come back from JSON (e.g. tuples to lists)'''
+    if params is None:
+        return None
+    return json.loads(json.dumps(params))
+
+
+def update_pipeline_manifest(pname, fun):
+    '''Load, update, and save the manifest of a patient with the file locked
+
+    Parameters:
+       fun (callable): called with the manifest, its return value is passed on
+
+    NOTE: cluster jobs of the same patient update the manifest concurrently.
+    '''
+    import fcntl
+    from hivwholeseq.patients.filenames import get_pipeline_manifest_filename
+
+    fn = get_pipeline_manifest_filename(pname)
+    with open(fn[:-len('.json')]+'.lock', 'a') as flock:
+        fcntl.lockf(flock, fcntl.LOCK_EX)
+        try:
+            manifest = PipelineManifest(pname)
+            out = fun(manifest)
+            if manifest.changed:
+                manifest.save()
+        finally:
+            fcntl.lockf(flock, fcntl.LOCK_UN)
+    return out
+
+
+def get_step_targets(sample, step, fragment=None, PCR=1, qual_min=30,
+                     filtered=True, sparse=True):
+    '''Get targets of a pipeline step and their inputs
+
+    Parameters:
+       sample (SamplePat or Patient): the patient for trajectories, else the
+       patient sample (with samples_seq restricted to some sequenced samples
+       to map only those)
+       step (str): one of step_names
+       fragment (str): the fragment (ignored for trajectories)
+       filtered (bool): map reads filtered after premapping (see
+       map_to_initial_reference)
+       sparse (bool): sparse allele cocounts
+
+    Returns:
+       targets (list): pairs of (target, inputs) filenames
+    '''
+    if step not in step_names:
+        raise ValueError('Pipeline step not found: '+str(step))
+
+    if step == 'trajectories':
+        from hivwholeseq.patients.filenames import get_trajectory_store_filename
+        regions = ['F'+str(i) for i in xrange(1, 7)] + ['genomewide']
+        inputs = []
+        for sample_pat in sample.itersamples():
+            for PCR_sample in (1, 2):
+                for region in regions:
+                    inputs.append(sample_pat.get_allele_counts_filename(region,
+                                                                       PCR=PCR_sample,
+                                                                       qual_min=qual_min))
+                    inputs.extend(sample_pat.get_insertions_filename(region,
+                                                                     PCR=PCR_sample,
+                                                                     qual_min=qual_min,
+                                                                     format=format)
+                                  for format in ('npz', 'pickle'))
+        return [(get_trajectory_store_filename(sample.name, qual_min=qual_min),
+                 inputs)]
+
+    from hivwholeseq.patients.filenames import get_mapped_to_initial_filename
+    pname = sample.patient
+    fn_ref = sample.get_reference_filename(fragment)
+
+    # Mapped reads, one file per sequenced sample
+    if step in ('map', 'filter'):
+        from hivwholeseq.sequencing.samples import SampleSeq
+        from hivwholeseq.store.map_to_initial_reference import get_input_filename
+
+        targets_map = []
+        for samplename_seq, sample_seq in sample.samples_seq.iterrows():
+            sample_seq = SampleSeq(sample_seq)
+            if (int(sample_seq['PCR']) != PCR) or \
+               (fragment not in sample_seq.regions_generic):
+                continue
+            fn_in = get_input_filename(sample_seq.seqrun_folder, sample_seq.adapter,
+                                       sample_seq.convert_region(fragment),
+                                       type='bam', filtered=filtered)
+            fn_out = get_mapped_to_initial_filename(pname, sample.name,
+                                                    samplename_seq, fragment,
+                                                    type='bam', PCR=PCR)
+            targets_map.append((fn_out, [fn_ref, fn_in]))
+
+    if step == 'map':
+        return targets_map
+
+    fn_filt = sample.get_mapped_filtered_filename(fragment, PCR=PCR,
+                                                  decontaminated=False)
+    if step == 'filter':
+        return [(fn_filt, [fn_ref] + [fn for (fn, _) in targets_map])]
+
+    fn_decont = sample.get_mapped_filtered_filename(fragment, PCR=PCR,
+                                                    decontaminated=True)
+    if step == 'decontaminate':
+        return [(fn_decont, [fn_filt])]
+
+    if step == 'consensus':
+        fn_out = sample.get_consensus_filename(fragment, PCR=PCR)
+    elif step == 'allele counts':
+        fn_out = sample.get_allele_counts_filename(fragment, PCR=PCR,
+                                                   qual_min=qual_min)
+    elif step == 'allele cocounts':
+        fn_out = sample.get_allele_cocounts_filename(fragment, PCR=PCR,
+                                                     qual_min=qual_min,
+                                                     sparse=sparse)
+    return [(fn_out, [fn_decont, fn_ref])]
+
+
+def is_step_up_to_date(sample, step, fragment=None, PCR=1, qual_min=30,
+                       params=None, VERBOSE=0, **kwargs):
+    '''Check whether all targets of a step are up to date
+
+    Parameters:
+       **kwargs: passed to get_step_targets
+    '''
+    targets = get_step_targets(sample, step, fragment=fragment, PCR=PCR,
+                               qual_min=qual_min, **kwargs)
+    pname = sample.name if step == 'trajectories' else sample.patient
+
+    def check(manifest):
+        return [manifest.get_target_status(target, inputs, params=params)
+                for (target, inputs) in targets]
+    stati = update_pipeline_manifest(pname, check)
+
+    if VERBOSE >= 2:
+        for (target, _), status in zip(targets, stati):
+            print status, target
+
+    return bool(len(stati)) and all(status == 'OK' for status in stati)
+
+
+def record_step(sample, step, fragment=None, PCR=1, qual_min=30, params=None,
+                VERBOSE=0, **kwargs):
+    '''Record the existing targets of a step as just made
+
+    Parameters:
+       **kwargs: passed to get_step_targets
+    '''
+    targets = get_step_targets(sample, step, fragment=fragment, PCR=PCR,
+                               qual_min=qual_min, **kwargs)
+    targets = [(target, inputs) for (target, inputs) in targets
+               if os.path.isfile(target)]
+    pname = sample.name if step == 'trajectories' else sample.patient
+
+    def record(manifest):
+        for (target, inputs) in targets:
+            manifest.record(target, step, inputs, params=params)
+    update_pipeline_manifest(pname, record)
+
+    if VERBOSE >= 2:
+        print 'Pipeline manifest updated:', pname, step, fragment
+
+
+def plan_pipeline(patient, steps=None, fragments=None, PCR=1, qual_min=30,
+                  VERBOSE=0):
+    '''Get the stale targets of a patient in dependency order
+
+    A target is stale if it is missing, if its inputs or parameters changed
+    since it was made, or if any of its inputs is itself stale (it is going to
+    change).
+
+    Returns:
+       plan (list): dicts with step, sample (None for trajectories), sequenced
+       sample (mapping only), fragment, target, and status (MISS, OLD, or DEP
+       for stale inputs)
+    '''
+    if steps is None:
+        steps = step_names
+    if fragments is None:
+        fragments = ['F'+str(i) for i in xrange(1, 7)]
+
+    jobs = []
+    for step in step_names:
+        if step not in steps:
+            continue
+        if step == 'trajectories':
+            for (target, inputs) in get_step_targets(patient, step,
+                                                     qual_min=qual_min):
+                jobs.append({'step': step, 'sample': None,
+                             'samplename_seq': None, 'fragment': None,
+                             'target': target, 'inputs': inputs})
+            continue
+
+        for sample in patient.itersamples():
+            # Mapping is done for each sequenced sample separately
+            if step == 'map':
+                samples_seq = sample.samples_seq
+                samplenames_seq = samples_seq.index.tolist()
+            else:
+                samplenames_seq = [None]
+
+            for samplename_seq in samplenames_seq:
+                if samplename_seq is not None:
+                    sample.samples_seq = samples_seq.loc[[samplename_seq]]
+
+                for fragment in fragments:
+                    for (target, inputs) in get_step_targets(sample, step, fragment,
+                                                             PCR=PCR,
+                                                             qual_min=qual_min):
+                        jobs.append({'step': step, 'sample': sample,
+                                     'samplename_seq': samplename_seq,
+                                     'fragment': fragment, 'target': target,
+                                     'inputs': inputs})
+
+            if step == 'map':
+                sample.samples_seq = samples_seq
+
+    def get_stati(manifest):
+        return [manifest.get_target_status(job['target'], job['inputs'])
+                for job in jobs]
+    stati = update_pipeline_manifest(patient.name, get_stati)
+
+    plan = []
+    stale = set()
+    for job, status in zip(jobs, stati):
+        if (status == 'OK') and any(fn in stale for fn in job['inputs']):
+            status = 'DEP'
+        if status != 'OK':
+            job['status'] = status
+            plan.append(job)
+            stale.add(job['target'])
+
+        if VERBOSE >= 3:
+            print '{:<16}'.format(job['step']), '{:<5}'.format(status), job['target']
+
+    return plan
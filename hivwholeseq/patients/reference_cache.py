@@ -0,0 +1,151 @@
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    In-memory cache of the patient references (fragments and annotated
+            genomewide), shared by all Patient and SamplePat instances, with an
+            index of features and fragments for fast ROI queries.
+'''
+# Modules
+import os
+from bisect import bisect_left, bisect_right
+
+
+
+# Globals
+_references = {}
+
+
+
+# Classes
+class ReferenceIndex(object):
+    '''Index of the features and fragments of an annotated reference
+
+    Features are looked up by name, fragments by position via binary search on
+    their sorted start and end coordinates. Amplicons are not nested, so ends
+    are sorted like starts; if they are not, the queries scan the candidates.
+    '''
+    def __init__(self, record):
+        self.length = len(record)
+
+        # NOTE: the first feature with a name wins, as in a linear scan
+        self.features = {}
+        for fea in record.features:
+            self.features.setdefault(fea.id, fea)
+
+        fragments = sorted(((fea.location.nofuzzy_start, i,
+                             fea.location.nofuzzy_end, fea.id)
+                            for i, fea in enumerate(record.features)
+                            if fea.type == 'fragment'))
+        self.fragment_starts = [start for (start, _, _, _) in fragments]
+        self.fragment_ends = [end for (_, _, end, _) in fragments]
+        self.fragment_names = [name for (_, _, _, name) in fragments]
+        self.ends_sorted = self.fragment_ends == sorted(self.fragment_ends)
+
+
+    def __repr__(self):
+        return 'ReferenceIndex('+str(len(self.features))+' features, '+\
+                str(len(self.fragment_names))+' fragments)'
+
+
+    def __contains__(self, name):
+        return name in self.features
+
+
+    def get_feature(self, name):
+        '''Get a feature by name'''
+        return self.features[name]
+
+
+    def get_feature_coordinates(self, name):
+        '''Get start and end of a feature'''
+        fea = self.features[name]
+        return (fea.location.nofuzzy_start, fea.location.nofuzzy_end)
+
+
+    def find_fragment(self, start, end):
+        '''Find the first fragment fully covering an interval
+
+        Returns:
+           (name, start, end): the fragment and its own coordinates, or None
+        '''
+        # Candidates start before the interval
+        i = bisect_right(self.fragment_starts, start)
+        if self.ends_sorted:
+            j = bisect_left(self.fragment_ends, end, 0, i)
+        else:
+            j = next((j for j in xrange(i) if self.fragment_ends[j] >= end), i)
+        if j == i:
+            return None
+        return (self.fragment_names[j], self.fragment_starts[j],
+                self.fragment_ends[j])
+
+
+    def get_fragments_overlapping(self, start, end):
+        '''Get all fragments overlapping an interval
+
+        Returns:
+           fragments (list): (name, start, end) of the fragments, sorted
+        '''
+        # Candidates start before the interval end
+        i = bisect_left(self.fragment_starts, end)
+        if self.ends_sorted:
+            j = bisect_right(self.fragment_ends, start, 0, i)
+        else:
+            j = 0
+        return [(self.fragment_names[k], self.fragment_starts[k],
+                 self.fragment_ends[k])
+                for k in xrange(j, i) if self.fragment_ends[k] > start]
+
+
+
+# Functions
+def _load_reference_entry(filename, format='fasta', VERBOSE=0):
+    '''Load a reference record and its index, reparsing only if the file changed'''
+    from Bio import SeqIO
+
+    mtime = os.path.getmtime(filename)
+    key = (os.path.abspath(filename), format)
+    if (key in _references) and (_references[key][0] == mtime):
+        return _references[key]
+
+    if VERBOSE >= 2:
+        print 'Reading reference:', filename
+
+    record = SeqIO.read(filename, format)
+    if format in ('gb', 'genbank'):
+        from hivwholeseq.utils.sequence import correct_genbank_features_load
+        correct_genbank_features_load(record)
+        index = ReferenceIndex(record)
+    else:
+        index = None
+
+    _references[key] = (mtime, record, index)
+    return _references[key]
+
+
+def load_reference_cached(filename, format='fasta', VERBOSE=0):
+    '''Load a reference, cached in memory
+
+    Returns:
+       record (SeqRecord): a copy of the cached record (callers may modify it)
+
+    NOTE: the cache is keyed on the path and format, and the file is parsed
+    again when its modification time changes.
+    '''
+    from copy import deepcopy
+    if not os.path.isfile(filename):
+        raise IOError('Reference file not found: '+filename)
+    return deepcopy(_load_reference_entry(filename, format=format,
+                                          VERBOSE=VERBOSE)[1])
+
+
+def load_reference_index(filename, VERBOSE=0):
+    '''Load the feature and fragment index of an annotated reference (GenBank)'''
+    if not os.path.isfile(filename):
+        raise IOError('Reference file not found: '+filename)
+    return _load_reference_entry(filename, format='gb', VERBOSE=VERBOSE)[2]
+
+
+def clear_reference_cache():
+    '''Empty the in-memory reference cache'''
+    _references.clear()
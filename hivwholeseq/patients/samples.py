@@ -65,8 +65,8 @@ class SamplePat(pd.Series):
         from hivwholeseq.patients.get_roi import get_fragmented_roi
         if isinstance(roi, basestring):
             roi = (roi, 0, '+oo')
-        refseq = self.get_reference('genomewide', 'gb')
-        return get_fragmented_roi(refseq, roi, VERBOSE=VERBOSE, **kwargs)
+        return get_fragmented_roi(self.get_reference_index(), roi,
+                                  VERBOSE=VERBOSE, **kwargs)
 
 
     def get_fragments_covered(self, roi, VERBOSE=0, include_coordinates=False):
@@ -82,9 +82,15 @@ class SamplePat(pd.Series):
         return get_initial_reference_filename(self.patient, fragment, format)
 
 
+    def get_reference_index(self):
+        '''Get the feature and fragment index of the annotated reference'''
+        from .reference_cache import load_reference_index
+        return load_reference_index(self.get_reference_filename('genomewide', 'gb'))
+
+
     def get_reference(self, region, format='fasta'):
-        '''Get the reference for a genomic region'''
-        from Bio import SeqIO
+        '''Get the reference for a genomic region (cached in memory)'''
+        from .reference_cache import load_reference_cached
         fragments = ['F'+str(i) for i in xrange(1, 7)] + ['genomewide']
 
         if region in fragments:
@@ -93,12 +99,9 @@ class SamplePat(pd.Series):
             (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                              include_genomewide=True)
 
-        refseq = SeqIO.read(self.get_reference_filename(fragment, format=format),
-                            format)
-
-        if format in ('gb', 'genbank'):
-            from hivwholeseq.utils.sequence import correct_genbank_features_load
-            correct_genbank_features_load(refseq)
+        refseq = load_reference_cached(self.get_reference_filename(fragment,
+                                                                   format=format),
+                                       format)
 
         if region not in fragments:
             refseq = refseq[start: end]
@@ -122,6 +125,21 @@ class SamplePat(pd.Series):
                                             PCR=PCR, **kwargs)
 
 
+    def get_mapped_filtered_filename_region(self, fragment, PCR=1):
+        '''Get the filename of the filtered reads best suited to region queries
+
+        Returns:
+           (filename, indexed): the coordinate-sorted, indexed twin if it is up
+           to date (indexed is True), else the name-sorted file
+        '''
+        from ..utils.mapping import is_sorted_bam_current
+        fn = self.get_mapped_filtered_filename(fragment, PCR=PCR)
+        fn_sorted = self.get_mapped_filtered_filename(fragment, PCR=PCR, sort=True)
+        if is_sorted_bam_current(fn_sorted, fn):
+            return (fn_sorted, True)
+        return (fn, False)
+
+
     def get_number_reads(self, fragment, PCR=1, **kwargs):
         '''Get the number of reads (not pairs)'''
         from ..utils.mapping import get_number_reads
@@ -137,20 +155,23 @@ class SamplePat(pd.Series):
                                           PCR=PCR, qual_min=qual_min, type=type)
 
 
-    def get_insertions_filename(self, fragment, PCR=1, qual_min=30, type='nuc'):
+    def get_insertions_filename(self, fragment, PCR=1, qual_min=30, type='nuc',
+                                format='pickle'):
         '''Get the filename of the insertions'''
         from hivwholeseq.patients.filenames import get_insertions_filename
         return get_insertions_filename(self.patient, self.name, fragment,
-                                       PCR=PCR, qual_min=qual_min, type=type)
+                                       PCR=PCR, qual_min=qual_min, type=type,
+                                       format=format)
 
 
     def get_allele_cocounts_filename(self, fragment, PCR=1, qual_min=30,
-                                     compressed=True):
+                                     compressed=True, sparse=False):
         '''Get the filename of the allele counts'''
         from hivwholeseq.patients.filenames import get_allele_cocounts_filename
         return get_allele_cocounts_filename(self.patient, self.name, fragment,
                                             PCR=PCR, qual_min=qual_min,
-                                            compressed=compressed)
+                                            compressed=compressed,
+                                            sparse=sparse)
 
 
     def get_consensus_filename(self, fragment, PCR=1):
@@ -194,64 +215,99 @@ class SamplePat(pd.Series):
 
     def get_allele_counts(self, region, PCR=1, qual_min=30, merge_read_types=True):
         '''Get the allele counts'''
-        import numpy as np
+        from hivwholeseq.patients.one_site_statistics import load_allele_counts
 
         # Fall back on genomewide counts if no single fragment is enough
         (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                          include_genomewide=True)
 
-        ac = np.load(self.get_allele_counts_filename(fragment, PCR=PCR, qual_min=qual_min))
-        ac = ac[:, :, start: end]
+        ac = load_allele_counts(self.get_allele_counts_filename(fragment, PCR=PCR,
+                                                                qual_min=qual_min),
+                                start=start, end=end)
+        ac = np.array(ac)
 
         if merge_read_types:
             ac = ac.sum(axis=0)
         return ac
 
 
-    def get_insertions(self, region, PCR=1, qual_min=30, merge_read_types=True):
+    def get_insertions(self, region, PCR=1, qual_min=30, merge_read_types=True,
+                       table=False):
         '''Get the insertions
         
+        Parameters:
+           table (bool): return an InsertionTable instead of Counters
+
         Returns:
            inse: if merge_read_types, a Counter, else a list of Counters
 
         Note: for convenience, one can call pd.Series on a Counter
+
+        NOTE: the columnar format is preferred if available, else the pickled
+        Counters are loaded.
         '''
-        from collections import Counter
+        import os
         import cPickle as pickle
+        from hivwholeseq.utils.one_site_statistics import InsertionTable
+
         (fragment, start, end) = self.get_fragmented_roi((region, 0, '+oo'),
                                                          include_genomewide=True)
-        fn = self.get_insertions_filename(fragment, PCR=PCR, qual_min=qual_min)
-        with open(fn, 'r') as f:
-            inse = pickle.load(f)
-        inse_new = []
-        for ins in inse:
-            ins_new = Counter()
-            for (pos, ins_string), value in ins.iteritems():
-                if (start <= pos < end):
-                    ins_new[(pos - start, ins_string)] = value
-            inse_new.append(ins_new)
-        inse = inse_new
+        fn = self.get_insertions_filename(fragment, PCR=PCR, qual_min=qual_min,
+                                          format='npz')
+        if os.path.isfile(fn):
+            inse = InsertionTable.load(fn)
+        else:
+            fn = self.get_insertions_filename(fragment, PCR=PCR, qual_min=qual_min)
+            with open(fn, 'r') as f:
+                inse = InsertionTable.from_counters(pickle.load(f))
 
+        inse = inse.get_region(start, end)
         if merge_read_types:
-            inse = sum(inse, Counter())
+            inse = inse.merge_read_types()
 
-        return inse
+        if table:
+            return inse
+        return inse.to_counters(merge_read_types=merge_read_types)
 
 
     def get_allele_counts_aa(self, protein, PCR=1, qual_min=30):
         '''Get the amino acid allele counts'''
         import numpy as np
-        ac = np.load(self.get_allele_counts_filename(protein, PCR=PCR,
-                                                     qual_min=qual_min,
-                                                     type='aa'))
-        return ac
+        from hivwholeseq.patients.one_site_statistics import load_allele_counts
+        ac = load_allele_counts(self.get_allele_counts_filename(protein, PCR=PCR,
+                                                                qual_min=qual_min,
+                                                                type='aa'))
+        return np.array(ac)
+
 
+    def get_allele_cocounts(self, fragment, PCR=1, qual_min=30, sparse=False):
+        '''Get the allele cocounts
 
-    def get_allele_cocounts(self, fragment, PCR=1, qual_min=30):
-        '''Get the allele cocounts'''
+        Parameters:
+           sparse (bool): return a memory-mapped CocountMatrix instead of a
+           dense matrix
+
+        NOTE: the sparse format is preferred if available, else the dense
+        compressed one is loaded.
+        '''
+        import os
         import numpy as np
-        acc = np.load(self.get_allele_cocounts_filename(fragment, PCR=PCR,
-                                                        qual_min=qual_min))['cocounts']
+        from hivwholeseq.utils.two_site_statistics import CocountMatrix
+
+        fn = self.get_allele_cocounts_filename(fragment, PCR=PCR,
+                                               qual_min=qual_min,
+                                               sparse=True)
+        if os.path.isfile(fn):
+            acc = CocountMatrix.load(fn)
+            if not sparse:
+                acc = acc.todense()
+
+        else:
+            acc = np.load(self.get_allele_cocounts_filename(fragment, PCR=PCR,
+                                                            qual_min=qual_min))['cocounts']
+            if sparse:
+                acc = CocountMatrix.from_dense(acc)
+
         return acc
 
 
@@ -271,46 +327,55 @@ class SamplePat(pd.Series):
                              PCR=1):
         '''Get local haplotypes'''
         from hivwholeseq.patients.get_local_haplotypes import get_local_haplotypes
-        bamfilename = self.get_mapped_filtered_filename(fragment, PCR=PCR)
+        from hivwholeseq.patients.get_local_haplotypes import filter_haplotypes
+        (bamfilename, indexed) = self.get_mapped_filtered_filename_region(fragment,
+                                                                          PCR=PCR)
         haplo = get_local_haplotypes(bamfilename,
                                      start, end,
                                      VERBOSE=VERBOSE,
                                      maxreads=maxreads,
-                                     label=self.name)
+                                     label=self.name,
+                                     indexed=indexed)
 
         if filters is not None:
-            if 'noN' in filters:
-                hnames = [hname for hname in haplo.iterkeys() if 'N' in hname]
-                for hname in hnames:
-                    del haplo[hname]
-
-            if 'nosingletons' in filters:
-                hnames = [hname for hname, c in haplo.iteritems() if c <= 1]
-                for hname in hnames:
-                    del haplo[hname]
-
-            if any('mincount=' in ft for ft in filters):
-                for ft in filters:
-                    if 'mincount=' in ft:
-                        break
-                cmin = int(ft[len('mincount='):])
-                hnames = [hname for hname, c in haplo.iteritems() if c < cmin]
-                for hname in hnames:
-                    del haplo[hname]
-            
-            if any('freqmin=' in ft for ft in filters):
-                for ft in filters:
-                    if 'freqmin=' in ft:
-                        break
-                fmin = float(ft[len('minfreq='):])
-                csum = sum(haplo.itervalues())
-                hnames = [hname for hname, c in haplo.iteritems() if c < fmin * csum]
-                for hname in hnames:
-                    del haplo[hname]
+            filter_haplotypes(haplo, filters)
 
         return haplo
 
 
+    def get_local_haplotypes_windows(self,
+                                     fragment, windows,
+                                     VERBOSE=0,
+                                     maxreads=-1,
+                                     filters=None,
+                                     PCR=1):
+        '''Get local haplotypes in many windows, scanning the reads once
+
+        Parameters:
+           fragment (str): the fragment
+           windows (list): (start, end) pairs of the windows in the fragment
+
+        Returns:
+           haplos (list of Counters): the haplotypes in each window
+        '''
+        from hivwholeseq.patients.get_local_haplotypes import get_local_haplotypes_windows
+        from hivwholeseq.patients.get_local_haplotypes import filter_haplotypes
+        (bamfilename, indexed) = self.get_mapped_filtered_filename_region(fragment,
+                                                                          PCR=PCR)
+        haplos = get_local_haplotypes_windows(bamfilename,
+                                              windows,
+                                              VERBOSE=VERBOSE,
+                                              maxreads=maxreads,
+                                              label=self.name,
+                                              indexed=indexed)
+
+        if filters is not None:
+            for haplo in haplos:
+                filter_haplotypes(haplo, filters)
+
+        return haplos
+
+
 
 # Functions
 def itersample(samples):
@@ -320,8 +385,9 @@ def itersample(samples):
 
 def load_samples_sequenced(patients=None, include_empty=False):
     '''Load patient samples sequenced from general table'''
-    sample_table = pd.read_excel(table_filename, 'Samples timeline sequenced',
-                                 index_col=0)
+    from hivwholeseq.utils.pandas import read_excel_cached
+    sample_table = read_excel_cached(table_filename, 'Samples timeline sequenced',
+                                     index_col=0)
 
     # Reindex DataFrame
     sample_table.index = pd.Index(map(str, sample_table.index))
@@ -332,8 +398,7 @@ def load_samples_sequenced(patients=None, include_empty=False):
     sample_table['n templates'] = sample_table['viral load'] * 0.4 / 12 * 2
 
     if not include_empty:
-        ind = [i for i, sample in sample_table.iterrows()
-               if (sample[['F1', 'F2', 'F3', 'F4', 'F5', 'F6']] != 'miss').any()]
+        ind = (sample_table[['F1', 'F2', 'F3', 'F4', 'F5', 'F6']] != 'miss').any(axis=1)
         sample_table = sample_table.loc[ind]
 
     if patients is not None:
@@ -0,0 +1,437 @@
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    Consolidated per-patient store of allele count and insertion
+            trajectories, to avoid scanning dozens of per-sample files.
+'''
+# Modules
+import os
+import json
+from collections import Counter
+import numpy as np
+
+
+
+# Classes
+class TrajectoryStore(object):
+    '''Allele count and insertion trajectories of a patient
+
+    The store is a folder with one group of arrays per region and data type.
+    Each group is an uncompressed .npy file, named '<type>_<region>.npy', so
+    it is memory mapped and only the requested samples and positions are read
+    from disk:
+       - nuc/aa: allele counts summed over read types (rows x alphabet x L)
+       - ins: a record array of position, sequence, count, with the rows of
+         each sample contiguous (read types merged)
+
+    Rows are in the order samples were added. The time axis of each group is
+    in the index ('index.json'): sample names, PCRs, days since infection, the
+    rows of each sample, and the modification time of the per-sample file it
+    came from (to spot stale samples). The index is written last, so the
+    arrays can be ahead of it but are never inconsistent with it.
+
+    Adding a sample writes only the array of its group, appending the new rows
+    to the end of the file.
+    '''
+    types = ('nuc', 'aa', 'ins')
+
+
+    def __init__(self, pname, qual_min=30):
+        self.pname = pname
+        self.qual_min = qual_min
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+
+    def __repr__(self):
+        return 'TrajectoryStore('+repr(self.pname)+')'
+
+
+    @property
+    def filename(self):
+        '''Filename of the index of the store'''
+        from hivwholeseq.patients.filenames import get_trajectory_store_filename
+        return get_trajectory_store_filename(self.pname, qual_min=self.qual_min)
+
+
+    @property
+    def foldername(self):
+        '''Folder of the store'''
+        return os.path.dirname(self.filename)+'/'
+
+
+    def get_array_filename(self, region, type='nuc'):
+        '''Get the filename of the array of a group'''
+        return self.foldername+type+'_'+region+'.npy'
+
+
+    def groups(self):
+        '''List of (type, region) groups present in the store'''
+        return sorted(tuple(key.split('_', 1)) for key in self.index)
+
+
+    def has_group(self, region, type='nuc'):
+        '''Check whether the store has data for a region'''
+        return (type+'_'+region) in self.index
+
+
+    def get_group_index(self, region, type='nuc'):
+        '''Get the index of a group (samples in the order they were added)'''
+        return self.index[type+'_'+region]
+
+
+    def has_samples(self, region, samplenames, type='nuc', filenames=None):
+        '''Check whether the store has up to date data for all of some samples
+
+        Parameters:
+           samplenames (list): (samplename, PCR) pairs
+           filenames (list): per-sample files the data came from, to check
+           that they did not change since they were added
+
+        NOTE: the store is filled one sample at a time, so a group can lag
+        behind the per-sample files.
+        '''
+        if not self.has_group(region, type=type):
+            return False
+        group = self.get_group_index(region, type=type)
+        mtimes = dict(((sn, PCR), mtime) for (sn, PCR, mtime) in
+                      zip(group['samplenames'], group['PCR'], group['mtimes']))
+
+        if filenames is None:
+            filenames = [None] * len(samplenames)
+        for (sn, PCR), fn in zip(samplenames, filenames):
+            if (sn, PCR) not in mtimes:
+                return False
+            if (fn is not None) and (os.path.getmtime(fn) > mtimes[(sn, PCR)]):
+                return False
+        return True
+
+
+    def get_array(self, region, type='nuc'):
+        '''Get the array of a group, memory mapped'''
+        if not self.has_group(region, type=type):
+            raise KeyError('Group not in trajectory store: '+type+' '+region)
+        return np.load(self.get_array_filename(region, type=type), mmap_mode='r')
+
+
+    def get_time_axis(self, region, type='nuc'):
+        '''Get sample names, PCRs and times of a group, sorted by time'''
+        if not self.has_group(region, type=type):
+            return (np.array([], 'S1'), np.array([], int), np.array([], float))
+        group = self.get_group_index(region, type=type)
+        times = np.array(group['times'], float)
+        ind = np.argsort(np.where(np.isnan(times), np.inf, times), kind='mergesort')
+        return (np.array(group['samplenames'], 'S')[ind],
+                np.array(group['PCR'], int)[ind],
+                times[ind])
+
+
+    def get_sample_entries(self, region, samplenames=None, type='nuc',
+                           use_PCR1=1):
+        '''Get the samples of a group and their position in the index
+
+        Parameters:
+           samplenames (list): samples, in the order to return them (default:
+           all, sorted by time)
+           use_PCR1 (int): 0 = all PCRs, 1 = PCR1 if present else PCR2,
+           2 = PCR1 only (see get_allele_count_trajectories)
+
+        Returns:
+           entries (list): (samplename, PCR, i), i being the position in the
+           group index
+        '''
+        group = self.get_group_index(region, type=type)
+        pos = dict(((sn, PCR), i) for i, (sn, PCR) in
+                   enumerate(zip(group['samplenames'], group['PCR'])))
+
+        if samplenames is None:
+            sns = self.get_time_axis(region, type=type)[0]
+            samplenames = sorted(set(sns), key=list(sns).index)
+
+        entries = []
+        for samplename in samplenames:
+            if use_PCR1 == 0:
+                PCRs_sample = (1, 2)
+            elif use_PCR1 == 1:
+                PCRs_sample = [1 if (samplename, 1) in pos else 2]
+            else:
+                PCRs_sample = (1,)
+            for PCR in PCRs_sample:
+                if (samplename, PCR) in pos:
+                    entries.append((samplename, PCR, pos[(samplename, PCR)]))
+        return entries
+
+
+    def set_sample(self, region, samplename, rows, PCR=1, time=np.nan,
+                   mtime=None, type='nuc'):
+        '''Set the index of a sample in a group (adding it if new)
+
+        Parameters:
+           rows (pair): first and last + 1 rows of the sample in the array
+           mtime (float): modification time of the per-sample file the data
+           came from (default: now)
+        '''
+        import time as timemodule
+
+        if mtime is None:
+            mtime = timemodule.time()
+
+        key = type+'_'+region
+        if key not in self.index:
+            self.index[key] = {'samplenames': [], 'PCR': [], 'times': [],
+                               'rows': [], 'mtimes': []}
+        group = self.index[key]
+
+        entry = [samplename, int(PCR), float(time), list(map(int, rows)),
+                 float(mtime)]
+        names = ('samplenames', 'PCR', 'times', 'rows', 'mtimes')
+        for i, (sn, P) in enumerate(zip(group['samplenames'], group['PCR'])):
+            if (sn == samplename) and (P == PCR):
+                for name, value in zip(names, entry):
+                    group[name][i] = value
+                break
+        else:
+            for name, value in zip(names, entry):
+                group[name].append(value)
+
+
+    def add_counts(self, region, samplename, counts, PCR=1, time=np.nan,
+                   mtime=None, type='nuc'):
+        '''Add or replace the allele counts of a sample
+
+        Parameters:
+           counts (ndarray): allele counts, with or without read types
+           mtime (float): see set_sample
+        '''
+        counts = np.asarray(counts)
+        if counts.ndim == 3:
+            counts = counts.sum(axis=0)
+
+        from hivwholeseq.utils.generic import mkdirs
+        mkdirs(self.foldername)
+        fn = self.get_array_filename(region, type=type)
+
+        entries = []
+        if self.has_group(region, type=type):
+            if self.get_array(region, type=type).shape[1:] != counts.shape:
+                raise ValueError('Allele counts have the wrong shape for '+region+\
+                                 ': '+str(counts.shape))
+            entries = self.get_sample_entries(region, [samplename], type=type,
+                                              use_PCR1=0)
+            entries = [e for e in entries if e[1] == PCR]
+
+        # Replace in place, or append a row
+        if entries:
+            rows = self.get_group_index(region, type=type)['rows'][entries[0][2]]
+            act = np.load(fn, mmap_mode='r+')
+            act[rows[0]] = counts
+            act.flush()
+            del act
+        else:
+            row = append_rows_npy(fn, counts[np.newaxis])
+            rows = (row, row + 1)
+
+        self.set_sample(region, samplename, rows, PCR=PCR, time=time,
+                        mtime=mtime, type=type)
+
+
+    def add_insertions(self, region, samplename, insertions, PCR=1, time=np.nan,
+                       mtime=None):
+        '''Add or replace the insertions of a sample
+
+        Parameters:
+           insertions (Counter or list of Counters): the insertions as keyed
+           by (position, sequence), optionally split by read type
+           mtime (float): see set_sample
+
+        NOTE: the rows of a replaced sample are left in the array, unused.
+        '''
+        if not isinstance(insertions, Counter):
+            insertions = sum(insertions, Counter())
+        items = sorted(insertions.iteritems())
+
+        from hivwholeseq.utils.generic import mkdirs
+        mkdirs(self.foldername)
+        fn = self.get_array_filename(region, type='ins')
+
+        # The sequence field is as wide as the longest insertion so far
+        width = max([1] + [len(seq) for ((_, seq), _) in items])
+        if self.has_group(region, type='ins'):
+            width = max(width, self.get_array(region, type='ins').dtype['sequence'].itemsize)
+        dtype = np.dtype([('position', int), ('sequence', 'S'+str(width)),
+                          ('count', int)])
+
+        arr = np.array([(pos, seq, c) for ((pos, seq), c) in items], dtype)
+        row = append_rows_npy(fn, arr)
+
+        self.set_sample(region, samplename, (row, row + len(arr)), PCR=PCR,
+                        time=time, mtime=mtime, type='ins')
+
+
+    def get_counts(self, region, samplenames=None, type='nuc', use_PCR1=1,
+                   start=None, end=None):
+        '''Get allele count trajectories
+
+        Returns:
+           (samplenames_out, act): list of (samplename, PCR) and counts, as
+           get_allele_count_trajectories
+
+        NOTE: only the requested samples and [start, end) are read from disk.
+        '''
+        entries = self.get_sample_entries(region, samplenames, type=type,
+                                          use_PCR1=use_PCR1)
+        group = self.get_group_index(region, type=type)
+        ind = np.array([group['rows'][i][0] for (_, _, i) in entries], int)
+
+        act = self.get_array(region, type=type)
+        act = np.array(act[ind, :, start: end])
+        samplenames_out = [(sn, PCR) for (sn, PCR, _) in entries]
+        return (samplenames_out, act)
+
+
+    def get_insertions(self, region, samplenames=None, use_PCR1=1):
+        '''Get insertion trajectories
+
+        Returns:
+           (samplenames_out, ics): list of (samplename, PCR) and Counters
+           keyed by (position, insertion)
+        '''
+        entries = self.get_sample_entries(region, samplenames, type='ins',
+                                          use_PCR1=use_PCR1)
+        group = self.get_group_index(region, type='ins')
+        arr = self.get_array(region, type='ins')
+
+        samplenames_out = []
+        ics = []
+        for (sn, PCR, i) in entries:
+            (r1, r2) = group['rows'][i]
+            data = arr[r1: r2]
+            samplenames_out.append((sn, PCR))
+            ics.append(Counter(dict(zip(zip(data['position'].tolist(),
+                                            data['sequence'].tolist()),
+                                        data['count'].tolist()))))
+        return (samplenames_out, ics)
+
+
+    def save(self):
+        '''Save the index of the store to file (atomically)'''
+        from hivwholeseq.utils.generic import mkdirs
+        mkdirs(self.foldername)
+
+        fn = self.filename
+        fn_tmp = fn+'_tmp_'+str(os.getpid())
+        with open(fn_tmp, 'w') as f:
+            json.dump(self.index, f, sort_keys=True)
+        os.rename(fn_tmp, fn)
+
+
+
+# Functions
+def append_rows_npy(filename, arr):
+    '''Append rows to an .npy file (making it if needed)
+
+    Returns:
+       row (int): the first new row
+
+    NOTE: only the new rows and the header are written, the data first. The
+    file is rewritten only if the header length or the dtype change (e.g.
+    longer strings).
+    '''
+    from cStringIO import StringIO
+    from numpy.lib import format as npformat
+
+    if not os.path.isfile(filename):
+        fn_tmp = filename[:-4]+'_tmp_'+str(os.getpid())+filename[-4:]
+        np.save(fn_tmp, arr)
+        os.rename(fn_tmp, filename)
+        return 0
+
+    old = np.load(filename, mmap_mode='r')
+    if old.shape[1:] != arr.shape[1:]:
+        raise ValueError('Rows have the wrong shape: '+str(arr.shape[1:])+\
+                         ' vs '+str(old.shape[1:]))
+    (n_old, dtype, fortran) = (old.shape[0], old.dtype, np.isfortran(old))
+    if (arr.dtype != dtype) and np.can_cast(arr.dtype, dtype):
+        arr = arr.astype(dtype)
+
+    header = StringIO()
+    npformat.write_array_header_1_0(header,
+                                    {'descr': npformat.dtype_to_descr(dtype),
+                                     'fortran_order': False,
+                                     'shape': (n_old + len(arr), ) + old.shape[1:]})
+    header = header.getvalue()
+    offset = old.offset
+    del old
+
+    if (arr.dtype != dtype) or fortran or (len(header) != offset):
+        # Record arrays are made with the wider dtype by the caller
+        if (arr.dtype != dtype) and (dtype.names is None):
+            dtype = np.promote_types(dtype, arr.dtype)
+        elif arr.dtype != dtype:
+            dtype = arr.dtype
+        arr_new = np.concatenate([np.load(filename).astype(dtype),
+                                  arr.astype(dtype)])
+        fn_tmp = filename[:-4]+'_tmp_'+str(os.getpid())+filename[-4:]
+        np.save(fn_tmp, arr_new)
+        os.rename(fn_tmp, filename)
+        return n_old
+
+    with open(filename, 'r+b') as f:
+        f.seek(offset + n_old * dtype.itemsize * int(np.prod(arr.shape[1:])))
+        f.write(np.ascontiguousarray(arr).tostring())
+        f.truncate()
+        f.flush()
+        f.seek(0)
+        f.write(header)
+    return n_old
+
+
+def load_trajectory_store(pname, qual_min=30):
+    '''Load the trajectory store of a patient, None if not found'''
+    store = TrajectoryStore(pname, qual_min=qual_min)
+    if not os.path.isfile(store.filename):
+        return None
+    return store
+
+
+def append_to_trajectory_store(pname, samplename, region, counts=None,
+                               insertions=None, PCR=1, time=np.nan,
+                               type='nuc', qual_min=30, filename=None,
+                               VERBOSE=0):
+    '''Append the data of a new sample to the trajectory store of a patient
+
+    Parameters:
+       counts (ndarray): allele counts, type 'nuc' or 'aa'
+       insertions (Counter or list): insertions, nucleotides only
+       filename (str): the per-sample file the data was saved to, to spot
+       later changes (default: the data is assumed current as of now)
+
+    NOTE: the store is locked while updating, so cluster jobs can append
+    concurrently. Only the group of the region and the index are written.
+    '''
+    import fcntl
+    from hivwholeseq.utils.generic import mkdirs
+
+    mtime = os.path.getmtime(filename) if filename is not None else None
+
+    foldername = TrajectoryStore(pname, qual_min=qual_min).foldername
+    mkdirs(foldername)
+    with open(foldername+'lock', 'a') as flock:
+        fcntl.lockf(flock, fcntl.LOCK_EX)
+        try:
+            store = TrajectoryStore(pname, qual_min=qual_min)
+            if counts is not None:
+                store.add_counts(region, samplename, counts, PCR=PCR, time=time,
+                                 mtime=mtime, type=type)
+            if insertions is not None:
+                store.add_insertions(region, samplename, insertions, PCR=PCR,
+                                     time=time, mtime=mtime)
+            store.save()
+        finally:
+            fcntl.lockf(flock, fcntl.LOCK_UN)
+
+    if VERBOSE >= 2:
+        print 'Trajectory store updated:', pname, samplename, region, type
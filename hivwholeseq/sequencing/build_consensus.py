@@ -31,7 +31,7 @@ from hivwholeseq.sequencing.filenames import get_divided_filename, \
         get_build_consensus_summary_filename, \
         get_reference_consensus_ali_filename
 from hivwholeseq.cluster.fork_cluster import fork_build_consensus as fork_self
-from hivwholeseq.utils.sequence import build_local_consensus
+from hivwholeseq.utils.sequence import build_local_consensus, find_seed
 
 
 
@@ -247,14 +247,10 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
                 pos_start = cons.find(seed)
                 # Allow imperfect matches
                 if pos_start == -1:
-                    consm = np.fromstring(cons, 'S1')
-                    seedm = np.fromstring(seed, 'S1')
-                    n_matches = [(consm[i: i + sl] == seedm).sum()
-                                 for i in xrange(len(cons) + 1 - len(seed))]
-                    pos_start = np.argmax(n_matches)
+                    (pos_start, n_match, _) = find_seed(cons, seed, masked='')
         
                     # Try to only add non-bogus stuff
-                    if n_matches[pos_start] < 0.66 * sl:
+                    if n_match < 0.66 * sl:
                         pos_start = -1
                         if VERBOSE >= 4:
                             print 'Block n.', len(consensi_local)+': cannot stack to previous one!'
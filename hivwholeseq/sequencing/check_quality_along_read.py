@@ -24,20 +24,84 @@ from hivwholeseq.sequencing.samples import load_sequencing_run
 
 
 
+# Globals
+phred_max = 41
+
+
+
 # Functions
+def update_quality_histogram(hist, quals):
+    '''Add a batch of quality strings to a histogram of phred along the read
+
+    Parameters:
+       hist (ndarray): read_len x (phred_max + 1) counts, updated in place
+       quals (list): Sanger-encoded quality strings of the reads
+    '''
+    if not len(quals):
+        return
+
+    (read_len, n_phred) = hist.shape
+    lengths = np.fromiter(map(len, quals), int, len(quals))
+    phred = np.fromstring(''.join(quals), np.uint8).astype(int) - ord('!')
+    np.clip(phred, 0, n_phred - 1, out=phred)
+
+    # Position of each base in its read
+    starts = np.cumsum(lengths) - lengths
+    pos = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+
+    ind = pos < read_len
+    hist += np.bincount(pos[ind] * n_phred + phred[ind],
+                        minlength=hist.size).reshape(hist.shape)
+
+
+def get_quality_fraction_above(hist, qthresh):
+    '''Get the fraction of bases above a quality threshold along the read
+
+    NOTE: ties are ranked as in scipy.stats.percentileofscore (kind='rank').
+    '''
+    n = hist.sum(axis=-1).astype(float)
+    n_below = hist[..., :qthresh].sum(axis=-1)
+    n_equal = hist[..., qthresh] if qthresh < hist.shape[-1] else 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1.0 - (2 * n_below + n_equal + (n_equal > 0)) * 0.5 / n
+
+
+def get_quality_quantiles(hist, quantiles):
+    '''Get quantiles of the quality along the read from its histogram
+
+    Parameters:
+       hist (ndarray): (...) x (phred_max + 1) counts
+       quantiles (array): quantiles between 0 and 1
+
+    Returns:
+       qq (ndarray): (...) x len(quantiles) phred scores, NaN where no reads
+    '''
+    quantiles = np.asarray(quantiles, float)
+    n = hist.sum(axis=-1)
+    cdf = np.cumsum(hist, axis=-1)
+    cdf = cdf[..., np.newaxis, :]
+    qq = ((cdf < quantiles[:, np.newaxis] * n[..., np.newaxis, np.newaxis]) |
+          (cdf == 0)).sum(axis=-1)
+    qq = np.minimum(qq, hist.shape[-1] - 1).astype(float)
+    qq[n == 0] = np.nan
+    return qq
+
+
 def quality_score_along_reads(read_len, reads_filenames,
                               skipreads=0,
                               randomreads=False,
-                              maxreads=-1, VERBOSE=0):
-    '''Calculate the quality score along the reads'''
+                              maxreads=-1, VERBOSE=0,
+                              batchsize=10000, seed=None):
+    '''Calculate the quality score along the reads
 
-    quality = [[[] for j in xrange(read_len)] for i in xrange(2)]
+    Returns:
+       hist (ndarray): 2 x read_len x (phred_max + 1) counts of phred scores
+       for read1 and read2 along the read
+    '''
+    from itertools import islice
+    from hivwholeseq.utils.mapping import reservoir_sample
 
-    # Precompute conversion table
-    SANGER_SCORE_OFFSET = ord("!")
-    q_mapping = dict()
-    for letter in range(0, 255):
-        q_mapping[chr(letter)] = letter - SANGER_SCORE_OFFSET
+    hist = np.zeros((2, read_len, phred_max + 1), int)
 
     if reads_filenames[0][-3:] == '.gz':
         openf = gzip.open
@@ -49,64 +113,37 @@ def quality_score_along_reads(read_len, reads_filenames,
     # Iterate over all reads (using fast iterators)
     with openf(reads_filenames[0], file_readmode) as fh1, \
          openf(reads_filenames[1], file_readmode) as fh2:
-    
-        if randomreads:
-            if VERBOSE:
-                print 'Getting number of reads',
-                sys.stdout.flush()
-            n_reads = sum(1 for read in FGI(fh1))
-            fh1.rewind()
-            if VERBOSE:
-                print n_reads
 
-            inds = np.arange(skipreads, n_reads)
-            np.random.shuffle(inds)
-            inds = inds[:maxreads]
-            inds.sort()
-            indi = 0
-            if VERBOSE:
-                print 'Random indices from ', inds[0], 'to', inds[-1]
+        quals_iter = ((read1[2], read2[2])
+                      for (read1, read2) in islice(izip(FGI(fh1), FGI(fh2)),
+                                                   skipreads, None))
 
-            for (i, reads) in enumerate(izip(FGI(fh1), FGI(fh2))):
-                if VERBOSE and (not ((i + 1) % 10000)):
-                    print i + 1
-
-                if (i != inds[indi]):
-                    continue
-
-                for ip, read in enumerate(reads):
-                    for j, qletter in enumerate(read[2]):
-                        quality[ip][j].append(q_mapping[qletter])
-
-                indi += 1
-                if indi == maxreads:
-                    if VERBOSE:
-                        print 'Maximal number of read pairs reached:', maxreads
-                    break
-
-        else:
+        # Random read pairs are picked in a single pass
+        if randomreads:
+            quals_iter = iter(reservoir_sample(quals_iter, maxreads, seed=seed))
+            if VERBOSE:
+                print 'Random read pairs picked'
 
-            for (i, reads) in enumerate(izip(FGI(fh1), FGI(fh2))):
-                if i < skipreads:
-                    continue
+        elif maxreads != -1:
+            quals_iter = islice(quals_iter, maxreads)
 
-                if i == skipreads + maxreads:
-                    if VERBOSE:
-                        print 'Maximal number of read pairs reached:', maxreads
-                    break
+        n_reads = 0
+        while True:
+            batch = list(islice(quals_iter, batchsize))
+            if not len(batch):
+                break
 
-                if VERBOSE and (not ((i + 1) % 10000)):
-                    print i + 1
+            for ip in xrange(2):
+                update_quality_histogram(hist[ip], [quals[ip] for quals in batch])
 
-                for ip, read in enumerate(reads):
-                    for j, qletter in enumerate(read[2]):
-                        quality[ip][j].append(q_mapping[qletter])
+            n_reads += len(batch)
+            if VERBOSE:
+                print n_reads
 
-    for qual in quality:
-        for qpos in qual:
-            qpos.sort()
+    if VERBOSE and (n_reads == maxreads):
+        print 'Maximal number of read pairs reached:', maxreads
 
-    return quality
+    return hist
 
 
 def plot_quality_along_reads(data_folder, adaID, title, quality, VERBOSE=0, savefig=False):
@@ -115,10 +152,10 @@ def plot_quality_along_reads(data_folder, adaID, title, quality, VERBOSE=0, save
     import matplotlib.pyplot as plt
     from matplotlib import cm
     fig, axs = plt.subplots(1, 2, figsize=(16, 9))
+    y = np.linspace(0, 1, 101)[::-1]
     for i, (ax, qual) in enumerate(izip(axs, quality)):
-        for j, qpos in enumerate(qual):
-            x = qpos
-            y = np.linspace(0, 1, len(x))[::-1]
+        qq = get_quality_quantiles(qual, 1 - y)
+        for j, x in enumerate(qq):
             ax.plot(x, y, color=cm.jet(int(255.0 * j / len(qual))),
                     alpha=0.5,
                     lw=2)
@@ -147,7 +184,6 @@ def plot_quality_along_reads(data_folder, adaID, title, quality, VERBOSE=0, save
 def plot_cuts_quality_along_reads(data_folder, adaID, quality, title='',
                                   VERBOSE=0, savefig=False):
     '''Plot some cuts of the quality along the read'''
-    from scipy.stats import percentileofscore as pof
     import matplotlib.pyplot as plt
     from matplotlib import cm
     fig, axs = plt.subplots(1, 2, figsize=(14, 8))
@@ -155,7 +191,7 @@ def plot_cuts_quality_along_reads(data_folder, adaID, quality, title='',
     for i, (ax, qual) in enumerate(izip(axs, quality)):
         for j, qthresh in enumerate(qthreshs):
             x = np.arange(len(qual))
-            y = np.array([100 - pof(qual[k], qthresh) for k in xrange(len(qual))])
+            y = 100 * get_quality_fraction_above(qual, qthresh)
             ax.plot(x, y, color=cm.jet(int(255.0 * j / len(qthreshs))),
                     alpha=0.8,
                     lw=2,
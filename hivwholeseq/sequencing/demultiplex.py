@@ -13,10 +13,7 @@ import sys
 import gzip
 import argparse
 from collections import Counter
-from operator import itemgetter
-from Bio import SeqIO
 from itertools import izip
-from Bio.SeqIO.QualityIO import FastqGeneralIterator as FGI
 
 from hivwholeseq.datasets import MiSeq_runs
 from hivwholeseq.sequencing.filenames import get_demultiplex_summary_filename, get_raw_read_files, \
@@ -26,7 +23,224 @@ from hivwholeseq.cluster.fork_cluster import fork_demultiplex as fork_self
 
 
 
+# Classes
+class BufferedGzipWriter(object):
+    '''Write text to a gzip file in large blocks, compressed by a pool of workers
+
+    Each block is a standalone gzip member, so the output is a valid
+    multi-member gzip file (readable by gzip.open, zcat, etc.).
+    '''
+    def __init__(self, filename, pool=None, compresslevel=9,
+                 buffersize=1 << 22, maxpending=8):
+        from collections import deque
+        self.handle = open(filename, 'wb')
+        self.pool = pool
+        self.compresslevel = compresslevel
+        self.buffersize = buffersize
+        self.maxpending = maxpending
+        self.buffer = []
+        self.size = 0
+        self.pending = deque()
+
+
+    def write(self, text):
+        '''Write some text'''
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.buffersize:
+            self.flush()
+
+
+    def flush(self):
+        '''Send the buffer to compression'''
+        if self.size:
+            block = ''.join(self.buffer)
+            self.buffer = []
+            self.size = 0
+            if self.pool is None:
+                self.handle.write(compress_block(block, self.compresslevel))
+            else:
+                self.pending.append(self.pool.apply_async(compress_block,
+                                                          (block, self.compresslevel)))
+        self.write_compressed()
+
+
+    def write_compressed(self, wait=False):
+        '''Write compressed blocks to file, in order'''
+        pending = self.pending
+        while pending and (wait or (len(pending) > self.maxpending) or pending[0].ready()):
+            self.handle.write(pending.popleft().get())
+
+
+    def close(self):
+        '''Flush all data and close the file'''
+        self.flush()
+        self.write_compressed(wait=True)
+        self.handle.close()
+
+
+
 # Functions
+def compress_block(text, compresslevel=9):
+    '''Compress a block of text into a standalone gzip member'''
+    import zlib
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+
+def open_fastq(filename):
+    '''Open a FASTQ file for reading, gzipped or not
+
+    NOTE: gzipped files are decompressed by a separate gzip process if possible,
+    which is much faster than the gzip module.
+    '''
+    if not filename.endswith('.gz'):
+        return open(filename, 'r')
+
+    from hivwholeseq.utils.generic import which
+    if len(which('gzip')):
+        import subprocess as sp
+        return sp.Popen(['gzip', '-dc', filename], stdout=sp.PIPE,
+                        bufsize=1 << 20).stdout
+    return gzip.open(filename, 'rb')
+
+
+def iter_fastq_raw(handle):
+    '''Iterate over FASTQ records as raw text
+
+    Returns:
+       iterator over (record, sequence), the record being the four lines of
+       text ready to be written out
+    '''
+    readline = handle.readline
+    while True:
+        title = readline()
+        if not title:
+            return
+        seq = readline()
+        readline()
+        qual = readline()
+        if (title[0] != '@') or (not qual):
+            raise ValueError('Truncated or malformed FASTQ record: '+title.rstrip('\n'))
+        yield (title+seq+'+\n'+qual, seq.rstrip('\n'))
+
+
+def make_barcode_index(adapters_designed, mismatches=1, VERBOSE=0):
+    '''Make a hash of the designed barcodes and their neighbours
+
+    Parameters:
+       adapters_designed (list): (adaID, barcode) pairs; dual index barcodes
+       are joined by a dash
+       mismatches (int): 0 for exact matches only, 1 to also accept barcodes
+       at Hamming distance one
+
+    Returns:
+       (index, collisions): dict from barcode to adaID, and set of barcodes
+       that are neighbours of more than one designed barcode (these are left
+       unclassified)
+    '''
+    if mismatches not in (0, 1):
+        raise ValueError('Only 0 or 1 mismatches are supported')
+
+    owners = {}
+    if mismatches:
+        for (adaID, s) in adapters_designed:
+            for pos, c in enumerate(s):
+                if c == '-':
+                    continue
+                for cn in 'ACGTN':
+                    if cn != c:
+                        owners.setdefault(s[:pos]+cn+s[pos+1:], set()).add(adaID)
+
+    index = {}
+    collisions = set()
+    for neighbour, adaIDs in owners.iteritems():
+        if len(adaIDs) == 1:
+            index[neighbour] = adaIDs.pop()
+        else:
+            collisions.add(neighbour)
+
+    # Designed barcodes always win over neighbours
+    for (adaID, s) in adapters_designed:
+        index[s] = adaID
+        collisions.discard(s)
+
+    if VERBOSE and collisions:
+        print 'Ambiguous barcodes (left unclassified):', len(collisions)
+
+    return (index, collisions)
+
+
+def demultiplex_fastq(input_filenames, output_filenames, barcode_index,
+                      maxreads=-1, threads=1, compresslevel=9, VERBOSE=0):
+    '''Demultiplex FASTQ files by barcode
+
+    Parameters:
+       input_filenames (list): read1, read2, and one file per index read
+       output_filenames (dict): adaID -> [read1, read2], plus 'unclassified' ->
+       [read1, read2, one per index read]. All outputs are gzipped.
+       barcode_index (dict): barcode -> adaID (see make_barcode_index)
+       threads (int): number of compression workers
+       compresslevel (int): gzip compression level
+
+    Returns:
+       (n_reads, adapters_found): number of read pairs and Counter of the
+       barcodes found
+    '''
+    from multiprocessing import Pool
+
+    pool = Pool(threads) if threads > 1 else None
+    fouts = {adaID: [BufferedGzipWriter(fn, pool=pool, compresslevel=compresslevel)
+                     for fn in fns]
+             for adaID, fns in output_filenames.iteritems()}
+    fins = [open_fastq(fn) for fn in input_filenames]
+
+    adapters_found = Counter()
+    n_reads = 0
+    try:
+        if VERBOSE >= 3:
+            print 'adaID'
+            print '--------------------'
+
+        fouts_unclassified = fouts['unclassified']
+        for records in izip(*map(iter_fastq_raw, fins)):
+            if n_reads == maxreads:
+                if VERBOSE:
+                    print 'Maxreads reached.'
+                break
+            n_reads += 1
+
+            if VERBOSE and (not (n_reads % 10000)):
+                print n_reads
+
+            adapter_string = '-'.join(seq for (_, seq) in records[2:])
+            adapters_found[adapter_string] += 1
+
+            # Unknown barcodes go into a wastebin folder
+            adaID = barcode_index.get(adapter_string, 'unclassified')
+            if VERBOSE >= 3:
+                print adaID
+
+            fout = fouts[adaID]
+            fout[0].write(records[0][0])
+            fout[1].write(records[1][0])
+            if adaID == 'unclassified':
+                for fou, (record, _) in izip(fouts_unclassified[2:], records[2:]):
+                    fou.write(record)
+
+    finally:
+        for fin in fins:
+            fin.close()
+        for fout in fouts.itervalues():
+            for fou in fout:
+                fou.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return (n_reads, adapters_found)
+
+
 def make_output_folders(data_folder, adapters_designed, VERBOSE=0, summary=True):
     '''Make output folders for all adapters and unclassified (e.g. PhiX)'''
     from hivwholeseq.utils.generic import mkdirs
@@ -73,173 +287,77 @@ def get_adapters_designed(dataset, VERBOSE=0, summary=True):
 
 
 def demultiplex_reads_single_index(data_folder, data_filenames, adapters_designed,
-                                   maxreads=-1, VERBOSE=0, summary=True):
+                                   maxreads=-1, VERBOSE=0, summary=True,
+                                   mismatches=1, threads=1, compresslevel=9):
     '''Demultiplex reads with single index adapters'''
+    input_filenames = [data_filenames['read1'],
+                       data_filenames['read2'],
+                       data_filenames['adapter']]
+
+    output_filenames = {adaID: get_read_filenames(data_folder, adaID, gzip=True)
+                        for adaID, _ in adapters_designed}
+    output_filenames['unclassified'] = get_unclassified_reads_filenames(data_folder,
+                                                                        gzip=True)
+
+    (index, collisions) = make_barcode_index(adapters_designed,
+                                             mismatches=mismatches,
+                                             VERBOSE=VERBOSE)
+
+    (n_reads, adapters_found) = demultiplex_fastq(input_filenames, output_filenames,
+                                                  index,
+                                                  maxreads=maxreads,
+                                                  threads=threads,
+                                                  compresslevel=compresslevel,
+                                                  VERBOSE=VERBOSE)
 
-    # Get the read filenames
-    datafile_read1 = data_filenames['read1']
-    datafile_read2 = data_filenames['read2']
-    datafile_adapter = data_filenames['adapter']
-
-    # Open output files (compressed)
-    fouts = {adaID: [gzip.open(fn, 'wb', compresslevel=9)
-             for fn in get_read_filenames(data_folder, adaID, gzip=True)]
-             for adaID, _ in adapters_designed}
-
-    fouts['unclassified'] = [gzip.open(fn, 'wb', compresslevel=9)
-                             for fn in get_unclassified_reads_filenames(data_folder, gzip=True)]
-
-    adapters_designed_inv = dict(map(reversed, adapters_designed))
-    adapters_strings = map(itemgetter(1), adapters_designed)
-
-    # Make sure you close the files
-    try:
-
-        # Iterate over all reads (using fast iterators)
-        with gzip.open(datafile_read1, 'rb') as fh1,\
-             gzip.open(datafile_read2, 'rb') as fh2,\
-             gzip.open(datafile_adapter, 'rb') as fha:
-
-            if VERBOSE >= 3:
-                print 'adaID'
-                print '--------------------'
-
-            adapters_found = Counter()
-            for i, (read1, read2, adapter) in enumerate(izip(FGI(fh1), FGI(fh2),
-                                                             SeqIO.parse(fha, 'fastq'))):
-
-                if i == maxreads:
-                    if VERBOSE:
-                        print 'Maxreads reached.'
-                    break
-
-                # Print some output
-                if VERBOSE and (not ((i + 1) % 10000)):
-                    print i + 1
-
-                # If the adapter is not known, add it to the list
-                adapter_string = str(adapter.seq)
-                adapters_found[adapter_string] += 1
-
-                # If the adapter does not match any know one,
-                # throw into wastebin folder
-                if adapter_string not in adapters_strings:
-                    adaID = 'unclassified'
-                else:
-                    adaID = adapters_designed_inv[adapter_string]
-            
-                if VERBOSE >= 3:
-                    print adaID
-
-                # Write sequences (append to file, manual but fast)
-                fouts[adaID][0].write("@%s\n%s\n+\n%s\n" % read1)
-                fouts[adaID][1].write("@%s\n%s\n+\n%s\n" % read2)
-                if adapter_string not in adapters_strings:
-                    SeqIO.write(adapter, fouts['unclassified'][2], 'fastq')
-
-    finally:
-        # Close all adaIDs
-        for fout in fouts.itervalues():
-            # Close both read 1 and read 2 (and barcode for unclassified)
-            for fou in fout:
-                fou.close()
-
-        if summary:
-            with open(get_demultiplex_summary_filename(data_folder), 'a') as f:
-                f.write('\n')
-                f.write('Total number of reads demultiplexed: '+str(i+1)+'\n')
-                f.write('Adapters found across all reads:\n')
-                for e in adapters_found.most_common():
-                    f.write('\t'.join(map(str, e))+'\n')
+    if summary:
+        write_demultiplex_summary(data_folder, n_reads, adapters_found,
+                                  mismatches, collisions)
 
 
 def demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
-                                   maxreads=-1, VERBOSE=0, summary=True):
+                                   maxreads=-1, VERBOSE=0, summary=True,
+                                   mismatches=1, threads=1, compresslevel=9):
     '''Demultiplex reads with dual index adapters'''
-    #FIXME: use gzipped files
-
-    # Get the read filenames
-    datafile_read1 = data_filenames['read1']
-    datafile_read2 = data_filenames['read2']
-    datafile_adapter1 = data_filenames['adapter1']
-    datafile_adapter2 = data_filenames['adapter2']
-
-    # Open output files
-    fouts = {adaID: (open(data_folder+foldername_adapter(adaID)+'read1.fastq', 'w'),
-                     open(data_folder+foldername_adapter(adaID)+'read2.fastq', 'w'))
-             for adaID, _ in adapters_designed}
-    fouts['unclassified'] = (open(data_folder+'unclassified_reads/read1.fastq', 'w'),
-                             open(data_folder+'unclassified_reads/read2.fastq', 'w'),
-                             open(data_folder+'unclassified_reads/adapter1.fastq', 'w'),
-                             open(data_folder+'unclassified_reads/adapter2.fastq', 'w'),
-                            )
-
-    adapters_designed_inv = dict(map(reversed, adapters_designed))
-    adapters_strings = map(itemgetter(1), adapters_designed)
-
-    # Make sure you close the files
-    try:
+    input_filenames = [data_filenames['read1'],
+                       data_filenames['read2'],
+                       data_filenames['adapter1'],
+                       data_filenames['adapter2']]
+
+    output_filenames = {adaID: get_read_filenames(data_folder, adaID, gzip=True)
+                        for adaID, _ in adapters_designed}
+    output_filenames['unclassified'] = get_unclassified_reads_filenames(data_folder,
+                                                                        gzip=True,
+                                                                        dual_index=True)
+
+    (index, collisions) = make_barcode_index(adapters_designed,
+                                             mismatches=mismatches,
+                                             VERBOSE=VERBOSE)
+
+    (n_reads, adapters_found) = demultiplex_fastq(input_filenames, output_filenames,
+                                                  index,
+                                                  maxreads=maxreads,
+                                                  threads=threads,
+                                                  compresslevel=compresslevel,
+                                                  VERBOSE=VERBOSE)
 
-        # Iterate over all reads (using fast iterators)
-        with open(datafile_read1, 'r') as fh1,\
-             open(datafile_read2, 'r') as fh2,\
-             open(datafile_adapter1, 'r') as fha1,\
-             open(datafile_adapter2, 'r') as fha2:
-
-            if VERBOSE >= 3:
-                print 'adaID'
-                print '--------------------'
-
-            adapters_found = Counter()
-            for i, (read1, read2,
-                    adapter1,
-                    adapter2) in enumerate(izip(FGI(fh1), FGI(fh2),
-                                                SeqIO.parse(fha1, 'fastq'),
-                                                SeqIO.parse(fha2, 'fastq'))):
-
-                # Stop at the maximal number of reads (for testing)
-                if i == maxreads:
-                    if VERBOSE:
-                        print 'Maximal number of read pairs reached:', maxreads
-                    break
-
-                if VERBOSE and (not ((i + 1) % 10000)):
-                    print i + 1
-
-                # If the adapter is not known, add it to the list
-                adapter_string = '-'.join(map(str, [adapter1.seq, adapter2.seq]))
-                adapters_found[adapter_string] += 1
-
-                # If the adapter does not match any know one,
-                # throw into wastebin folder
-                if adapter_string not in adapters_strings:
-                    adaID = 'unclassified'
-                else:
-                    adaID = adapters_designed_inv[adapter_string]
-            
-                if VERBOSE >= 3:
-                    print adaID
-
-                # Write sequences (append to file, manual but fast)
-                fouts[adaID][0].write("@%s\n%s\n+\n%s\n" % read1)
-                fouts[adaID][1].write("@%s\n%s\n+\n%s\n" % read2)
-                if adapter_string not in adapters_strings:
-                    SeqIO.write(adapter1, fouts['unclassified'][2], 'fastq')
-                    SeqIO.write(adapter2, fouts['unclassified'][3], 'fastq')
+    if summary:
+        write_demultiplex_summary(data_folder, n_reads, adapters_found,
+                                  mismatches, collisions)
 
-    finally:
-        # Close all adaIDs
-        for fout in fouts.itervalues():
-            # Close both read 1 and read 2 (and barcode for unclassified)
-            for fou in fout:
-                fou.close()
 
-    if summary:
-        with open(get_demultiplex_summary_filename(data_folder), 'a') as f:
-            f.write('\n')
-            f.write('Adapters found across all reads:\n')
-            for e in adapters_found.most_common():
-                f.write('\t'.join(map(str, e))+'\n')
+def write_demultiplex_summary(data_folder, n_reads, adapters_found,
+                              mismatches, collisions):
+    '''Write the demultiplexing results to the summary file'''
+    with open(get_demultiplex_summary_filename(data_folder), 'a') as f:
+        f.write('\n')
+        f.write('Total number of reads demultiplexed: '+str(n_reads)+'\n')
+        f.write('Barcode mismatches accepted: '+str(mismatches)+'\n')
+        if collisions:
+            f.write('Ambiguous barcodes (left unclassified): '+str(len(collisions))+'\n')
+        f.write('Adapters found across all reads:\n')
+        for e in adapters_found.most_common():
+            f.write('\t'.join(map(str, e))+'\n')
 
 
 
@@ -259,6 +377,12 @@ if __name__ == '__main__':
     parser.add_argument('--no-summary', action='store_false',
                         dest='summary',
                         help='Do not save results in a summary file')
+    parser.add_argument('--mismatches', type=int, default=1,
+                        help='Barcode mismatches accepted (0 or 1)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of compression workers')
+    parser.add_argument('--compresslevel', type=int, default=9,
+                        help='Compression level of the output files [1-9]')
 
     args = parser.parse_args()
     seq_run = args.run
@@ -266,10 +390,15 @@ if __name__ == '__main__':
     maxreads = args.maxreads
     submit = args.submit
     summary = args.summary
+    mismatches = args.mismatches
+    threads = args.threads
+    compresslevel = args.compresslevel
 
     # If submit, outsource to the cluster
     if submit:
-        fork_self(seq_run, VERBOSE=VERBOSE, maxreads=maxreads, summary=summary)
+        fork_self(seq_run, VERBOSE=VERBOSE, maxreads=maxreads, summary=summary,
+                  mismatches=mismatches, threads=threads,
+                  compresslevel=compresslevel)
         sys.exit()
 
     # Specify the dataset
@@ -291,8 +420,10 @@ if __name__ == '__main__':
     if '-' not in adapters_designed[0][0]:
         demultiplex_reads_single_index(data_folder, data_filenames, adapters_designed,
                                        maxreads=maxreads, VERBOSE=VERBOSE,
-                                       summary=summary)
+                                       summary=summary, mismatches=mismatches,
+                                       threads=threads, compresslevel=compresslevel)
     else:
         demultiplex_reads_dual_index(data_folder, data_filenames, adapters_designed,
                                      maxreads=maxreads, VERBOSE=VERBOSE,
-                                     summary=summary)
+                                     summary=summary, mismatches=mismatches,
+                                     threads=threads, compresslevel=compresslevel)
@@ -387,9 +387,13 @@ def get_insert_counts_phix_filename(data_folder, qual_min=None):
     return fn
 
 
-def get_unclassified_reads_filenames(data_folder, filtered=False, gzip=False):
+def get_unclassified_reads_filenames(data_folder, filtered=False, gzip=False,
+                                     dual_index=False):
     '''Get the filenames of the unclassified reads'''
-    filenames = ['read1', 'read2', 'adapter']
+    if dual_index:
+        filenames = ['read1', 'read2', 'adapter1', 'adapter2']
+    else:
+        filenames = ['read1', 'read2', 'adapter']
     if filtered:
         filenames = [f+'_filtered_trimmed' if 'read' in f else f for f in filenames]
     filenames = [data_folder+'unclassified_reads/'+f+'.fastq' for f in filenames]
@@ -32,7 +32,8 @@ from hivwholeseq.sequencing.filenames import get_custom_reference_filename, \
         get_reference_premap_index_filename, get_reference_premap_hash_filename,\
         get_coverage_figure_filename, get_insert_size_distribution_cumulative_filename,\
         get_insert_size_distribution_filename
-from hivwholeseq.utils.mapping import stampy_bin, convert_sam_to_bam, convert_bam_to_sam
+from hivwholeseq.utils.mapping import stampy_bin, convert_sam_to_bam, convert_bam_to_sam, \
+        map_parts_local
 from hivwholeseq.cluster.fork_cluster import fork_premap as fork_self
 from hivwholeseq.utils.clean_temp_files import remove_premapped_tempfiles
 
@@ -246,36 +247,15 @@ def premap_stampy(data_folder, adaID, VERBOSE=0, threads=1, summary=True, maxrea
 
     else:
 
-        # Multithreading works as follows: call qsub + stampy, monitor the process
-        # IDs with qstat at regular intervals, and finally merge results with pysam
+        # Multithreading works as follows: run stampy parts as local processes,
+        # stream their output into BAM, and merge the parts sorted by read name
         output_file_parts = [get_premapped_filename(data_folder, adaID, type='bam',
                                                 part=(j+1)) for j in xrange(threads)]
-
-        # Submit map script
-        jobs_done = np.zeros(threads, bool)
-        job_IDs = np.zeros(threads, 'S30')
-        
-        # Submit map call
-        import hivwholeseq
-        JOBDIR = hivwholeseq.__path__[0].rstrip('/')+'/'
-        JOBLOGOUT = JOBDIR+'logout'
-        JOBLOGERR = JOBDIR+'logerr'
-        cluster_time = ['23:59:59', '1:59:59']
-        vmem = '8G'
+        call_lists = []
         for j in xrange(threads):
-            call_list = ['qsub','-cwd',
-                         '-b', 'y',
-                         '-S', '/bin/bash',
-                         '-o', JOBLOGOUT,
-                         '-e', JOBLOGERR,
-                         '-N', adaID+' p'+str(j+1),
-                         '-l', 'h_rt='+cluster_time[threads >= 30],
-                         '-l', 'h_vmem='+vmem,
-                         stampy_bin,
-                         '--overwrite',
+            call_list = [stampy_bin,
                          '-g', get_reference_premap_index_filename(data_folder, adaID, ext=False),
                          '-h', get_reference_premap_hash_filename(data_folder, adaID, ext=False), 
-                         '-o', get_premapped_filename(data_folder, adaID, type='sam', part=(j+1)),
                          '--processpart='+str(j+1)+'/'+str(threads),
                          '--insertsize=450',
                          '--insertsd=100',
@@ -283,81 +263,20 @@ def premap_stampy(data_folder, adaID, VERBOSE=0, threads=1, summary=True, maxrea
                          '--gapopen='+str(gapopen),
                          '--gapextend='+str(gapextend),
                          '-M'] + input_filenames
-            call_list = map(str, call_list)
-            if VERBOSE >= 2:
-                print ' '.join(call_list)
-            job_ID = sp.check_output(call_list)
-            job_ID = job_ID.split()[2]
-            job_IDs[j] = job_ID
-
-        # Monitor output
-        time_wait = 10 # secs
-        while not jobs_done.all():
-
-            # Sleep some time
-            time.sleep(time_wait)
-
-            # Get the output of qstat to check the status of jobs
-            qstat_output = sp.check_output(['qstat'])
-            qstat_output = qstat_output.split('\n')[:-1] # The last is an empty line
-            if VERBOSE >=3:
-                print qstat_output
-            if len(qstat_output) < 3:
-                jobs_done[:] = True
-                break
-            else:
-                qstat_output = [line.split()[0] for line in qstat_output[2:]]
-
-            time_wait = 10 # secs
-            for j in xrange(threads):
-                if jobs_done[j]:
-                    continue
-
-                if job_IDs[j] not in qstat_output:
-                    # Convert to BAM for merging
-                    if VERBOSE >= 1:
-                        print 'Convert premapped reads to BAM for merging: adaID '+\
-                               adaID+', part '+str(j+1)+ ' of '+ \
-                               str(threads)
-                    convert_sam_to_bam(output_file_parts[j])
-                    # We do not need to wait if we did the conversion (it takes
-                    # longer than some secs)
-                    time_wait = 0
-                    jobs_done[j] = True
-
-        if summary:
-            with open(summary_filename, 'a') as f:
-                f.write('Stampy premapped ('+str(threads)+' threads).\n')
+            call_lists.append(map(str, call_list))
 
-        # Concatenate output files
-        if VERBOSE >= 1:
-            print 'Concatenate premapped reads: adaID '+adaID+'...',
-        output_filename = get_premapped_filename(data_folder, adaID, type='bam', unsorted=True)
-        pysam.cat('-o', output_filename, *output_file_parts)
-        if VERBOSE >= 1:
-            print 'done.'
-        if summary:
-            with open(summary_filename, 'a') as f:
-                f.write('BAM files concatenated (unsorted).\n')
-
-        # Sort the file by read names (to ensure the pair_generator)
-        # NOTE: we exclude the extension and the option -f because of a bug in samtools
-        if VERBOSE >= 1:
-            print 'Sort premapped reads: adaID '+adaID
         output_filename_sorted = get_premapped_filename(data_folder, adaID, type='bam', unsorted=False)
-        pysam.sort('-n', output_filename, output_filename_sorted[:-4])
-        if summary:
-            with open(summary_filename, 'a') as f:
-                f.write('Joint BAM file sorted.\n')
+        stats = map_parts_local(call_lists, output_file_parts, output_filename_sorted,
+                                threads=threads, VERBOSE=VERBOSE)
 
-        # Reheader the file without BAM -> SAM -> BAM
-        if VERBOSE >= 1:
-            print 'Reheader premapped reads: adaID '+adaID
-        header_filename = get_premapped_filename(data_folder, adaID, type='sam', part=1)
-        pysam.reheader(header_filename, output_filename_sorted)
         if summary:
             with open(summary_filename, 'a') as f:
-                f.write('Joint BAM file reheaded.\n')
+                f.write('Stampy premapped ('+str(threads)+' threads).\n')
+                for stats_part in stats:
+                    f.write('Part '+str(stats_part['part'])+': '+\
+                            str(stats_part['n_reads'])+' reads, '+\
+                            str(int(stats_part['end'] - stats_part['start']))+' secs\n')
+                f.write('BAM files merged (sorted by read name).\n')
 
     if VERBOSE >= 1:
         print 'Remove temporary files: adaID '+adaID
@@ -15,7 +15,7 @@ content:    Trim premapped reads according to:
 import os
 import argparse
 from operator import itemgetter
-from itertools import izip
+from itertools import izip, islice
 import numpy as np
 from Bio import SeqIO
 import pysam
@@ -461,11 +461,251 @@ def trim_primers(reads, frag_pos, include_tests=False):
     return False
 
 
+def divide_read_pairs(read_pairs, template, output_filenames, n_fragments,
+                      frags_pos, primers_out_pos, primers_out_seq, len_reference,
+                      minisize=100, include_tests=False, VERBOSE=0):
+    '''Trim read pairs and write them into the fragment output files
+
+    Parameters:
+       read_pairs (iterator): read pairs from the premapped BAM file
+       template (Samfile): BAM file to copy the header from
+       output_filenames (list): one BAM file per fragment, then ambiguous,
+       crossmapped, unmapped, and low-quality
+
+    Returns:
+       counts (dict): number of read pairs in each category
+    '''
+    try:
+        file_handles = [pysam.Samfile(ofn, 'wb', template=template)
+                        for ofn in output_filenames[:n_fragments]]
+
+        fo_am = pysam.Samfile(output_filenames[-4], 'wb', template=template)
+        fo_cm = pysam.Samfile(output_filenames[-3], 'wb', template=template)
+        fo_um = pysam.Samfile(output_filenames[-2], 'wb', template=template)
+        fo_lq = pysam.Samfile(output_filenames[-1], 'wb', template=template)
+
+        # Iterate over the mapped reads and assign fragments
+        n_pairs = 0
+        n_mapped = [0 for n_frag in xrange(n_fragments)]
+        n_unmapped = 0
+        n_crossfrag = 0
+        n_ambiguous = 0
+        n_outer = 0
+        n_lowq = 0
+        for irp, reads in enumerate(read_pairs):
+
+            if VERBOSE >= 2:
+                if not ((irp+1) % 10000):
+                    print irp+1
+            n_pairs += 1
+
+            i_fwd = reads[0].is_reverse
+
+            # If unmapped or unpaired, mini, or insert size mini, or
+            # divergent read pair (fully cross-overlapping), discard
+            if reads[0].is_unmapped or (not reads[0].is_proper_pair) or \
+               reads[1].is_unmapped or (not reads[1].is_proper_pair) or \
+               (reads[0].rlen < 50) or (reads[1].rlen < 50) or \
+               (reads[i_fwd].isize < minisize):
+                if VERBOSE >= 3:
+                    print 'Read pair unmapped/unpaired/tiny/divergent:', reads[0].qname
+                n_unmapped += 1
+                fo_um.write(reads[0])
+                fo_um.write(reads[1])
+                continue
+
+            # If the insert is a misamplification from the outer primers
+            # in fragments that underwent nested PCR,
+            # trash it (it will have skewed amplification anyway). We cannot
+            # find all of those, rather only the ones still carrying the
+            # primer itself (some others have lost it while shearing). For
+            # those, no matter what happens at the end (reading into adapters,
+            # etc.), ONE of the reads in the pair will start exactly with one
+            # outer primer: if the rev read with a rev primer, if the fwd
+            # with a fwd one. Test all six.
+            if (len(primers_out_pos['fwd']) or len(primers_out_pos['rev'])) and \
+               test_outer_primer(reads,
+                                 primers_out_pos, primers_out_seq,
+                                 len_reference):
+                if VERBOSE >= 3:
+                    print 'Read pair from outer primer:', reads[0].qname
+                n_outer += 1
+                fo_um.write(reads[0])
+                fo_um.write(reads[1])
+                continue
+
+            # FIXME: the following becomes a bit harder when we mix parallel
+            # PCRs, e.g. F5a+b, to get more product
+
+            # Assign to a fragment now, so that primer trimming is faster 
+            pair_identity = assign_to_fragment(reads, frags_pos['full'],
+                                               VERBOSE=VERBOSE)
+
+            # 1. If no fragments are possible (e.g. one read crosses the
+            # fragment boundary, they map to different fragments), dump it
+            # into a special bucket
+            if pair_identity == 'cross':
+                n_crossfrag += 1
+                fo_cm.write(reads[0])
+                fo_cm.write(reads[1])
+                continue
+
+            # 2. If 2+ fragments are possible (tie), put into a special bucket
+            # (essentially excluded, because we want two independent measurements
+            # in the overlapping region, but we might want to recover them)
+            elif pair_identity == 'ambiguous':
+                n_ambiguous += 1
+                fo_am.write(reads[0])
+                fo_am.write(reads[1])
+                continue
+
+            # 3. If the intersection is a single fragment, good: trim the primers
+            # NB: n_frag is the index IN THE POOL. If we sequence only F2-F5, F2 is n_frag = 0
+            n_frag = int(pair_identity)
+            frag_pos = frags_pos['trim'][n_frag]
+            if not np.isscalar(frag_pos[0]):
+                frag_pos = [frag_pos[0]['inner'], frag_pos[1]['inner']]
+            trashed_primers = trim_primers(reads, frag_pos,
+                                           include_tests=include_tests)
+            if trashed_primers or (reads[i_fwd].isize < 100):
+                n_unmapped += 1
+                if VERBOSE >= 3:
+                    print 'Read pair is mismapped:', reads[0].qname
+                fo_um.write(reads[0])
+                fo_um.write(reads[1])
+                continue
+
+            # Quality trimming: if no decently long pair survives, trash
+            #trashed_quality = main_block_low_quality(reads, phred_min=20,
+            #                                         include_tests=include_tests)
+            trashed_quality = trim_low_quality(reads, phred_min=20,
+                                               include_tests=include_tests)
+            if trashed_quality or (reads[i_fwd].isize < 100):
+                n_lowq += 1
+                if VERBOSE >= 3:
+                    print 'Read pair has low phred quality:', reads[0].qname
+                fo_lq.write(reads[0])
+                fo_lq.write(reads[1])
+                continue
+
+            # Check for cross-overhangs or COH (reading into the adapters)
+            #        --------------->
+            #    <-----------
+            # In that case, trim to perfect overlap.
+            if test_coh(reads, VERBOSE=False):
+                trim_coh(reads, trim=0, include_tests=include_tests)
+
+            # Change coordinates into the fragmented reference (primer-trimmed)
+            for read in reads:
+                read.pos -= frag_pos[0]
+                read.mpos -= frag_pos[0]
+
+            # Here the tests
+            if include_tests:
+                lfr = frags_pos['trim'][n_frag][1] - frags_pos['trim'][n_frag][0]
+                if test_sanity(reads, n_frag, lfr):
+                    print 'Tests failed:', reads[0].qname
+                    import ipdb; ipdb.set_trace()
+
+            # There we go!
+            n_mapped[n_frag] += 1
+            file_handles[n_frag].write(reads[0])
+            file_handles[n_frag].write(reads[1])
+
+    finally:
+        for f in file_handles:
+            f.close()
+        fo_am.close()
+        fo_cm.close()
+        fo_um.close()
+        fo_lq.close()
+
+    return {'n_pairs': n_pairs,
+            'n_mapped': n_mapped,
+            'n_unmapped': n_unmapped,
+            'n_crossfrag': n_crossfrag,
+            'n_ambiguous': n_ambiguous,
+            'n_outer': n_outer,
+            'n_lowq': n_lowq}
+
+
+def get_shards(bamfile, shardsize, maxreads=-1):
+    '''Split a premapped BAM file into shards of whole read pairs
+
+    Returns:
+       shards (list): (virtual offset, number of pairs) of each shard
+    '''
+    shards = []
+    offset = bamfile.tell()
+    n_pairs = 0
+    for irp, reads in enumerate(pair_generator(bamfile)):
+        if irp == maxreads:
+            break
+        n_pairs += 1
+        if n_pairs == shardsize:
+            shards.append((offset, n_pairs))
+            offset = bamfile.tell()
+            n_pairs = 0
+    if n_pairs:
+        shards.append((offset, n_pairs))
+    return shards
+
+
+def get_shard_filenames(output_filenames, ishard):
+    '''Get the filenames of the divided reads from one shard'''
+    return [fn[:-4]+'_shard'+str(ishard)+fn[-4:] for fn in output_filenames]
+
+
+def divide_read_pairs_shard(args):
+    '''Trim and divide one shard of read pairs (in a worker process)'''
+    (input_filename, offset, n_pairs, output_filenames, kwargs) = args
+    with pysam.Samfile(input_filename, 'rb') as bamfile:
+        bamfile.seek(offset)
+        read_pairs = islice(pair_generator(bamfile), n_pairs)
+        return divide_read_pairs(read_pairs, bamfile, output_filenames, **kwargs)
+
+
+def merge_shards(output_filenames, n_shards, VERBOSE=0):
+    '''Concatenate the shard outputs in order and delete the shards'''
+    for ifn, output_filename in enumerate(output_filenames):
+        shard_filenames = [get_shard_filenames(output_filenames, ishard)[ifn]
+                           for ishard in xrange(n_shards)]
+        if len(shard_filenames) == 1:
+            os.rename(shard_filenames[0], output_filename)
+            continue
+        elif len(shard_filenames) == 0:
+            continue
+
+        if VERBOSE >= 2:
+            print 'Concatenate shards:', os.path.basename(output_filename)
+        pysam.cat('-o', output_filename, *shard_filenames)
+        for fn in shard_filenames:
+            os.remove(fn)
+
+
+def merge_counts(counts_shards):
+    '''Sum the read pair counts of all shards'''
+    counts = {}
+    for key in counts_shards[0]:
+        if key == 'n_mapped':
+            counts[key] = map(sum, izip(*(c[key] for c in counts_shards)))
+        else:
+            counts[key] = sum(c[key] for c in counts_shards)
+    return counts
+
+
 def trim_and_divide_reads(data_folder, adaID, n_cycles, fragments,
                           maxreads=-1, VERBOSE=0,
                           minisize=100,
-                          include_tests=False, summary=True):
-    '''Trim reads and divide them into fragments'''
+                          include_tests=False, summary=True,
+                          threads=1, shardsize=100000):
+    '''Trim reads and divide them into fragments
+
+    Parameters:
+       threads (int): if more than one, split the read pairs into shards of
+       shardsize pairs and process them in parallel. The output is the same
+       as the serial run, including the order of the read pairs.
+    '''
     if VERBOSE:
         print 'Trim and divide into fragments: adaID '+adaID+', fragments: '+\
                 ' '.join(fragments)
@@ -531,179 +771,78 @@ def trim_and_divide_reads(data_folder, adaID, n_cycles, fragments,
     if not os.path.isfile(input_filename):
         convert_sam_to_bam(input_filename)
     output_filenames = get_divided_filenames(data_folder, adaID, fragments, type='bam')
-    with pysam.Samfile(input_filename, 'rb') as bamfile:
 
-        try:
-            file_handles = [pysam.Samfile(ofn, 'wb', template=bamfile)
-                            for ofn in output_filenames[:len(fragments)]]
-    
-            fo_am = pysam.Samfile(output_filenames[-4], 'wb', template=bamfile)
-            fo_cm = pysam.Samfile(output_filenames[-3], 'wb', template=bamfile)
-            fo_um = pysam.Samfile(output_filenames[-2], 'wb', template=bamfile)
-            fo_lq = pysam.Samfile(output_filenames[-1], 'wb', template=bamfile)
-
-            # Iterate over the mapped reads and assign fragments
-            n_mapped = [0 for fragment in fragments]
-            n_unmapped = 0
-            n_crossfrag = 0
-            n_ambiguous = 0
-            n_outer = 0
-            n_lowq = 0
-            for irp, reads in enumerate(pair_generator(bamfile)):
-
-                if irp == maxreads:
-                    if VERBOSE:
-                        print 'Maximal number of read pairs reached:', maxreads
-                    break
-
-                if VERBOSE >= 2:
-                    if not ((irp+1) % 10000):
-                        print irp+1
-
-                i_fwd = reads[0].is_reverse
-
-                # If unmapped or unpaired, mini, or insert size mini, or
-                # divergent read pair (fully cross-overlapping), discard
-                if reads[0].is_unmapped or (not reads[0].is_proper_pair) or \
-                   reads[1].is_unmapped or (not reads[1].is_proper_pair) or \
-                   (reads[0].rlen < 50) or (reads[1].rlen < 50) or \
-                   (reads[i_fwd].isize < minisize):
-                    if VERBOSE >= 3:
-                        print 'Read pair unmapped/unpaired/tiny/divergent:', reads[0].qname
-                    n_unmapped += 1
-                    fo_um.write(reads[0])
-                    fo_um.write(reads[1])
-                    continue
-
-                # If the insert is a misamplification from the outer primers
-                # in fragments that underwent nested PCR,
-                # trash it (it will have skewed amplification anyway). We cannot
-                # find all of those, rather only the ones still carrying the
-                # primer itself (some others have lost it while shearing). For
-                # those, no matter what happens at the end (reading into adapters,
-                # etc.), ONE of the reads in the pair will start exactly with one
-                # outer primer: if the rev read with a rev primer, if the fwd
-                # with a fwd one. Test all six.
-                if (len(primers_out_pos['fwd']) or len(primers_out_pos['rev'])) and \
-                   test_outer_primer(reads,
-                                     primers_out_pos, primers_out_seq,
-                                     len_reference):
-                    if VERBOSE >= 3:
-                        print 'Read pair from outer primer:', reads[0].qname
-                    n_outer += 1
-                    fo_um.write(reads[0])
-                    fo_um.write(reads[1])
-                    continue
-
-                # FIXME: the following becomes a bit harder when we mix parallel
-                # PCRs, e.g. F5a+b, to get more product
-
-                # Assign to a fragment now, so that primer trimming is faster 
-                pair_identity = assign_to_fragment(reads, frags_pos['full'],
-                                                   VERBOSE=VERBOSE)
-
-                # 1. If no fragments are possible (e.g. one read crosses the
-                # fragment boundary, they map to different fragments), dump it
-                # into a special bucket
-                if pair_identity == 'cross':
-                    n_crossfrag += 1
-                    fo_cm.write(reads[0])
-                    fo_cm.write(reads[1])
-                    continue
-
-                # 2. If 2+ fragments are possible (tie), put into a special bucket
-                # (essentially excluded, because we want two independent measurements
-                # in the overlapping region, but we might want to recover them)
-                elif pair_identity == 'ambiguous':
-                    n_ambiguous += 1
-                    fo_am.write(reads[0])
-                    fo_am.write(reads[1])
-                    continue
-
-                # 3. If the intersection is a single fragment, good: trim the primers
-                # NB: n_frag is the index IN THE POOL. If we sequence only F2-F5, F2 is n_frag = 0
-                n_frag = int(pair_identity)
-                frag_pos = frags_pos['trim'][n_frag]
-                if not np.isscalar(frag_pos[0]):
-                    frag_pos = [frag_pos[0]['inner'], frag_pos[1]['inner']]
-                trashed_primers = trim_primers(reads, frag_pos,
-                                               include_tests=include_tests)
-                if trashed_primers or (reads[i_fwd].isize < 100):
-                    n_unmapped += 1
-                    if VERBOSE >= 3:
-                        print 'Read pair is mismapped:', reads[0].qname
-                    fo_um.write(reads[0])
-                    fo_um.write(reads[1])
-                    continue
-
-                # Quality trimming: if no decently long pair survives, trash
-                #trashed_quality = main_block_low_quality(reads, phred_min=20,
-                #                                         include_tests=include_tests)
-                trashed_quality = trim_low_quality(reads, phred_min=20,
-                                                   include_tests=include_tests)
-                if trashed_quality or (reads[i_fwd].isize < 100):
-                    n_lowq += 1
-                    if VERBOSE >= 3:
-                        print 'Read pair has low phred quality:', reads[0].qname
-                    fo_lq.write(reads[0])
-                    fo_lq.write(reads[1])
-                    continue
-
-                # Check for cross-overhangs or COH (reading into the adapters)
-                #        --------------->
-                #    <-----------
-                # In that case, trim to perfect overlap.
-                if test_coh(reads, VERBOSE=False):
-                    trim_coh(reads, trim=0, include_tests=include_tests)
-
-                # Change coordinates into the fragmented reference (primer-trimmed)
-                for read in reads:
-                    read.pos -= frag_pos[0]
-                    read.mpos -= frag_pos[0]
-
-                # Here the tests
-                if include_tests:
-                    lfr = frags_pos['trim'][n_frag][1] - frags_pos['trim'][n_frag][0]
-                    if test_sanity(reads, n_frag, lfr):
-                        print 'Tests failed:', reads[0].qname
-                        import ipdb; ipdb.set_trace()
+    kwargs = {'n_fragments': len(fragments),
+              'frags_pos': frags_pos,
+              'primers_out_pos': primers_out_pos,
+              'primers_out_seq': primers_out_seq,
+              'len_reference': len_reference,
+              'minisize': minisize,
+              'include_tests': include_tests,
+              'VERBOSE': VERBOSE}
+
+    # Split the pairs into shards for parallel processing
+    shards = []
+    if threads > 1:
+        if include_tests:
+            raise ValueError('Tests require an interactive shell')
+
+        with pysam.Samfile(input_filename, 'rb') as bamfile:
+            shards = get_shards(bamfile, shardsize, maxreads=maxreads)
+        if VERBOSE:
+            print 'Shards:', len(shards)
 
-                # There we go!
-                n_mapped[n_frag] += 1
-                file_handles[n_frag].write(reads[0])
-                file_handles[n_frag].write(reads[1])
+    # NOTE: without any read pairs, the serial run writes the empty outputs
+    if not shards:
+        with pysam.Samfile(input_filename, 'rb') as bamfile:
+            read_pairs = pair_generator(bamfile)
+            if maxreads != -1:
+                read_pairs = islice(read_pairs, maxreads)
+            counts = divide_read_pairs(read_pairs, bamfile, output_filenames,
+                                       **kwargs)
 
+    else:
+        # Process the shards in parallel, and concatenate the outputs in the
+        # original order
+        from multiprocessing import Pool
+
+        shard_args = [(input_filename, offset, n_pairs,
+                       get_shard_filenames(output_filenames, ishard), kwargs)
+                      for ishard, (offset, n_pairs) in enumerate(shards)]
+        pool = Pool(min(threads, len(shards)))
+        try:
+            counts_shards = pool.map(divide_read_pairs_shard, shard_args)
         finally:
-            for f in file_handles:
-                f.close()
-            fo_am.close()
-            fo_cm.close()
-            fo_um.close()
-            fo_lq.close()
+            pool.close()
+            pool.join()
+
+        merge_shards(output_filenames, len(shards), VERBOSE=VERBOSE)
+        counts = merge_counts(counts_shards)
 
+    n_mapped = counts['n_mapped']
 
     if VERBOSE:
         print 'Trim and divide results: adaID '+adaID
-        print 'Total:\t\t', irp
+        print 'Total:\t\t', counts['n_pairs']
         print 'Mapped:\t\t', sum(n_mapped), n_mapped
-        print 'Unmapped/unpaired/tiny:\t', n_unmapped
-        print 'Outer primer\t', n_outer
-        print 'Crossfrag:\t', n_crossfrag
-        print 'Ambiguous:\t', n_ambiguous
-        print 'Low-quality:\t', n_lowq
+        print 'Unmapped/unpaired/tiny:\t', counts['n_unmapped']
+        print 'Outer primer\t', counts['n_outer']
+        print 'Crossfrag:\t', counts['n_crossfrag']
+        print 'Ambiguous:\t', counts['n_ambiguous']
+        print 'Low-quality:\t', counts['n_lowq']
 
     # Write summary to file
     if summary:
         with open(get_divide_summary_filename(data_folder, adaID), 'a') as f:
             f.write('\n')
             f.write('Trim and divide results: adaID '+adaID+'\n')
-            f.write('Total:\t\t'+str(irp + 1)+'\n')
+            f.write('Total:\t\t'+str(counts['n_pairs'])+'\n')
             f.write('Mapped:\t\t'+str(sum(n_mapped))+' '+str(n_mapped)+'\n')
-            f.write('Unmapped/unpaired/tiny insert:\t'+str(n_unmapped)+'\n')
-            f.write('Outer primer\t'+str(n_outer)+'\n')
-            f.write('Crossfrag:\t'+str(n_crossfrag)+'\n')
-            f.write('Ambiguous:\t'+str(n_ambiguous)+'\n')
-            f.write('Low-quality:\t'+str(n_lowq)+'\n')
+            f.write('Unmapped/unpaired/tiny insert:\t'+str(counts['n_unmapped'])+'\n')
+            f.write('Outer primer\t'+str(counts['n_outer'])+'\n')
+            f.write('Crossfrag:\t'+str(counts['n_crossfrag'])+'\n')
+            f.write('Ambiguous:\t'+str(counts['n_ambiguous'])+'\n')
+            f.write('Low-quality:\t'+str(counts['n_lowq'])+'\n')
 
 
 
@@ -729,6 +868,8 @@ if __name__ == '__main__':
                         help='Include sanity checks on mapped reads (slow)')
     parser.add_argument('--no-summary', action='store_false', dest='summary',
                         help='Do not save results in a summary file')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of worker processes (sharded input)')
 
     args = parser.parse_args()
     seq_run = args.run
@@ -739,6 +880,7 @@ if __name__ == '__main__':
     submit = args.submit
     include_tests = args.test
     summary = args.summary
+    threads = args.threads
 
     dataset = load_sequencing_run(seq_run)
     data_folder = dataset.folder
@@ -773,7 +915,7 @@ if __name__ == '__main__':
             if include_tests:
                 raise ValueError('Tests require an interactive shell')
             fork_self(seq_run, adaID, VERBOSE=VERBOSE, maxreads=maxreads,
-                      minisize=minisize, summary=summary)
+                      minisize=minisize, summary=summary, threads=threads)
             continue
 
         make_output_folders(data_folder, adaID, VERBOSE=VERBOSE)
@@ -796,4 +938,5 @@ if __name__ == '__main__':
                               maxreads=maxreads, VERBOSE=VERBOSE,
                               minisize=minisize,
                               include_tests=include_tests,
-                              summary=summary)
+                              summary=summary,
+                              threads=threads)
@@ -4,16 +4,15 @@ author:     Fabio Zanini
 date:       31/08/14
 content:    Check status of patients: initial reference, genomewide reference,
             mapped reads, filtered reads, allele counts, allele frequency
-            trajectories, linkage data structures.
+            trajectories, linkage data structures. The status of each output
+            comes from the pipeline manifest.
 '''
 # Modules
 import os
 import argparse
-import datetime
 from hivwholeseq.patients.patients import (load_patients, load_patient,
                                            iterpatient, SamplePat)
 from hivwholeseq.patients.filenames import get_decontaminate_summary_filename
-from hivwholeseq.utils.generic import modification_date
 from hivwholeseq.utils.argparse import PatientsAction
 
 
@@ -66,117 +65,113 @@ def check_reference_overlap(p, VERBOSE=0):
         raise ValueError('GAPS status found') 
 
 
-def print_info_patient(p, title, name, method, name_requisite=None,
-                       VERBOSE=0):
-    '''Pretty printer for whole-patient info, fragment by fragment'''
-    import os, sys
+def get_target_stati(pname, targets):
+    '''Get the status of targets from the pipeline manifest of a patient
 
-    mod_dates = p.mod_dates
+    Parameters:
+       targets (list): pairs of (target, inputs) filenames
 
-    line = ('{:<'+str(title_len)+'}').format(title+':')
-    stati = []
-    for fragment in ('F'+str(i+1) for i in xrange(6)):
-        if isinstance(method, basestring):
-            fun = getattr(p, method)
-            fn = fun(fragment)
-        else:
-            fn = method(p.name, fragment)
+    Returns:
+       stati (list): MISS, OLD, or OK (see PipelineManifest.get_target_status)
+    '''
+    from hivwholeseq.patients.pipeline_manifest import update_pipeline_manifest
 
-        if os.path.isfile(fn):
-            md = modification_date(fn)
-            mod_dates[('refmap', fragment)] = md
+    def get_stati(manifest):
+        return [manifest.get_target_status(target, inputs)
+                for (target, inputs) in targets]
+    return update_pipeline_manifest(pname, get_stati)
 
-            if name_requisite is None:
-                status = 'OK'
 
-            elif ((name_requisite, fragment) in mod_dates):
-                if md > mod_dates[(name_requisite, fragment)]:
-                    status = 'OK'
-                else:
-                    status = 'OLD'
+def merge_stati(stati):
+    '''Merge the stati of the targets of a cell into one'''
+    if not len(stati):
+        return 'MISS'
+    for status in ('OLD', 'MISS'):
+        if status in stati:
+            return status
+    return 'OK'
 
-        else:
-            status = 'MISS'
 
-        stati.append(status)
+def print_info_patient(p, title, method, VERBOSE=0):
+    '''Pretty printer for whole-patient info, fragment by fragment
+
+    Parameters:
+       method (str): Patient method to get the filename of a fragment, its
+       input is the fragment reference
+    '''
+    fragments = ['F'+str(i+1) for i in xrange(6)]
+    targets = [(getattr(p, method)(fragment), [p.get_reference_filename(fragment)])
+               for fragment in fragments]
+    stati = get_target_stati(p.name, targets)
+
+    line = ('{:<'+str(title_len)+'}').format(title+':')
+    for fragment, status in zip(fragments, stati):
         line = line + fragment + ': ' + ('{:>'+str(cell_len - len(fragment) - 1)+'}').format(status) + '  '
     print line
 
 
-def print_info(p, title, name, method, name_requisite=None, VERBOSE=0):
-    '''Pretty printer for patient pipeline info'''
-    import os, sys
+def print_info(p, title, step, VERBOSE=0):
+    '''Pretty printer for patient pipeline info
+
+    Parameters:
+       step (str): pipeline step (see patients/pipeline_manifest.py), whose
+       targets and inputs are checked against the manifest
+    '''
     from hivwholeseq.patients.samples import SamplePat
+    from hivwholeseq.patients.pipeline_manifest import get_step_targets
     from hivwholeseq.utils.mapping import get_number_reads
 
-    mod_dates = p.mod_dates
-
     # NOTE: this function is used to check both entire patients and single samples
     if isinstance(p, SamplePat):
         sample_iter = [(p.name, p)]
+        pname = p.patient
     else:
         sample_iter = p.samples.iterrows()
+        pname = p.name
 
     fragments=['F'+str(i+1) for i in xrange(6)]
 
+    samples = []
+    targets = []
+    for samplename, sample in sample_iter:
+        sample = SamplePat(sample)
+        samples.append(sample)
+        for fragment in fragments:
+            targets.append(get_step_targets(sample, step, fragment))
+
+    # Query the manifest once for all targets, then split them by cell
+    stati_flat = get_target_stati(pname, sum(targets, []))
+    stati_targets = []
+    for targets_cell in targets:
+        stati_targets.append(stati_flat[:len(targets_cell)])
+        stati_flat = stati_flat[len(targets_cell):]
+
     stati = set()
     line = ('{:<'+str(title_len)+'}').format(title+':')
     print line
-    for samplename, sample in sample_iter:
-        sample = SamplePat(sample)
+    i = 0
+    for sample in samples:
         title = sample.name
         line = ('{:<'+str(title_len)+'}').format(title+':')
-        
+
         for fragment in fragments:
-            if isinstance(method, basestring) and hasattr(sample, method):
-                fun = getattr(sample, method)
-                fn = fun(fragment)
-            else:
-                fn = method(sample.patient, samplename, fragment)
-
-            if os.path.isfile(fn):
-                md = modification_date(fn)
-                mod_dates[(name, fragment, samplename)] = md
-
-                if name_requisite is None:
-                    status = 'OK'
-
-                elif ((name_requisite, fragment, samplename) in mod_dates):
-                    if md > mod_dates[(name_requisite, fragment, samplename)]:
-                        status = 'OK'
-                    else:
-                        status = 'OLD'
-                        print fn, md, mod_dates[(name_requisite, fragment, samplename)]
-
-                elif ((name_requisite, fragment) in mod_dates):
-                    if md > mod_dates[(name_requisite, fragment)]:
-                        status = 'OK'
-                    else:
-                        status = 'OLD'
-
-                        # NOTE: on Nov 13, 2014 I updated the mod dates of all
-                        # references by mistake, without actually changing the
-                        # sequences (ironically, probably testing a backup system
-                        # for the refs themselves). So if the requisite is a ref
-                        # seq and the date is this one, it's OK
-                        if ((name_requisite == 'reference') and
-                            mod_dates[(name_requisite, fragment)].date() == \
-                            datetime.date(2014, 11, 13)):
-                            status = 'OK'
-
-
-                elif 'contaminated' in sample[fragment]:
-                    status = 'CONT'
-                
-                else:
-                    status = 'ERROR'
-
-            else:
-                status = 'MISS'
+            targets_cell = targets[i]
+            stati_cell = stati_targets[i]
+            i += 1
+
+            status = merge_stati(stati_cell)
+            if (status == 'MISS') and ('contaminated' in sample[fragment]):
+                status = 'CONT'
+
+            if (status == 'OLD') and (VERBOSE >= 2):
+                for (target, _), status_target in zip(targets_cell, stati_cell):
+                    if status_target == 'OLD':
+                        print 'OLD', target
 
             # Check the number of reads if requested
-            if (status == 'OK') and (fn[-3:] == 'bam') and (VERBOSE >= 3):
-                status = str(get_number_reads(fn))
+            if (status == 'OK') and (len(targets_cell) == 1) and \
+               (targets_cell[0][0][-3:] == 'bam') and (VERBOSE >= 3):
+                status = str(get_number_reads(targets_cell[0][0]))
 
             stati.add(status)
             line = line+fragment+': '+\
@@ -188,37 +183,18 @@ def print_info(p, title, name, method, name_requisite=None, VERBOSE=0):
         raise ValueError('OLD status found') 
 
 
-def print_info_genomewide(p, title, name, method, VERBOSE=0, require_all=True):
-    '''Pretty printer for patient pipeline info'''
-
-    mod_dates = p.mod_dates
+def print_info_genomewide(p, title, step, method, VERBOSE=0, require_all=True):
+    '''Pretty printer for patient pipeline info
 
-    def check_requisite_genomewide(md, name_requisite, samplename, mod_dates,
-                                   require_all=True):
-        '''Check requisites for genomewide observables'''
-        stati = []
-        fragments=['F'+str(i+1) for i in xrange(6)]
-        for fragment in fragments:
-            if (name_requisite, fragment, samplename) not in mod_dates:
-                stati.append('MISS')
-            elif md < mod_dates[(name_requisite, fragment, samplename)]:
-                stati.append('OLD')
-            else:
-                stati.append('OK')
-
-        if 'OLD' in stati:
-            return 'OLD'
-        else:
-            if require_all:
-                if 'MISS' in stati:
-                    return 'MISS'
-                else:
-                    return 'OK'
-            else:
-                if 'OK' in stati:
-                    return 'OK'
-                else:
-                    return 'MISS'
+    Parameters:
+       step (str): pipeline step of the fragment targets, which are the inputs
+       of the genomewide one
+       method (str): SamplePat method to get the genomewide filename
+       require_all (bool): require all fragments, else at least one
+    '''
+    from hivwholeseq.patients.samples import SamplePat
+    from hivwholeseq.patients.pipeline_manifest import get_step_targets
+    from hivwholeseq.utils.mapping import get_number_reads
 
     def check_contamination_genomewide(sample):
         '''Check whether any of the fragment samples is contaminated'''
@@ -228,44 +204,52 @@ def print_info_genomewide(p, title, name, method, VERBOSE=0, require_all=True):
                 return True
         return False
 
-    import os, sys
-    from hivwholeseq.patients.samples import SamplePat
-
     # NOTE: this function is used to check both entire patients and single samples
     if isinstance(p, SamplePat):
         sample_iter = [(p.name, p)]
+        pname = p.patient
     else:
         sample_iter = p.samples.iterrows()
+        pname = p.name
+
+    fragments=['F'+str(i+1) for i in xrange(6)]
+
+    samples = []
+    targets_genomewide = []
+    targets = []
+    for samplename, sample in sample_iter:
+        sample = SamplePat(sample)
+        samples.append(sample)
+        fns_in = [target for fragment in fragments
+                  for (target, _) in get_step_targets(sample, step, fragment)]
+        target = (getattr(sample, method)('genomewide'), fns_in)
+        targets_genomewide.append(target)
+
+        # The fragment targets first, then the genomewide one
+        targets.extend([(fn, []) for fn in fns_in] + [target])
+
+    stati_targets = get_target_stati(pname, targets)
 
     stati = set()    
     line = ('{:<'+str(title_len)+'}').format(title+':')
     print line
-    for samplename, sample in sample_iter:
-        sample = SamplePat(sample)
+    i = 0
+    for sample, (fn, fns_in) in zip(samples, targets_genomewide):
         title = sample.name
         line = ('{:<'+str(title_len)+'}').format(title+':')
-        
-        if isinstance(method, basestring) and hasattr(sample, method):
-            fun = getattr(sample, method)
-            fn = fun('genomewide')
-        else:
-            fn = method(sample.patient, samplename, 'genomewide')
-        if os.path.isfile(fn):
-            md = modification_date(fn)
-            mod_dates[(name, 'genomewide', samplename)] = md
 
-            if name is None:
-                status = 'OK'
+        stati_in = stati_targets[i: i + len(fns_in)]
+        status = stati_targets[i + len(fns_in)]
+        i += len(fns_in) + 1
 
-            elif check_contamination_genomewide(sample):
+        if status != 'MISS':
+            if check_contamination_genomewide(sample):
                 status = 'CONT'
 
-            else:
-                status = check_requisite_genomewide(md, name, samplename, mod_dates,
-                                                    require_all=require_all)
-
-        else:
-            status = 'MISS'
+            elif (not len(stati_in)) or \
+                 (require_all and ('MISS' in stati_in)) or \
+                 ((not require_all) and (set(stati_in) == set(['MISS']))):
+                status = 'MISS'
 
         # Check the number of reads if requested
         if (status == 'OK') and (fn[-3:] == 'bam') and (VERBOSE >= 3):
@@ -311,32 +295,26 @@ def check_pipeline_patient(p, VERBOSE=0):
 
     def print_info_references(p):
         '''Print info on references'''
+        fragments = ['F'+str(i+1) for i in xrange(6)]
+        fn_genomewide = p.get_reference_filename('genomewide', 'fasta')
+        targets = [(p.get_reference_filename(fragment), []) for fragment in fragments]
+        targets.append((fn_genomewide, []))
+        targets.append((p.get_reference_filename('genomewide', 'gb'), [fn_genomewide]))
+        stati = get_target_stati(p.name, targets)
+
         title = 'References'
         line = ('{:<'+str(title_len)+'}').format(title+':')
-        stati = []
-        for fragment in ('F'+str(i+1) for i in xrange(6)):
-            fn = p.get_reference_filename(fragment)
-            if os.path.isfile(fn):
-                status = 'OK'
-                p.mod_dates[('reference', fragment)] = modification_date(fn)
-            else:
-                status = 'MISS'
-            stati.append(status)
+        for fragment, status in zip(fragments, stati):
             line = line + fragment + ': ' + ('{:>'+str(cell_len - len(fragment) - 1)+'}').format(status) + '  '
         print line
     
-        if frozenset(stati) != frozenset(['OK']):
+        if frozenset(stati[:len(fragments)]) != frozenset(['OK']):
             print ''
             raise PipelineError('Amplicon reference failed!')
     
         title = 'Genome ref'
         line = ('{:<'+str(title_len)+'}').format(title+':')
-        fn = p.get_reference_filename('genomewide', 'fasta')
-        if os.path.isfile(fn):
-            status = 'OK'
-            p.mod_dates[('reference', 'genomewide')] = modification_date(fn)
-        else:
-            status = 'MISS'
+        status = stati[-2]
         line = line + ('{:<'+str(cell_len)+'}').format(status)
         print line
     
@@ -348,59 +326,50 @@ def check_pipeline_patient(p, VERBOSE=0):
 
         title = 'Annotated'
         line = ('{:<'+str(title_len)+'}').format(title+':')
-        fn = p.get_reference_filename('genomewide', 'gb')
-        if os.path.isfile(fn):
-            md = modification_date(fn)
-            if md >= p.mod_dates[('reference', 'genomewide')]:
-                status = 'OK'
-            else:
-                status = 'OLD'
-        else:
-            status = 'MISS'
+        status = stati[-1]
         line = line + ('{:<'+str(cell_len)+'}').format(status)
         print line
         if status != 'OK':
             print ''
             raise PipelineError('Annotated reference failed!')
 
+    def print_info_trajectories(p):
+        '''Print info on the trajectory store'''
+        from hivwholeseq.patients.pipeline_manifest import get_step_targets
+        title = 'Trajectories'
+        line = ('{:<'+str(title_len)+'}').format(title+':')
+        status = merge_stati(get_target_stati(p.name,
+                                              get_step_targets(p, 'trajectories')))
+        line = line + ('{:<'+str(cell_len)+'}').format(status)
+        print line
+
 
-    p.mod_dates = {}
-    
     print_info_summary(p)
 
     print_info_references(p)
 
-    from hivwholeseq.patients.filenames import get_mapped_filtered_filename
-    print_info(p, 'Map + filter', 'filter',
-               lambda pn, sn, fr: get_mapped_filtered_filename(pn, sn, fr, decontaminated=False),
-               'reference')
+    print_info(p, 'Map + filter', 'filter', VERBOSE=VERBOSE)
 
-    print_info(p, 'Decontaminate', 'decontaminate',
-               lambda pn, sn, fr: get_mapped_filtered_filename(pn, sn, fr, decontaminated=True),
-               'filter')
+    print_info(p, 'Decontaminate', 'decontaminate', VERBOSE=VERBOSE)
 
-    print_info(p, 'Consensus', 'consensus',
-               'get_consensus_filename',
-               'decontaminate')
+    print_info(p, 'Consensus', 'consensus', VERBOSE=VERBOSE)
 
     print_info_genomewide(p, 'Cons genomewide', 'consensus',
-                          'get_consensus_filename')
+                          'get_consensus_filename', VERBOSE=VERBOSE)
 
-    print_info(p, 'Allele counts', 'allele counts',
-               'get_allele_counts_filename',
-               'decontaminate')
+    print_info(p, 'Allele counts', 'allele counts', VERBOSE=VERBOSE)
 
-    print_info(p, 'Allele cocounts', 'allele cocounts',
-               'get_allele_cocounts_filename',
-               'decontaminate')
+    print_info(p, 'Allele cocounts', 'allele cocounts', VERBOSE=VERBOSE)
 
     print_info_genomewide(p, 'Allele counts genomewide', 'allele counts',
                           'get_allele_counts_filename',
-                          require_all=False)
+                          require_all=False, VERBOSE=VERBOSE)
+
+    print_info_trajectories(p)
 
-    print_info_patient(p, 'Maps to HXB2', 'reference',
+    print_info_patient(p, 'Maps to HXB2',
                        'get_map_coordinates_reference_filename',
-                       'reference')
+                       VERBOSE=VERBOSE)
 
 
     print ''
@@ -4,6 +4,9 @@
 author:     Fabio Zanini
 date:       17/12/14
 content:    Compress cocount matrices for faster IO.
+
+            With --sparse, dense cocounts (compressed or not) are converted
+            into the sparse, symmetric format instead.
 '''
 # Modules
 import os
@@ -13,6 +16,7 @@ import numpy as np
 
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.utils.two_site_statistics import CocountMatrix
 from hivwholeseq.cluster.fork_cluster import fork_compress_cocounts_patient as fork_self
 
 
@@ -38,6 +42,8 @@ if __name__ == '__main__':
                         help='Minimal quality of base to call')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (1 or 2)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Convert to the sparse format instead of compressing')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -47,6 +53,7 @@ if __name__ == '__main__':
     submit = args.submit
     qual_min = args.qualmin
     PCR = args.PCR
+    sparse = args.sparse
 
     samples = lssp()
     if pnames is not None:
@@ -66,7 +73,7 @@ if __name__ == '__main__':
         for fragment in fragments:
             for samplename, sample in samples.iterrows():
                 fork_self(samplename, fragment, VERBOSE=VERBOSE,
-                          qual_min=qual_min, PCR=PCR)
+                          qual_min=qual_min, PCR=PCR, sparse=sparse)
         sys.exit()
 
 
@@ -84,6 +91,13 @@ if __name__ == '__main__':
                                                      compressed=False)
             
             fn_out = sample.get_allele_cocounts_filename(fragment, PCR=PCR,
+                                                         qual_min=qual_min,
+                                                         compressed=True,
+                                                         sparse=sparse)
+
+            # The sparse format can be made from the compressed files too
+            if sparse and (not os.path.isfile(fn)):
+                fn = sample.get_allele_cocounts_filename(fragment, PCR=PCR,
                                                          qual_min=qual_min,
                                                          compressed=True)
 
@@ -95,7 +109,15 @@ if __name__ == '__main__':
             if VERBOSE >= 2:
                 print 'Loading cocounts'
             cocount = np.load(fn)
+            if fn.endswith('.npz'):
+                cocount = cocount['cocounts']
 
-            if VERBOSE >= 2:
-                print 'Storing compressed cocounts'
-            np.savez_compressed(fn_out, cocounts=cocount)
+            if sparse:
+                if VERBOSE >= 2:
+                    print 'Storing sparse cocounts'
+                CocountMatrix.from_dense(cocount).save(fn_out)
+
+            else:
+                if VERBOSE >= 2:
+                    print 'Storing compressed cocounts'
+                np.savez_compressed(fn_out, cocounts=cocount)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    Convert allele counts pickled via ndarray.dump into the .npy format,
+            which can be memory mapped to read only a region.
+'''
+# Modules
+import os
+import argparse
+import cPickle as pickle
+import numpy as np
+
+from hivwholeseq.patients.samples import load_samples_sequenced as lssp
+from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.utils.generic import is_npy_file
+
+
+
+# Script
+if __name__ == '__main__':
+
+    # Parse input args
+    parser = argparse.ArgumentParser(description='Convert allele counts to .npy format',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    pats_or_samples = parser.add_mutually_exclusive_group(required=True)
+    pats_or_samples.add_argument('--patients', nargs='+',
+                                 help='Patient to analyze')
+    pats_or_samples.add_argument('--samples', nargs='+',
+                                 help='Samples to analyze')
+    parser.add_argument('--regions', nargs='*',
+                        help='Fragments, genomewide or proteins (e.g. F1 genomewide)')
+    parser.add_argument('--type', choices=['nuc', 'aa'], default='nuc',
+                        help='Nucleotide or amino acid counts')
+    parser.add_argument('--verbose', type=int, default=0,
+                        help='Verbosity level [0-3]')
+    parser.add_argument('--qualmin', type=int, default=30,
+                        help='Minimal quality of base to call')
+    parser.add_argument('--PCR', type=int, default=1,
+                        help='Analyze only reads from this PCR (1 or 2)')
+
+    args = parser.parse_args()
+    pnames = args.patients
+    samplenames = args.samples
+    regions = args.regions
+    type = args.type
+    VERBOSE = args.verbose
+    qual_min = args.qualmin
+    PCR = args.PCR
+
+    samples = lssp()
+    if pnames is not None:
+        samples = samples.loc[samples.patient.isin(pnames)]
+    elif samplenames is not None:
+        samples = samples.loc[samples.index.isin(samplenames)]
+
+    if VERBOSE >= 2:
+        print 'samples', samples.index.tolist()
+
+    if not regions:
+        if type == 'aa':
+            raise ValueError('Amino acid counts need the proteins to convert')
+        regions = ['F'+str(i) for i in xrange(1, 7)] + ['genomewide']
+    if VERBOSE >= 3:
+        print 'regions', regions
+
+    for samplename, sample in samples.iterrows():
+        sample = SamplePat(sample)
+        pname = sample.patient
+
+        for region in regions:
+
+            if VERBOSE >= 1:
+                print pname, samplename, region
+
+            fn = sample.get_allele_counts_filename(region, PCR=PCR,
+                                                   qual_min=qual_min,
+                                                   type=type)
+
+            if not os.path.isfile(fn):
+                if VERBOSE >= 2:
+                    print 'File not found, skipping'
+                continue
+
+            if is_npy_file(fn):
+                if VERBOSE >= 2:
+                    print 'Already in .npy format, skipping'
+                continue
+
+            with open(fn, 'rb') as f:
+                count = pickle.load(f)
+
+            # Same filename, so write to a temporary file and rename
+            fn_tmp = fn[:-4]+'_tmp_'+str(os.getpid())+fn[-4:]
+            np.save(fn_tmp, count)
+            os.rename(fn_tmp, fn)
+
+            if VERBOSE >= 2:
+                print 'Allele counts converted'
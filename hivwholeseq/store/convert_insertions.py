@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    Convert pickled insertions into the columnar format for faster IO.
+'''
+# Modules
+import os
+import argparse
+import cPickle as pickle
+
+from hivwholeseq.patients.samples import load_samples_sequenced as lssp
+from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.utils.one_site_statistics import InsertionTable
+
+
+
+# Script
+if __name__ == '__main__':
+
+    # Parse input args
+    parser = argparse.ArgumentParser(description='Convert insertions to columnar format',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    pats_or_samples = parser.add_mutually_exclusive_group(required=True)
+    pats_or_samples.add_argument('--patients', nargs='+',
+                                 help='Patient to analyze')
+    pats_or_samples.add_argument('--samples', nargs='+',
+                                 help='Samples to analyze')
+    parser.add_argument('--regions', nargs='*',
+                        help='Fragments or genomewide (e.g. F1 genomewide)')
+    parser.add_argument('--verbose', type=int, default=0,
+                        help='Verbosity level [0-3]')
+    parser.add_argument('--qualmin', type=int, default=30,
+                        help='Minimal quality of base to call')
+    parser.add_argument('--PCR', type=int, default=1,
+                        help='Analyze only reads from this PCR (1 or 2)')
+    parser.add_argument('--remove', action='store_true',
+                        help='Remove the pickled files after conversion')
+
+    args = parser.parse_args()
+    pnames = args.patients
+    samplenames = args.samples
+    regions = args.regions
+    VERBOSE = args.verbose
+    qual_min = args.qualmin
+    PCR = args.PCR
+    remove = args.remove
+
+    samples = lssp()
+    if pnames is not None:
+        samples = samples.loc[samples.patient.isin(pnames)]
+    elif samplenames is not None:
+        samples = samples.loc[samples.index.isin(samplenames)]
+
+    if VERBOSE >= 2:
+        print 'samples', samples.index.tolist()
+
+    if not regions:
+        regions = ['F'+str(i) for i in xrange(1, 7)] + ['genomewide']
+    if VERBOSE >= 3:
+        print 'regions', regions
+
+    for samplename, sample in samples.iterrows():
+        sample = SamplePat(sample)
+        pname = sample.patient
+
+        for region in regions:
+
+            if VERBOSE >= 1:
+                print pname, samplename, region
+
+            fn = sample.get_insertions_filename(region, PCR=PCR,
+                                                qual_min=qual_min)
+            fn_out = sample.get_insertions_filename(region, PCR=PCR,
+                                                    qual_min=qual_min,
+                                                    format='npz')
+
+            if not os.path.isfile(fn):
+                if VERBOSE >= 2:
+                    print 'Input file not found, skipping'
+                continue
+
+            with open(fn, 'r') as f:
+                inse = pickle.load(f)
+
+            if VERBOSE >= 2:
+                print 'Storing columnar insertions'
+            InsertionTable.from_counters(inse).save(fn_out)
+
+            if remove:
+                os.remove(fn)
+                if VERBOSE >= 2:
+                    print 'Pickled insertions removed'
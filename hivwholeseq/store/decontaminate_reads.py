@@ -17,7 +17,9 @@ from hivwholeseq.patients.patients import load_samples_sequenced as lssp
 from hivwholeseq.patients.patients import SamplePat
 from hivwholeseq.reference import load_custom_reference
 from hivwholeseq.utils.sequence import pretty_print_pairwise_ali
+from hivwholeseq.utils.mapping import make_sorted_bam, is_sorted_bam_current
 from hivwholeseq.patients.filenames import get_decontaminate_summary_filename
+from hivwholeseq.patients.pipeline_manifest import is_step_up_to_date, record_step
 from hivwholeseq.cluster.fork_cluster import fork_decontaminate_reads_patient as fork_self
 
 
@@ -100,21 +102,88 @@ def trim_align_overlap(ali):
     return (ali1, ali2)
 
 
+def make_kmer_index(seqs, k=12):
+    '''Make an index of the k-mers of many sequences
+
+    Parameters:
+       seqs (dict): sequences by name, e.g. all consensi of a fragment
+       k (int): length of the k-mers
+
+    Returns:
+       kmer_index (dict): names of the sequences, k, and for each k-mer the
+       indices of the sequences containing it
+    '''
+    names = sorted(seqs.iterkeys())
+    kmers = {}
+    for i, name in enumerate(names):
+        seq = ''.join(seqs[name])
+        for kmer in set(seq[j: j + k] for j in xrange(len(seq) - k + 1)):
+            if kmer not in kmers:
+                kmers[kmer] = [i]
+            else:
+                kmers[kmer].append(i)
+
+    kmers = {kmer: np.array(ind, int) for kmer, ind in kmers.iteritems()}
+    return {'names': names, 'k': k, 'kmers': kmers}
+
+
+def get_kmer_candidates(seq, kmer_index, n_candidates=5, names=None):
+    '''Get the sequences sharing most k-mers with a read
+
+    Parameters:
+       seq (str): the read sequence
+       kmer_index (dict): see make_kmer_index
+       n_candidates (int): number of candidates to return
+       names (set): restrict the candidates to these sequences
+
+    Returns:
+       candidates (list): names of the top candidates, best first
+    '''
+    k = kmer_index['k']
+    kmers = kmer_index['kmers']
+    inds = [kmers[kmer] for kmer in set(seq[j: j + k] for j in xrange(len(seq) - k + 1))
+            if kmer in kmers]
+    if not len(inds):
+        return []
+
+    scores = np.bincount(np.concatenate(inds), minlength=len(kmer_index['names']))
+    candidates = []
+    for i in np.argsort(-scores, kind='mergesort'):
+        if scores[i] == 0:
+            break
+        name = kmer_index['names'][i]
+        if (names is None) or (name in names):
+            candidates.append(name)
+            if len(candidates) == n_candidates:
+                break
+    return candidates
+
+
 def filter_contamination(bamfilename, bamfilename_out, contseqs, samplename, VERBOSE=0,
                          deltascore_max_self=60, deltascore_max_other=24,
-                         maxreads=-1,
+                         maxreads=-1, kmer_index=None, n_candidates=0,
                          **kwargs):
     '''Fish contaminated reads from mapped reads
 
     The function checks for a maximal distance to the expected consensus, and only
-    if it's more than that it checks all other samples.
+    if it's more than that it checks the other samples (optionally only those
+    sharing most k-mers with the read).
     
     Args:
       deltascore_max_self (int): the maximal delta in alignment score to the 
                                  consensus to be considered pure
       deltascore_max_other (int): the maximal delta in alignment score to any other
                                   sample to be considered a contamination
+      kmer_index (dict): k-mer index of the consensi, see make_kmer_index (it
+                         is made from contseqs if missing and needed)
+      n_candidates (int): number of other samples to align each read to, by
+                          shared k-mers (default: align to all of them)
       **kwargs: passed down to the pairwise alignment function
+
+    NOTE: the k-mer shortlist is opt-in because the result is approximate. If
+    more than n_candidates other consensi are about equally close to a read,
+    the one it came from might be left out and the read kept as good (or
+    attributed to a different source).
     '''
     import pysam
     from collections import defaultdict
@@ -133,6 +202,10 @@ def filter_contamination(bamfilename, bamfilename_out, contseqs, samplename, VER
     contseqs = contseqs.copy()
     consseq = contseqs.pop(samplename)
 
+    if n_candidates and (kmer_index is None):
+        kmer_index = make_kmer_index(contseqs)
+    contnames = frozenset(contseqs.iterkeys())
+
     if VERBOSE >= 2:
         print 'Scanning reads ('+str(get_number_reads(bamfilename) // 2)+')'
 
@@ -170,8 +243,17 @@ def filter_contamination(bamfilename, bamfilename_out, contseqs, samplename, VER
                                                       name1='ref', name2='read')
                         continue
 
-                    # Otherwise, move on to all other sequences and find the neighbour
-                    for contname, contseq in contseqs.iteritems():
+                    # Otherwise, move on to the most similar other sequences
+                    # (by shared k-mers) and find the neighbour
+                    if n_candidates:
+                        contnames_read = get_kmer_candidates(read.seq, kmer_index,
+                                                             n_candidates=n_candidates,
+                                                             names=contnames)
+                    else:
+                        contnames_read = contseqs.iterkeys()
+
+                    for contname in contnames_read:
+                        contseq = contseqs[contname]
                         (score, ali1, ali2) = align_overlap(contseq, read.seq, **kwargs)
                         (ali1, ali2) = trim_align_overlap((ali1, ali2))
                         scoremax = len(ali1) * score_match
@@ -263,6 +345,13 @@ if __name__ == '__main__':
                         help='Execute the script in parallel on the cluster')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (e.g. 1)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip samples that are up to date in the pipeline manifest')
+    parser.add_argument('--sorted', action='store_true', dest='sort',
+                        help='Also make a coordinate-sorted, indexed BAM for region queries')
+    parser.add_argument('--kmer-candidates', type=int, default=0,
+                        dest='n_candidates',
+                        help='Align reads only to this many other consensi, by shared k-mers (approximate, 0 for all)')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -273,6 +362,12 @@ if __name__ == '__main__':
     maxreads = args.maxreads
     summary = args.summary
     PCR = args.PCR
+    incremental = args.incremental
+    sort = args.sort
+    n_candidates = args.n_candidates
+    params = {'maxreads': maxreads}
+    if n_candidates:
+        params['kmer candidates'] = n_candidates
 
     samples = lssp()
     if pnames is not None:
@@ -304,12 +399,18 @@ if __name__ == '__main__':
                                                                       decontaminated=False)
                     if not os.path.isfile(bamfilename):
                         continue
+
+                    if incremental and is_step_up_to_date(sample, 'decontaminate',
+                                                          fragment, PCR=PCR_sample,
+                                                          params=params):
+                        continue
                 
                     #if check_already_decontaminated(sample, fragment, PCR_sample):
                     #    continue
 
                     fork_self(samplename, fragment, VERBOSE=VERBOSE, maxreads=maxreads,
-                              summary=summary, PCR=PCR_sample)
+                              summary=summary, PCR=PCR_sample, sort=sort,
+                              n_candidates=n_candidates)
 
         sys.exit()
 
@@ -324,6 +425,12 @@ if __name__ == '__main__':
                 print samplename, 'file not found'
                 continue
 
+        # The k-mer index is shared by all samples
+        if n_candidates:
+            kmer_index = make_kmer_index(consensi)
+        else:
+            kmer_index = None
+
         for samplename, sample in samples_focal.iterrows():
             sample = SamplePat(sample)
             pname = sample.patient
@@ -342,6 +449,21 @@ if __name__ == '__main__':
                 bamfilename_out = sample.get_mapped_filtered_filename(fragment,
                                                                       decontaminated=True,
                                                                       PCR=PCR_sample)
+                bamfilename_sorted = sample.get_mapped_filtered_filename(fragment,
+                                                                         decontaminated=True,
+                                                                         PCR=PCR_sample,
+                                                                         sort=True)
+
+                if incremental and is_step_up_to_date(sample, 'decontaminate',
+                                                      fragment, PCR=PCR_sample,
+                                                      params=params):
+                    if VERBOSE:
+                        print samplename, PCR_sample, 'up to date'
+                    if sort and (not is_sorted_bam_current(bamfilename_sorted,
+                                                           bamfilename_out)):
+                        make_sorted_bam(bamfilename_out, bamfilename_sorted,
+                                        VERBOSE=VERBOSE)
+                    continue
 
                 # Exclude the same patient as potential contaminants
                 consensi_sample = consensi.copy()
@@ -363,7 +485,9 @@ if __name__ == '__main__':
                 (n_good, n_cont) = filter_contamination(bamfilename, bamfilename_out,
                                                         consensi_sample, samplename,
                                                         VERBOSE=VERBOSE,
-                                                        maxreads=maxreads)
+                                                        maxreads=maxreads,
+                                                        kmer_index=kmer_index,
+                                                        n_candidates=n_candidates)
 
                 if VERBOSE:
                     print 'good:', n_good, 'contaminated:', n_cont
@@ -378,9 +502,18 @@ if __name__ == '__main__':
                                 ' --verbose '+str(VERBOSE))
                         if maxreads != -1:
                             f.write(' --maxreads '+str(maxreads))
+                        if n_candidates:
+                            f.write(' --kmer-candidates '+str(n_candidates))
                         f.write('\n')
                         f.write('Good: '+str(n_good)+'\n')
                         f.write('Contaminated: '+str(sum(n_cont.itervalues()))+'\n')
                         f.write('Contamination sources:\n')
                         for contname, n_conti in n_cont.iteritems():
                             f.write('{:<20s}'.format(contname)+' '+'{:>7d}'.format(n_conti)+'\n')
+
+                if sort:
+                    make_sorted_bam(bamfilename_out, bamfilename_sorted,
+                                    VERBOSE=VERBOSE)
+
+                record_step(sample, 'decontaminate', fragment, PCR=PCR_sample,
+                            params=params, VERBOSE=VERBOSE)
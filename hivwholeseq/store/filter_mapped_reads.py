@@ -26,6 +26,7 @@ from hivwholeseq.sequencing.filter_mapped_reads import plot_distance_histogram,
 from hivwholeseq.patients.filenames import get_initial_reference_filename, \
         get_mapped_to_initial_filename, get_filter_mapped_init_summary_filename, \
         get_mapped_filtered_filename
+from hivwholeseq.patients.pipeline_manifest import is_step_up_to_date, record_step
 from hivwholeseq.utils.mapping import convert_sam_to_bam, pair_generator
 from hivwholeseq.cluster.fork_cluster import fork_filter_mapped_init as fork_self
 
@@ -284,6 +285,8 @@ if __name__ == '__main__':
                         help='Do not save results in a summary file')
     parser.add_argument('--PCR', default='1',
                         help='PCR to analyze (1, 2, or all)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip samples that are up to date in the pipeline manifest')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -294,6 +297,8 @@ if __name__ == '__main__':
     n_pairs = args.maxreads
     summary = args.summary
     PCR = args.PCR
+    incremental = args.incremental
+    params = {'maxreads': n_pairs}
 
     # Collect all sequenced samples from patients
     samples_pat = lssp()
@@ -339,7 +344,18 @@ if __name__ == '__main__':
         pname = sample_pat.patient
         PCR = int(PCR)
 
+        # The manifest needs the full patient sample
+        sample_manifest = SamplePat(sample_pat)
+        sample_manifest.samples_seq = samples_seq_group
+
         for fragment in fragments:
+            if incremental and is_step_up_to_date(sample_manifest, 'filter',
+                                                  fragment, PCR=PCR,
+                                                  params=params):
+                if VERBOSE:
+                    print samplename_pat, fragment, PCR, 'up to date'
+                continue
+
             if submit:
                 fork_self(samplename_pat, fragment,
                           VERBOSE=VERBOSE,
@@ -364,4 +380,7 @@ if __name__ == '__main__':
                                 VERBOSE=VERBOSE, maxreads=n_pairs,
                                 summary=summary)
 
+            record_step(sample_manifest, 'filter', fragment, PCR=PCR,
+                        params=params, VERBOSE=VERBOSE)
+
 
@@ -28,11 +28,13 @@ from hivwholeseq.patients.patients import load_patients, load_patient, Patient
 from hivwholeseq.patients.samples import SamplePat
 from hivwholeseq.utils.generic import mkdirs
 from hivwholeseq.utils.mapping import stampy_bin, subsrate, \
-        convert_sam_to_bam, convert_bam_to_sam, get_number_reads
+        convert_sam_to_bam, convert_bam_to_sam, get_number_reads, \
+        map_parts_local
 from hivwholeseq.patients.filenames import get_initial_index_filename, \
         get_initial_hash_filename, get_initial_reference_filename, \
         get_mapped_to_initial_filename, get_mapped_to_initial_foldername, \
         get_map_initial_summary_filename
+from hivwholeseq.patients.pipeline_manifest import is_step_up_to_date, record_step
 from hivwholeseq.cluster.fork_cluster import fork_map_to_initial_reference as fork_self
 from hivwholeseq.utils.clean_temp_files import remove_mapped_init_tempfiles
 from hivwholeseq.patients.patients import load_samples_sequenced as lssp
@@ -214,56 +216,55 @@ def map_stampy_singlethread(sample, fragment, VERBOSE=0, n_pairs=-1,
 
 def map_stampy_multithread(sample, fragment, VERBOSE=0, threads=2, summary=True,
                            filtered=True):
-    '''Map using stampy, multithread (via cluster requests, queueing race conditions possible)'''
-    import hivwholeseq
-    JOBDIR = hivwholeseq.__path__[0].rstrip('/')+'/'
-    JOBLOGOUT = JOBDIR+'logout/'
-    JOBLOGERR = JOBDIR+'logerr/'
-    cluster_time = ['23:59:59', '0:59:59']
-    vmem = '8G'
-
-    pname = patient.id
-    sample = patient.sample_table.loc[samplename]
-    seq_run = sample['run']
-    data_folder = MiSeq_runs[seq_run]['folder']
-    adaID = sample['adaID']
+    '''Map using stampy, multithread (local processes, merged by read name)'''
+    pname = sample.patient
+    samplename_pat = sample['patient sample']
+    samplename = sample.name
+    data_folder = sample.sequencing_run['folder']
+    adaID = sample['adapter']
+    PCR = int(sample.PCR)
 
     if VERBOSE:
-        print 'Map via stampy: '+pname+' '+samplename+' '+fragment
+        print 'Map via stampy ('+str(threads)+' threads): '+samplename+' '+fragment
 
     if summary:
-        summary_filename = get_map_initial_summary_filename(pname, samplename, fragment)
+        summary_filename = get_map_initial_summary_filename(pname, samplename_pat, 
+                                                            samplename, fragment,
+                                                            PCR=PCR)
 
     # Specific fragment (e.g. F5 --> F5bi)
-    frag_spec = filter(lambda x: fragment in x, sample['fragments'])
+    frag_spec = filter(lambda x: fragment in x, sample.regions_complete)
     if not len(frag_spec):
-        raise ValueError(str(patient)+', '+samplename+': fragment '+fragment+' not found.')
-    frag_spec = frag_spec[0]
+        if summary:
+            with open(summary_filename, 'a') as f:
+                f.write('Failed (specific fragment for '+fragment+'not found).\n')
+
+        raise ValueError(samplename+': fragment '+fragment+' not found.')
+    else:
+        frag_spec = frag_spec[0]
+
+    input_filename = get_input_filename(data_folder, adaID, frag_spec, type='bam',
+                                        filtered=filtered)
+
+    # NOTE: we introduced fragment nomenclature late, e.g. F3a. Check for that
+    if not os.path.isfile(input_filename):
+        if fragment == 'F3':
+            input_filename = input_filename.replace('F3a', 'F3')
 
-    input_filename = get_input_filename(data_folder, adaID, frag_spec, type='bam')
+    # Check existance of input file, because stampy creates output anyway
+    if not os.path.isfile(input_filename):
+        if summary:
+            with open(summary_filename, 'a') as f:
+                f.write('Failed (input file for mapping not found).\n')
+
+        raise ValueError(samplename+', fragment '+fragment+': input file not found.')
 
-    # Submit map scripts in parallel to the cluster
-    jobs_done = np.zeros(threads, bool)
-    job_IDs = np.zeros(threads, 'S30')
+    # Run the stampy parts as local processes, streaming their output into BAM
+    call_lists = []
     for j in xrange(threads):
-    
-        output_filename = get_mapped_to_initial_filename(pname, samplename,
-                                                         fragment,
-                                                         type='sam', part=(j+1))
-        # Map
-        call_list = ['qsub','-cwd',
-                     '-b', 'y',
-                     '-S', '/bin/bash',
-                     '-o', JOBLOGOUT,
-                     '-e', JOBLOGERR,
-                     '-N', 'm '+samplename+fragment+' p'+str(j+1),
-                     '-l', 'h_rt='+cluster_time[threads >= 10],
-                     '-l', 'h_vmem='+vmem,
-                     stampy_bin,
-                     '--overwrite',
+        call_list = [stampy_bin,
                      '-g', get_initial_index_filename(pname, fragment, ext=False),
                      '-h', get_initial_hash_filename(pname, fragment, ext=False),
-                     '-o', output_filename,
                      '--processpart='+str(j+1)+'/'+str(threads),
                      '--substitutionrate='+subsrate,
                      '--gapopen', stampy_gapopen,
@@ -271,92 +272,36 @@ def map_stampy_multithread(sample, fragment, VERBOSE=0, threads=2, summary=True,
         if stampy_sensitive:
             call_list.append('--sensitive')
         call_list = call_list + ['-M', input_filename]
+        call_lists.append(map(str, call_list))
 
-        call_list = map(str, call_list)
-        if VERBOSE >= 2:
-            print ' '.join(call_list)
-        job_ID = sp.check_output(call_list)
-        job_ID = job_ID.split()[2]
-        job_IDs[j] = job_ID
-
-    # Monitor output
-    output_file_parts = [get_mapped_to_initial_filename(pname, samplename,
-                                                        fragment,
-                                                        type='bam', part=(j+1))
+    output_file_parts = [get_mapped_to_initial_filename(pname, samplename_pat,
+                                                        samplename, fragment,
+                                                        type='bam', PCR=PCR,
+                                                        part=(j+1))
                          for j in xrange(threads)]
-    time_wait = 10 # secs
-    while not jobs_done.all():
-
-        # Sleep some time
-        time.sleep(time_wait)
-
-        # Get the output of qstat to check the status of jobs
-        qstat_output = sp.check_output(['qstat'])
-        qstat_output = qstat_output.split('\n')[:-1] # The last is an empty line
-        if len(qstat_output) < 3:
-            jobs_done[:] = True
-            break
-        else:
-            qstat_output = [line.split()[0] for line in qstat_output[2:]]
-
-        time_wait = 10 # secs
-        for j in xrange(threads):
-            if jobs_done[j]:
-                continue
+    output_filename = get_mapped_to_initial_filename(pname, samplename_pat,
+                                                     samplename, fragment,
+                                                     type='bam', PCR=PCR)
 
-            if job_IDs[j] not in qstat_output:
-                # Convert to BAM for merging
-                if VERBOSE >= 1:
-                    print 'Convert mapped reads to BAM for merging: sample '+\
-                           samplename+', part '+str(j+1)+ ' of '+ \
-                           str(threads)
-                convert_sam_to_bam(output_file_parts[j])
-                # We do not need to wait if we did the conversion (it takes
-                # longer than some secs)
-                time_wait = 0
-                jobs_done[j] = True
+    # Merge the parts sorted by read names (to ensure the pair_generator)
+    stats = map_parts_local(call_lists, output_file_parts, output_filename,
+                            threads=threads, VERBOSE=VERBOSE)
 
     if summary:
         with open(summary_filename, 'a') as f:
             f.write('Stampy mapped ('+str(threads)+' threads).\n')
-
-    # Concatenate output files
-    output_filename = get_mapped_to_initial_filename(pname, samplename,
-                                                     fragment,
-                                                     type='bam', unsorted=True)
-    if VERBOSE >= 1:
-        print 'Concatenate premapped reads: sample '+samplename
-    pysam.cat('-o', output_filename, *output_file_parts)
-    if summary:
-        with open(summary_filename, 'a') as f:
-            f.write('BAM files concatenated (unsorted).\n')
-
-    # Sort the file by read names (to ensure the pair_generator)
-    output_filename_sorted = get_mapped_to_initial_filename(pname, samplename,
-                                                            fragment,
-                                                            type='bam')
-    # NOTE: we exclude the extension and the option -f because of a bug in samtools
-    if VERBOSE >= 1:
-        print 'Sort mapped reads: sample '+samplename
-    pysam.sort('-n', output_filename, output_filename_sorted[:-4])
-    if summary:
-        with open(summary_filename, 'a') as f:
-            f.write('Joint BAM file sorted.\n')
-
-    # Reheader the file without BAM -> SAM -> BAM
-    if VERBOSE >= 1:
-        print 'Reheader mapped reads: sample '+samplename
-    header_filename = get_mapped_to_initial_filename(pname, samplename,
-                                                     fragment,
-                                                     type='sam', part=1)
-    pysam.reheader(header_filename, output_filename_sorted)
-    if summary:
-        with open(summary_filename, 'a') as f:
-            f.write('Joint BAM file reheaded.\n')
+            for stats_part in stats:
+                f.write('Part '+str(stats_part['part'])+': '+\
+                        str(stats_part['n_reads'])+' reads, '+\
+                        str(int(stats_part['end'] - stats_part['start']))+' secs\n')
+            f.write('BAM files merged (sorted by read name).\n')
 
     if VERBOSE >= 1:
         print 'Remove temporary files: sample '+samplename
-    remove_mapped_init_tempfiles(pname, samplename, fragment, VERBOSE=VERBOSE)
+    remove_mapped_init_tempfiles(pname, samplename_pat,
+                                 samplename, fragment,
+                                 PCR=PCR,
+                                 VERBOSE=VERBOSE)
     if summary:
         with open(summary_filename, 'a') as f:
             f.write('Temp mapping files removed.\n')
@@ -436,6 +381,8 @@ if __name__ == '__main__':
                         help='Only map some chunks (cluster optimization): 0 for automatic detection')
     parser.add_argument('--unfiltered', action='store_false', dest='filtered',
                         help='Map unfiltered reads (for quick checks only)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip samples that are up to date in the pipeline manifest')
     parser.add_argument('--include-contaminated', action='store_true',
                         help='Include majorly contaminated samples in the map')
 
@@ -452,6 +399,8 @@ if __name__ == '__main__':
     only_chunks = args.chunks
     filtered = args.filtered
     use_contaminated = args.include_contaminated
+    incremental = args.incremental
+    params = {'maxreads': n_pairs, 'filtered': filtered}
 
     # Collect all sequenced samples from patients
     samples_pat = lssp()
@@ -492,6 +441,10 @@ if __name__ == '__main__':
         PCR = int(sample.PCR)
         fragments_sample = sorted(set(sample.regions_generic) & set(fragments))
 
+        # The manifest tracks this sequenced sample only
+        sample_manifest = SamplePat(sample_pat)
+        sample_manifest.samples_seq = samples_seq.loc[[samplename]]
+
         if VERBOSE:
             print samplename, samplename_pat, pname, PCR
 
@@ -508,6 +461,13 @@ if __name__ == '__main__':
                 print 'WARNING: This sample has a suspected contamination! Skipping.'
                 continue
 
+            if incremental and (only_chunks == [None]) and \
+               is_step_up_to_date(sample_manifest, 'map', fragment, PCR=PCR,
+                                  params=params, filtered=filtered):
+                if VERBOSE:
+                    print 'Up to date'
+                continue
+
             if not skip_hash:
                 make_index_and_hash(pname, fragment, VERBOSE=VERBOSE)
     
@@ -565,3 +525,7 @@ if __name__ == '__main__':
                 map_stampy(sample, fragment,
                            VERBOSE=VERBOSE, threads=threads, n_pairs=n_pairs,
                            summary=summary, only_chunk=only_chunk, filtered=filtered)
+
+                if only_chunk is None:
+                    record_step(sample_manifest, 'map', fragment, PCR=PCR,
+                                params=params, filtered=filtered, VERBOSE=VERBOSE)
@@ -13,11 +13,14 @@ import numpy as np
 import pysam
 from Bio import SeqIO
 
+from hivwholeseq.utils.exceptions import PipelineError
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
 from hivwholeseq.patients.filenames import get_initial_reference_filename
+from hivwholeseq.patients.pipeline_manifest import is_step_up_to_date, record_step
 from hivwholeseq.utils.two_site_statistics import get_coallele_counts_from_file as gac
 from hivwholeseq.cluster.fork_cluster import fork_get_cocounts_patient as fork_self
+from hivwholeseq.cluster.executors import set_executor, wait_report
 
 
 
@@ -48,6 +51,12 @@ if __name__ == '__main__':
                         help='Minimal quality of base to call')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (1 or 2)')
+    parser.add_argument('--dense', action='store_true',
+                        help='Store dense compressed matrices instead of sparse ones')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip samples that are up to date in the pipeline manifest')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Run the tasks in this many local processes (implies --save)')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -60,6 +69,10 @@ if __name__ == '__main__':
     save_to_file = args.save
     qual_min = args.qualmin
     PCR = args.PCR
+    sparse = not args.dense
+    incremental = args.incremental
+    jobs = args.jobs
+    params = {'maxreads': maxreads}
 
     samples = lssp()
     if pnames is not None:
@@ -75,12 +88,31 @@ if __name__ == '__main__':
     if VERBOSE >= 3:
         print 'fragments', fragments
 
+    if jobs > 1:
+        set_executor('local', cores=jobs)
+        submit = True
+
     if submit:
+        jobids = []
+        labels = []
         for fragment in fragments:
             for samplename, sample in samples.iterrows():
-                fork_self(samplename, fragment, VERBOSE=VERBOSE,
-                          qual_min=qual_min, PCR=PCR,
-                          maxreads=maxreads, use_tests=use_tests)
+                if incremental and is_step_up_to_date(SamplePat(sample),
+                                                      'allele cocounts', fragment,
+                                                      PCR=PCR, qual_min=qual_min,
+                                                      params=params, sparse=sparse):
+                    continue
+
+                jobids.append(fork_self(samplename, fragment, VERBOSE=VERBOSE,
+                                        qual_min=qual_min, PCR=PCR,
+                                        maxreads=maxreads, use_tests=use_tests,
+                                        sparse=sparse))
+                labels.append(samplename+' '+fragment)
+
+        if jobs > 1:
+            failed = wait_report(jobids, labels, VERBOSE=VERBOSE)
+            if len(failed):
+                raise PipelineError('Allele cocounts failed for: '+', '.join(failed))
         sys.exit()
 
     counts_all = []
@@ -97,25 +129,47 @@ if __name__ == '__main__':
 
             fn_out = sample.get_allele_cocounts_filename(fragment, PCR=PCR,
                                                          qual_min=qual_min,
-                                                         compressed=True)
+                                                         compressed=True,
+                                                         sparse=sparse)
             fn = sample.get_mapped_filtered_filename(fragment, PCR=PCR,
                                                      decontaminated=True) #FIXME
-            if save_to_file:
+            if save_to_file and incremental and \
+               is_step_up_to_date(sample, 'allele cocounts', fragment, PCR=PCR,
+                                  qual_min=qual_min, params=params, sparse=sparse):
+                if VERBOSE >= 2:
+                    print 'Allele cocounts up to date:', samplename, fragment
+                counts.append(sample.get_allele_cocounts(fragment, PCR=PCR,
+                                                         qual_min=qual_min,
+                                                         sparse=sparse))
+
+            elif save_to_file:
                 cocount = gac(fn, len(refseq), 
                               maxreads=maxreads,
                               VERBOSE=VERBOSE,
                               qual_min=qual_min,
-                              use_tests=use_tests)
+                              use_tests=use_tests,
+                              sparse=sparse)
 
-                np.savez_compressed(fn_out, cocounts=cocount)
+                fn_tmp = fn_out[:-4]+'_tmp_'+str(os.getpid())+fn_out[-4:]
+                if sparse:
+                    cocount.save(fn_tmp)
+                else:
+                    np.savez_compressed(fn_tmp, cocounts=cocount)
+                os.rename(fn_tmp, fn_out)
 
                 if VERBOSE >= 2:
                     print 'Allele cocounts saved:', samplename, fragment
 
+                record_step(sample, 'allele cocounts', fragment, PCR=PCR,
+                            qual_min=qual_min, params=params, sparse=sparse,
+                            VERBOSE=VERBOSE)
+
                 counts.append(cocount)
 
             elif os.path.isfile(fn_out):
-                cocount = np.load(fn_out)['cocounts']
+                cocount = sample.get_allele_cocounts(fragment, PCR=PCR,
+                                                     qual_min=qual_min,
+                                                     sparse=sparse)
                 counts.append(cocount)
 
             elif os.path.isfile(fn):
@@ -123,5 +177,6 @@ if __name__ == '__main__':
                               maxreads=maxreads,
                               VERBOSE=VERBOSE,
                               qual_min=qual_min,
-                              use_tests=use_tests)
+                              use_tests=use_tests,
+                              sparse=sparse)
                 counts.append(cocount)
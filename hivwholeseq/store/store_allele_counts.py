@@ -14,13 +14,16 @@ import numpy as np
 from Bio import SeqIO
 
 from hivwholeseq.utils.argparse import PatientsAction
-from hivwholeseq.utils.exceptions import NoDataWarning
+from hivwholeseq.utils.exceptions import NoDataWarning, PipelineError
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.patients.trajectory_store import append_to_trajectory_store
+from hivwholeseq.patients.pipeline_manifest import is_step_up_to_date, record_step
 from hivwholeseq.patients.filenames import get_initial_reference_filename, \
         get_mapped_filtered_filename, get_allele_counts_filename
 from hivwholeseq.utils.one_site_statistics import get_allele_counts_insertions_from_file as gac
 from hivwholeseq.cluster.fork_cluster import fork_get_allele_counts_patient as fork_self 
+from hivwholeseq.cluster.executors import set_executor, wait_report
 
 
 
@@ -46,6 +49,10 @@ if __name__ == '__main__':
                         help='Minimal quality of base to call')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (e.g. 1)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip samples that are up to date in the pipeline manifest')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Run the tasks in this many local processes (implies --save)')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -56,6 +63,8 @@ if __name__ == '__main__':
     save_to_file = args.save
     qual_min = args.qualmin
     PCR = args.PCR
+    incremental = args.incremental
+    jobs = args.jobs
 
     samples = lssp()
     if pnames is not None:
@@ -71,11 +80,26 @@ if __name__ == '__main__':
     if VERBOSE >= 3:
         print 'fragments', fragments
 
+    if jobs > 1:
+        set_executor('local', cores=jobs)
+        submit = True
+    jobids = []
+    labels = []
+
     for fragment in fragments:
         counts = []
         for samplename, sample in samples.iterrows():
+            if incremental and is_step_up_to_date(SamplePat(sample),
+                                                  'allele counts', fragment,
+                                                  PCR=PCR, qual_min=qual_min):
+                if VERBOSE >= 1:
+                    print fragment, samplename, 'up to date'
+                continue
+
             if submit:
-                fork_self(samplename, fragment, VERBOSE=VERBOSE, qual_min=qual_min)
+                jobids.append(fork_self(samplename, fragment, VERBOSE=VERBOSE,
+                                        PCR=PCR, qual_min=qual_min))
+                labels.append(samplename+' '+fragment)
                 continue
 
             if VERBOSE >= 1:
@@ -96,7 +120,23 @@ if __name__ == '__main__':
             if save_to_file:
                 fn_out = sample.get_allele_counts_filename(fragment, PCR=PCR,
                                                            qual_min=qual_min)
-                count.dump(fn_out)
+                fn_tmp = fn_out[:-4]+'_tmp_'+str(os.getpid())+fn_out[-4:]
+                np.save(fn_tmp, count)
+                os.rename(fn_tmp, fn_out)
 
                 if VERBOSE >= 2:
                     print 'Allele counts saved:', samplename, fragment
+
+                record_step(sample, 'allele counts', fragment, PCR=PCR,
+                            qual_min=qual_min, VERBOSE=VERBOSE)
+
+                append_to_trajectory_store(pname, samplename, fragment,
+                                           counts=count, PCR=PCR,
+                                           time=sample['days since infection'],
+                                           qual_min=qual_min, filename=fn_out,
+                                           VERBOSE=VERBOSE)
+
+    if jobs > 1:
+        failed = wait_report(jobids, labels, VERBOSE=VERBOSE)
+        if len(failed):
+            raise PipelineError('Allele counts failed for: '+', '.join(failed))
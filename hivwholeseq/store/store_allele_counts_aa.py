@@ -13,12 +13,15 @@ import numpy as np
 from Bio import SeqIO
 
 from hivwholeseq.utils.argparse import PatientsAction
+from hivwholeseq.utils.exceptions import PipelineError
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.patients.trajectory_store import append_to_trajectory_store
 from hivwholeseq.patients.filenames import get_initial_reference_filename, \
         get_mapped_filtered_filename, get_allele_counts_filename
 from hivwholeseq.utils.one_site_statistics import get_allele_counts_aa_from_file as gac
 from hivwholeseq.cluster.fork_cluster import fork_get_allele_counts_aa_patient as fork_self 
+from hivwholeseq.cluster.executors import set_executor, wait_report
 
 
 
@@ -54,6 +57,8 @@ if __name__ == '__main__':
                         help='Minimal quality of base to call')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (e.g. 1)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Run the tasks in this many local processes (implies --save)')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -65,6 +70,7 @@ if __name__ == '__main__':
     qual_min = args.qualmin
     PCR = args.PCR
     use_plot = args.plot
+    jobs = args.jobs
 
     if use_plot:
         import matplotlib.pyplot as plt
@@ -78,12 +84,20 @@ if __name__ == '__main__':
     if VERBOSE >= 2:
         print 'samples', samples.index.tolist()
 
+    if jobs > 1:
+        set_executor('local', cores=jobs)
+        submit = True
+    jobids = []
+    labels = []
+
     counts_all = []
     for protein in proteins:
         counts = []
         for samplename, sample in samples.iterrows():
             if submit:
-                fork_self(samplename, protein, VERBOSE=VERBOSE, qual_min=qual_min)
+                jobids.append(fork_self(samplename, protein, VERBOSE=VERBOSE,
+                                        PCR=PCR, qual_min=qual_min))
+                labels.append(samplename+' '+protein)
                 continue
 
             if VERBOSE >= 1:
@@ -122,8 +136,8 @@ if __name__ == '__main__':
                     end_fr -= rf
                     end -= rf
                                
-                fn = sample.get_mapped_filtered_filename(fragment, PCR=PCR,
-                                                         decontaminated=True)
+                (fn, indexed) = sample.get_mapped_filtered_filename_region(fragment,
+                                                                           PCR=PCR)
                 
                 if not os.path.isfile(fn):
                     if VERBOSE >= 2:
@@ -133,7 +147,7 @@ if __name__ == '__main__':
                 if VERBOSE >= 2:
                     print 'Get allele counts for amino acids'
                 cou = gac(fn, start_fr, end_fr, qual_min=qual_min,
-                          VERBOSE=VERBOSE)
+                          VERBOSE=VERBOSE, indexed=indexed)
                 # We do not care about fwd/reverse
                 count[:, start // 3: end // 3] = cou.sum(axis=0)
 
@@ -142,7 +156,14 @@ if __name__ == '__main__':
             if save_to_file:
                 if VERBOSE >= 2:
                     print 'Save allele counts:', samplename, protein
-                count.dump(fn_out)
+                fn_tmp = fn_out[:-4]+'_tmp_'+str(os.getpid())+fn_out[-4:]
+                np.save(fn_tmp, count)
+                os.rename(fn_tmp, fn_out)
+                append_to_trajectory_store(sample.patient, samplename, protein,
+                                           counts=count, PCR=PCR,
+                                           time=sample['days since infection'],
+                                           type='aa', qual_min=qual_min,
+                                           filename=fn_out, VERBOSE=VERBOSE)
 
             if use_plot:
                 if VERBOSE >= 2:
@@ -163,6 +184,11 @@ if __name__ == '__main__':
                 ax.set_title(samplename)
 
 
+    if jobs > 1:
+        failed = wait_report(jobids, labels, VERBOSE=VERBOSE)
+        if len(failed):
+            raise PipelineError('Amino acid counts failed for: '+', '.join(failed))
+
     if use_plot:
         plt.ion()
         plt.show()
@@ -14,69 +14,56 @@ from hivwholeseq.utils.argparse import PatientsAction
 from hivwholeseq.utils.miseq import alpha, read_types
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.patients.trajectory_store import append_to_trajectory_store
 from hivwholeseq.patients.filenames import get_initial_reference_filename
+from hivwholeseq.patients.fragment_maps import load_fragment_maps
 
 
 
 # Functions
-def merge_allele_counts(ref_genomewide, acs, VERBOSE=0):
+def merge_allele_counts(ref_genomewide, acs, VERBOSE=0, maps=None):
     '''Merge the allele counts of all fragments
     
+    Parameters:
+       ref_genomewide (str or SeqRecord): genomewide reference
+       acs (list): (fragment, reference, allele counts) in genomic order
+       maps (dict): fragment to genomewide coordinate maps (see
+       patients/fragment_maps.py); computed from the references if None
+
     Note: we do not require full coverage of all fragments, the missing
           ones will just have zero counts. Sometimes, cherry-picking the data
           fragment by fragment might be a better choice.
     '''
     from hivwholeseq.utils.miseq import alpha, read_types
-    from seqanpy import align_overlap
+
+    if maps is None:
+        from hivwholeseq.patients.fragment_maps import build_fragment_maps
+        maps = build_fragment_maps(ref_genomewide,
+                                   [(fr, ref) for (fr, ref, _) in acs],
+                                   VERBOSE=VERBOSE)
 
     ac = np.zeros((len(read_types), len(alpha), len(ref_genomewide)), int)
 
-    pos_ref = 1000
+    # Genomewide position of every fragment position (gaps in genomewide are
+    # ignored FIXME: probably we should put deletions)
+    pos_gw = []
+    acs_fr = []
     for (fr, ref, acsi) in acs:
+        mapfr = maps[fr][:acsi.shape[-1]]
+        ind = (mapfr >= 0).nonzero()[0]
+        pos_gw.append(mapfr[ind])
+        acs_fr.append(acsi[:, :, ind])
 
-        # Find the coordinates
-        (score, ali1, ali2) = align_overlap(ref_genomewide[pos_ref - 1000:],
-                                            ref,
-                                            #score_gapopen=-20,
-                                           )
-        fr_start = len(ali2) - len(ali2.lstrip('-'))
-        fr_end = len(ali2.rstrip('-'))
-
-        if VERBOSE:
-            print fr, pos_ref - 1000 + fr_start, pos_ref - 1000 + fr_end
-
-        # Scan the alignment
-        pos_ref = pos_ref - 1000 + fr_start
-        fr_start_ref = pos_ref
-        fr_end_ref = pos_ref + fr_end - fr_start
-        pos_fr = 0
-        for pos_ali in xrange(fr_start, fr_end):
-            # Gap in genomewise, ignore position
-            if ali1[pos_ali] == '-':
-                pos_fr += 1
-                continue
-
-            # Gap in fragment, ignore FIXME: probably we should put deletions
-            elif ali2[pos_ali] == '-':
-                pos_ref += 1
-                continue
+        if VERBOSE >= 1:
+            print fr, pos_gw[-1][0], pos_gw[-1][-1] + 1
 
-            # Add the counts
-            # NOTE: all fragments are treated the same, even in case of coverage
-            # differences of orders of magnitude. This means, larger coverage
-            # always wins. Maybe we want to implement this somewhat differently
-            ac[:, :, pos_ref] += acsi[:, :, pos_fr]
-            pos_fr += 1
-            pos_ref += 1
-
-        if VERBOSE >= 3:
-            from hivwholeseq.utils.sequence import pretty_print_pairwise_ali
-            cons = alpha[ac.sum(axis=0).argmax(axis=0)]
-            pretty_print_pairwise_ali((ali1[fr_start: fr_end],
-                                       cons[fr_start: fr_end]),
-                                      name1='gw',
-                                      name2=fr,
-                                      width=100)
+    # Add the counts of all fragments and read types at once
+    # NOTE: all fragments are treated the same, even in case of coverage
+    # differences of orders of magnitude. This means, larger coverage
+    # always wins. Maybe we want to implement this somewhat differently
+    if len(pos_gw):
+        np.add.at(ac, (slice(None), slice(None), np.concatenate(pos_gw)),
+                  np.concatenate(acs_fr, axis=-1))
 
     return ac
 
@@ -140,9 +127,15 @@ if __name__ == '__main__':
             continue
 
         # Merge allele counts
-        ac = merge_allele_counts(conss_genomewide, acs, VERBOSE=VERBOSE)
+        ac = merge_allele_counts(conss_genomewide, acs, VERBOSE=VERBOSE,
+                                 maps=load_fragment_maps(pname, VERBOSE=VERBOSE))
         if save_to_file:
             fn_out = sample.get_allele_counts_filename('genomewide')
             np.save(fn_out, ac)
             if VERBOSE >= 1:
                 print 'Genomewide allele counts saved to:', fn_out
+
+            append_to_trajectory_store(pname, samplename, 'genomewide',
+                                       counts=ac, PCR=PCR,
+                                       time=sample['days since infection'],
+                                       filename=fn_out, VERBOSE=VERBOSE)
@@ -16,12 +16,50 @@ from Bio.Alphabet.IUPAC import ambiguous_dna
 
 from hivwholeseq.patients.patients import load_samples_sequenced, SamplePat
 from hivwholeseq.patients.filenames import get_initial_reference_filename
+from hivwholeseq.patients.pipeline_manifest import is_step_up_to_date, record_step
 from hivwholeseq.cluster.fork_cluster import fork_build_consensus_patient as fork_self
 
 
 
 # Function
-def pileup_trim_reads_coverfull(bamfile, edges, VERBOSE=0):
+def index_reads_by_position(bamfile, VERBOSE=0):
+    '''Index the reads of a BAM file by position in a single pass
+
+    Returns:
+       (starts, ends, offsets): arrays of the reference start and end of each
+       read and of its virtual offset in the file, sorted by start
+    '''
+    starts = []
+    ends = []
+    offsets = []
+    offset = bamfile.tell()
+    for read in bamfile:
+        starts.append(read.pos)
+        ends.append(read.pos + sum(bl for bt, bl in read.cigar if bt in (0, 2)))
+        offsets.append(offset)
+        offset = bamfile.tell()
+
+    starts = np.array(starts, int)
+    ends = np.array(ends, int)
+    offsets = np.array(offsets, np.int64)
+
+    ind = np.argsort(starts, kind='mergesort')
+    if VERBOSE >= 3:
+        print 'Reads indexed:', len(ind)
+
+    return (starts[ind], ends[ind], offsets[ind])
+
+
+def get_reads_from_offsets(bamfile, offsets):
+    '''Get reads from a BAM file by their virtual offsets'''
+    reads = []
+    for offset in np.sort(offsets):
+        bamfile.seek(offset)
+        reads.append(bamfile.next())
+    return reads
+
+
+def pileup_trim_reads_coverfull(reads, edges, VERBOSE=0):
     '''Collect reads that fully cover a region, and trim them to the same
     
     Note: this function does not look at the full read pair!
@@ -30,7 +68,7 @@ def pileup_trim_reads_coverfull(bamfile, edges, VERBOSE=0):
     block_len = edges[1] - edges[0]
 
     seqs = []
-    for read in bamfile:
+    for read in reads:
         start_read = end_read = read.pos
         if start_read > pos_ref:
             continue
@@ -71,12 +109,10 @@ def pileup_trim_reads_coverfull(bamfile, edges, VERBOSE=0):
         seq = read.seq[pos_read_start: pos_read_end]
         seqs.append(seq)
 
-    bamfile.reset()
-
     return seqs
 
 
-def pileup_trim_reads_coverstart(bamfile, start, VERBOSE=0):
+def pileup_trim_reads_coverstart(reads, start, VERBOSE=0):
     '''Collect reads that cover the start of a region, and trim them to the same
     
     Note: this function does not look at the full read pair!
@@ -84,7 +120,7 @@ def pileup_trim_reads_coverstart(bamfile, start, VERBOSE=0):
     pos_ref = start
 
     seqs = []
-    for read in bamfile:
+    for read in reads:
         start_read = end_read = read.pos
         if (start_read > pos_ref) or (start_read < pos_ref - 300):
             continue
@@ -117,8 +153,6 @@ def pileup_trim_reads_coverstart(bamfile, start, VERBOSE=0):
         
         seqs.append(seq)
 
-    bamfile.reset()
-
     return seqs
 
 
@@ -154,7 +188,11 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
                     block_len=100,
                     reads_per_alignment=31,
                     deltamax=60):
-    '''Build a consensus from mapped filtered reads'''
+    '''Build a consensus from mapped filtered reads
+
+    The reads are indexed by position in a single pass, then each block only
+    loads a random sample of the reads covering it.
+    '''
     if VERBOSE:
         print 'Build consensus'
     
@@ -171,30 +209,36 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
     
     with pysam.Samfile(bamfilename, 'rb') as bamfile:
 
+        if VERBOSE >= 2:
+            print 'Index reads by position'
+        (starts, ends, offsets) = index_reads_by_position(bamfile, VERBOSE=VERBOSE)
+        if not len(starts):
+            raise ValueError('No reads found')
+        span_max = (ends - starts).max()
+
         if VERBOSE >= 3:
-            from hivwholeseq.utils.mapping import get_number_reads_open
-            print 'The bamfile has', get_number_reads_open(bamfile), 'reads.'
+            print 'The bamfile has', len(starts), 'reads.'
 
         # Get first block covered, even if partially, and record where each read started
         if VERBOSE >= 2:
             print 'First block'
 
         block_len = block_len
-        seqs = []
+        ind = []
         n_block = 0
-        while not seqs:
+        while not len(ind):
             start_block = n_block * (block_len // 2)
-            for read in bamfile:
-                if read.pos <= start_block:
-                    seqs.append((read.pos, ('N' * read.pos) + read.seq[:block_len - read.pos]))
-            bamfile.reset()
+            ind = np.arange(np.searchsorted(starts, start_block, side='right'))
             n_block += 1
         
         # If there are too many reads, take the reads that start earliest
-        if len(seqs) > reads_per_alignment:
-            np.random.shuffle(seqs)
-            seqs.sort(key=itemgetter(0))
-            seqs = seqs[:reads_per_alignment]
+        if len(ind) > reads_per_alignment:
+            np.random.shuffle(ind)
+            ind = ind[np.argsort(starts[ind], kind='mergesort')]
+            ind = ind[:reads_per_alignment]
+
+        seqs = [(read.pos, ('N' * read.pos) + read.seq[:block_len - read.pos])
+                for read in get_reads_from_offsets(bamfile, offsets[ind])]
 
         seqrecs = [SeqRecord(Seq(s, ambiguous_dna), id=str(i), name=str(i))
                    for i, (pos, s) in enumerate(seqs)]
@@ -210,15 +254,21 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
             if VERBOSE >= 2:
                 print 'block n.', n_block, 'region:', edges
 
-            seqs = pileup_trim_reads_coverfull(bamfile, edges, VERBOSE=VERBOSE)
+            # Only reads starting within the longest read span can cover
+            ind = np.arange(np.searchsorted(starts, edges[1] - span_max, side='left'),
+                            np.searchsorted(starts, edges[0], side='right'))
+            ind = ind[ends[ind] >= edges[1]]
 
             # If we do not find reads that fully cover, consider it the end of
             # the consensus, only the final block is missing
-            if not seqs:
+            if not len(ind):
                 break
-            elif len(seqs) > reads_per_alignment:
-                np.random.shuffle(seqs)
-                seqs = seqs[:reads_per_alignment]
+            elif len(ind) > reads_per_alignment:
+                np.random.shuffle(ind)
+                ind = ind[:reads_per_alignment]
+
+            reads = get_reads_from_offsets(bamfile, offsets[ind])
+            seqs = pileup_trim_reads_coverfull(reads, edges, VERBOSE=VERBOSE)
 
             # Make local consensus using a multiple sequence alignment
             # --------------
@@ -246,7 +296,11 @@ def build_consensus(bamfilename, len_reference, VERBOSE=0,
             print 'final block'
 
         # If we broke out of the while, a final block is needed
-        seqs = pileup_trim_reads_coverstart(bamfile, start_block, VERBOSE=VERBOSE)
+        ind = np.arange(np.searchsorted(starts, start_block - 300, side='left'),
+                        np.searchsorted(starts, start_block, side='right'))
+        ind = ind[ends[ind] > start_block]
+        reads = get_reads_from_offsets(bamfile, offsets[ind])
+        seqs = pileup_trim_reads_coverstart(reads, start_block, VERBOSE=VERBOSE)
 
         # Sort reads by length
         if len(seqs) > reads_per_alignment:
@@ -299,6 +353,8 @@ if __name__ == '__main__':
                         help='Use non decontaminated reads')
     parser.add_argument('--deltamax', type=int, default=60,
                         help='Max score delta between subsequent local consensi')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip samples that are up to date in the pipeline manifest')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -312,6 +368,9 @@ if __name__ == '__main__':
     PCR = args.PCR
     use_raw_reads = args.raw
     deltamax = args.deltamax
+    incremental = args.incremental
+    params = {'block_len': block_len, 'reads_per_alignment': n_reads_per_ali,
+              'raw': use_raw_reads, 'deltamax': deltamax}
 
     samples = load_samples_sequenced()
     if pnames is not None:
@@ -336,6 +395,13 @@ if __name__ == '__main__':
                 if VERBOSE >= 2:
                     print ''
 
+            if incremental and is_step_up_to_date(SamplePat(sample), 'consensus',
+                                                  fragment, PCR=PCR,
+                                                  params=params):
+                if VERBOSE >= 1:
+                    print 'up to date'
+                continue
+
             if submit:
                 fork_self(samplename, fragment, VERBOSE=VERBOSE, PCR=PCR,
                           block_len=block_len, n_reads_per_ali=n_reads_per_ali)
@@ -390,5 +456,8 @@ if __name__ == '__main__':
                                    )
                 SeqIO.write(consrec, fn_out, 'fasta')
 
+                record_step(sample, 'consensus', fragment, PCR=PCR,
+                            params=params, VERBOSE=VERBOSE)
+
             if VERBOSE == 1:
                 print ''
@@ -18,12 +18,49 @@ import Bio.SeqIO as SeqIO
 from hivwholeseq.patients.patients import SamplePat
 from hivwholeseq.patients.patients import load_samples_sequenced as lssp
 from hivwholeseq.sequencing.check_overlaps import get_overlapping_fragments
+from hivwholeseq.patients.fragment_maps import load_fragment_maps
 
 
 
 # Functions
-def merge_fragments(sequences, name='', VERBOSE=0):
-    '''Merge references at overlapping pairs'''
+def get_overlap_lengths(maps):
+    '''Get the overlap lengths of consecutive fragments from their maps'''
+    lens = []
+    for i in xrange(5):
+        map1 = maps['F'+str(i+1)]
+        map2 = maps['F'+str(i+2)]
+        lens.append(map1[map1 >= 0].max() + 1 - map2[map2 >= 0].min())
+    return lens
+
+
+def align_ladder_window(seq1, seq2, len_overlap, margin=100, **kwargs):
+    '''Ladder alignment of the end of seq1 with the start of seq2 in a window
+
+    Only the last and first len_overlap + margin bases are aligned. If the
+    overlap reaches the window edges, the whole sequences are aligned instead.
+    '''
+    from seqanpy import align_ladder
+
+    w = len_overlap + margin
+    if (len_overlap > 0) and (w < min(len(seq1), len(seq2))):
+        (score, ali1, ali2) = align_ladder(seq1[-w:], seq2[:w], **kwargs)
+        start2 = len(ali2) - len(ali2.lstrip('-'))
+        end1 = len(ali1.rstrip('-'))
+        if (start2 > 0) and (end1 < len(ali1)):
+            ali1 = seq1[:-w] + ali1 + '-' * (len(seq2) - w)
+            ali2 = '-' * (len(seq1) - w) + ali2 + seq2[w:]
+            return (score, ali1, ali2)
+
+    return align_ladder(seq1, seq2, **kwargs)
+
+
+def merge_fragments(sequences, name='', VERBOSE=0, maps=None):
+    '''Merge references at overlapping pairs
+
+    Parameters:
+       maps (dict): fragment to genomewide coordinate maps of the patient (see
+       patients/fragment_maps.py), to align the overlaps only
+    '''
     from Bio.SeqRecord import SeqRecord
     from Bio.Seq import Seq
     from Bio.Alphabet.IUPAC import ambiguous_dna
@@ -31,11 +68,19 @@ def merge_fragments(sequences, name='', VERBOSE=0):
 
     from hivwholeseq.utils.sequence import pretty_print_pairwise_ali
 
+    if maps is not None:
+        lens_overlap = get_overlap_lengths(maps)
+
     consensus = []
     seq_old = ''.join(sequences['F1'])
     for i in xrange(5):
         seq_new = ''.join(sequences['F'+str(i+2)])
-        (score, ali1, ali2) = align_ladder(seq_old, seq_new, score_gapopen=-10)
+        if maps is not None:
+            (score, ali1, ali2) = align_ladder_window(seq_old, seq_new,
+                                                      lens_overlap[i],
+                                                      score_gapopen=-10)
+        else:
+            (score, ali1, ali2) = align_ladder(seq_old, seq_new, score_gapopen=-10)
 
         if VERBOSE >= 3:
             pretty_print_pairwise_ali([ali1, ali2], name1='F'+str(i+1), name2='F'+str(i+2))
@@ -142,7 +187,9 @@ if __name__ == '__main__':
             print 'ok: all 6 consensi found'
 
         consensus =  merge_fragments(consensi_pat, name=sample_pat.patient,
-                                     VERBOSE=VERBOSE)
+                                     VERBOSE=VERBOSE,
+                                     maps=load_fragment_maps(sample_pat.patient,
+                                                             VERBOSE=VERBOSE))
 
         if len(consensus) < 8800:
             print 'WARNING: the consensus looks too short!'
@@ -95,20 +95,19 @@ if __name__ == '__main__':
         ref = patient.get_reference('genomewide')
         L = len(ref)
 
+        # Collect all windows first, so that each BAM file is scanned once
+        windows = []
         win_start = start
         while win_start + width - gap < min(L, end):
             win_end = min(win_start + width, end, L)
+            windows.append((win_start, win_end))
+            win_start += gap
 
-            if VERBOSE >= 1:
-                print patient.code, win_start, win_end
-    
-            if VERBOSE >= 2:
-                print 'Get region haplotypes'
-            try:
-                datum = patient.get_local_haplotype_count_trajectories(\
+        if VERBOSE >= 2:
+            print 'Get region haplotypes'
+        data_windows = patient.get_local_haplotype_count_trajectories_windows(\
                                'genomewide',
-                               start=win_start,
-                               end=win_end,
+                               windows,
                                filters=['noN',
                                         'mincount='+str(countmin),
                                         'freqmin='+str(freqmin),
@@ -116,12 +115,16 @@ if __name__ == '__main__':
                                VERBOSE=VERBOSE,
                                align=True,
                                return_dict=True)
-            except RoiError:
-                win_start += gap
+
+        for (win_start, win_end), datum in zip(windows, data_windows):
+            if VERBOSE >= 1:
+                print patient.code, win_start, win_end
+
+            # No fragment fully covers the window
+            if datum is None:
                 continue
 
             if not len(datum['ind']):
-                win_start += gap
                 continue
 
             datum['times'] = patient.times[datum['ind']]
@@ -191,5 +194,3 @@ if __name__ == '__main__':
                 if VERBOSE >= 2:
                     print 'Plot'
                 plot_tree(tree, title=patient.code+', '+str(win_start)+'-'+str(win_end))
-
-            win_start += gap
@@ -14,22 +14,29 @@ import numpy as np
 from Bio import SeqIO
 
 from hivwholeseq.utils.argparse import PatientsAction
-from hivwholeseq.utils.exceptions import NoDataWarning
+from hivwholeseq.utils.exceptions import NoDataWarning, PipelineError
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.patients.trajectory_store import append_to_trajectory_store
 from hivwholeseq.patients.filenames import get_initial_reference_filename, \
         get_mapped_filtered_filename, get_insertions_filename
 from hivwholeseq.utils.one_site_statistics import get_allele_counts_insertions_from_file as gac
 from hivwholeseq.cluster.fork_cluster import fork_get_insertions_patient as fork_self 
+from hivwholeseq.cluster.executors import set_executor, wait_report
 
 
 
 # Functions
 def save_insertions(filename, insertions):
-    '''Save insertions to file'''
-    import cPickle as pickle
-    with open(filename, 'w') as f:
-        pickle.dump(insertions, f, protocol=-1)
+    '''Save insertions to file (columnar format if .npz, else pickled)'''
+    if filename[-4:] == '.npz':
+        from hivwholeseq.utils.one_site_statistics import InsertionTable
+        InsertionTable.from_counters(insertions).save(filename)
+
+    else:
+        import cPickle as pickle
+        with open(filename, 'w') as f:
+            pickle.dump(insertions, f, protocol=-1)
 
 
 
@@ -55,6 +62,8 @@ if __name__ == '__main__':
                         help='Minimal quality of base to call')
     parser.add_argument('--PCR', type=int, default=1,
                         help='Analyze only reads from this PCR (e.g. 1)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Run the tasks in this many local processes (implies --save)')
 
     args = parser.parse_args()
     pnames = args.patients
@@ -65,6 +74,7 @@ if __name__ == '__main__':
     save_to_file = args.save
     qual_min = args.qualmin
     PCR = args.PCR
+    jobs = args.jobs
 
     samples = lssp()
     if pnames is not None:
@@ -80,11 +90,19 @@ if __name__ == '__main__':
     if VERBOSE >= 3:
         print 'fragments', fragments
 
+    if jobs > 1:
+        set_executor('local', cores=jobs)
+        submit = True
+    jobids = []
+    labels = []
+
     for fragment in fragments:
         inses = []
         for samplename, sample in samples.iterrows():
             if submit:
-                fork_self(samplename, fragment, VERBOSE=VERBOSE, qual_min=qual_min)
+                jobids.append(fork_self(samplename, fragment, VERBOSE=VERBOSE,
+                                        PCR=PCR, qual_min=qual_min))
+                labels.append(samplename+' '+fragment)
                 continue
 
             if VERBOSE >= 1:
@@ -104,8 +122,22 @@ if __name__ == '__main__':
 
             if save_to_file:
                 fn_out = sample.get_insertions_filename(fragment, PCR=PCR,
-                                                        qual_min=qual_min)
-                save_insertions(fn_out, inse)
+                                                        qual_min=qual_min,
+                                                        format='npz')
+                fn_tmp = fn_out[:-4]+'_tmp_'+str(os.getpid())+fn_out[-4:]
+                save_insertions(fn_tmp, inse)
+                os.rename(fn_tmp, fn_out)
 
                 if VERBOSE >= 2:
                     print 'Insertions saved:', samplename, fragment
+
+                append_to_trajectory_store(pname, samplename, fragment,
+                                           insertions=inse, PCR=PCR,
+                                           time=sample['days since infection'],
+                                           qual_min=qual_min, filename=fn_out,
+                                           VERBOSE=VERBOSE)
+
+    if jobs > 1:
+        failed = wait_report(jobids, labels, VERBOSE=VERBOSE)
+        if len(failed):
+            raise PipelineError('Insertions failed for: '+', '.join(failed))
@@ -15,24 +15,39 @@ from hivwholeseq.utils.argparse import PatientsAction
 from hivwholeseq.utils.miseq import alpha, read_types
 from hivwholeseq.patients.samples import load_samples_sequenced as lssp
 from hivwholeseq.patients.samples import SamplePat
+from hivwholeseq.patients.trajectory_store import append_to_trajectory_store
 from hivwholeseq.patients.filenames import get_initial_reference_filename
 from hivwholeseq.utils.sequence import find_annotation
 from hivwholeseq.store.store_insertions import save_insertions
+from hivwholeseq.patients.fragment_maps import load_fragment_maps, get_insertion_map
 
 
 
 # Functions
-def merge_insertions(ics, VERBOSE=0):
-    '''Merge the insertions of all fragments'''
+def merge_insertions(ics, VERBOSE=0, maps=None):
+    '''Merge the insertions of all fragments
+
+    Parameters:
+       ics (dict): insertions of each fragment, keyed by (fragment, start)
+       maps (dict): fragment to genomewide coordinate maps (see
+       patients/fragment_maps.py); if None, positions are shifted by start
+    '''
     from collections import Counter
     ic = [Counter() for rt in read_types]
 
     for (fragment, start), icts in ics.iteritems():
         if VERBOSE >= 2:
             print fragment, start
+
+        if (maps is not None) and (fragment in maps):
+            mapins = get_insertion_map(maps[fragment])
+            convert = lambda pos: mapins[pos] if pos < len(mapins) else pos + start
+        else:
+            convert = lambda pos: pos + start
+
         for irt, ict in enumerate(icts):
             for (position, insertion), value in ict.iteritems():
-                ic[irt][(position + start, insertion)] += value
+                ic[irt][(int(convert(position)), insertion)] += value
 
     return ic
 
@@ -96,9 +111,15 @@ if __name__ == '__main__':
             continue
 
         # Merge insertions
-        ic = merge_insertions(ics, VERBOSE=VERBOSE)
+        ic = merge_insertions(ics, VERBOSE=VERBOSE,
+                              maps=load_fragment_maps(pname, VERBOSE=VERBOSE))
         if save_to_file:
-            fn_out = sample.get_insertions_filename('genomewide')
+            fn_out = sample.get_insertions_filename('genomewide', format='npz')
             save_insertions(fn_out, ic)
             if VERBOSE >= 1:
                 print 'Genomewide insertions saved to:', fn_out
+
+            append_to_trajectory_store(pname, samplename, 'genomewide',
+                                       insertions=ic, PCR=PCR,
+                                       time=sample['days since infection'],
+                                       filename=fn_out, VERBOSE=VERBOSE)
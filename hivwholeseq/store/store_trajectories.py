@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    Build the patient trajectory stores from the per-sample allele
+            count and insertion files.
+'''
+# Modules
+import os
+import argparse
+
+from hivwholeseq.utils.argparse import PatientsAction
+from hivwholeseq.patients.patients import load_patients, Patient
+from hivwholeseq.patients.trajectory_store import append_to_trajectory_store
+from hivwholeseq.patients.filenames import get_trajectory_store_foldername
+from hivwholeseq.patients.pipeline_manifest import is_step_up_to_date, record_step
+
+
+
+# Script
+if __name__ == '__main__':
+
+    # Parse input args
+    parser = argparse.ArgumentParser(description='Build trajectory stores',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)    
+    parser.add_argument('--patients', action=PatientsAction,
+                        help='Patients to analyze')
+    parser.add_argument('--regions', nargs='+',
+                        default=['F'+str(i) for i in xrange(1, 7)] + ['genomewide'],
+                        help='Fragments or genomewide to store')
+    parser.add_argument('--proteins', nargs='*', default=[],
+                        help='Proteins to store amino acid counts for (e.g. PR IN)')
+    parser.add_argument('--verbose', type=int, default=0,
+                        help='Verbosity level [0-3]')
+    parser.add_argument('--qualmin', type=int, default=30,
+                        help='Minimal quality of base to call')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip patients that are up to date in the pipeline manifest')
+
+    args = parser.parse_args()
+    pnames = args.patients
+    regions = args.regions
+    proteins = args.proteins
+    VERBOSE = args.verbose
+    qual_min = args.qualmin
+    incremental = args.incremental
+
+    patients = load_patients()
+    if pnames is not None:
+        patients = patients.loc[patients.index.isin(pnames)]
+
+    for pname, patient in patients.iterrows():
+        patient = Patient(patient)
+        if incremental and is_step_up_to_date(patient, 'trajectories',
+                                              qual_min=qual_min):
+            if VERBOSE >= 1:
+                print pname, 'up to date'
+            continue
+
+        if VERBOSE >= 1:
+            print pname
+
+        for sample in patient.itersamples():
+            time = sample['days since infection']
+            for PCR in (1, 2):
+                for region in regions:
+                    fn = sample.get_allele_counts_filename(region, PCR=PCR,
+                                                           qual_min=qual_min)
+                    if os.path.isfile(fn):
+                        append_to_trajectory_store(pname, sample.name, region,
+                                                   counts=sample.get_allele_counts(region, PCR=PCR,
+                                                                                   qual_min=qual_min,
+                                                                                   merge_read_types=False),
+                                                   PCR=PCR, time=time,
+                                                   qual_min=qual_min,
+                                                   filename=fn)
+
+                    fns = [sample.get_insertions_filename(region, PCR=PCR,
+                                                          qual_min=qual_min,
+                                                          format=format)
+                           for format in ('npz', 'pickle')]
+                    fns = filter(os.path.isfile, fns)
+                    if fns:
+                        append_to_trajectory_store(pname, sample.name, region,
+                                                   insertions=sample.get_insertions(region, PCR=PCR,
+                                                                                    qual_min=qual_min),
+                                                   PCR=PCR, time=time,
+                                                   qual_min=qual_min,
+                                                   filename=fns[0])
+
+                for protein in proteins:
+                    fn = sample.get_allele_counts_filename(protein, PCR=PCR,
+                                                           qual_min=qual_min,
+                                                           type='aa')
+                    if os.path.isfile(fn):
+                        append_to_trajectory_store(pname, sample.name, protein,
+                                                   counts=sample.get_allele_counts_aa(protein, PCR=PCR,
+                                                                                      qual_min=qual_min),
+                                                   PCR=PCR, time=time, type='aa',
+                                                   qual_min=qual_min,
+                                                   filename=fn)
+
+            if VERBOSE >= 2:
+                print sample.name
+
+        record_step(patient, 'trajectories', qual_min=qual_min, VERBOSE=VERBOSE)
+        if VERBOSE >= 1:
+            print 'Trajectory store saved:', get_trajectory_store_foldername(pname,
+                                                                            qual_min=qual_min)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# vim: fdm=marker
+'''
+date:       17/10/26
+content:    Recompute the stale targets of the patient pipeline, step by step
+            in dependency order, using the pipeline manifest. Each step is
+            submitted to the executor (cluster or local processes) and waited
+            for before the next one starts.
+'''
+# Modules
+import argparse
+
+from hivwholeseq.utils.argparse import PatientsAction
+from hivwholeseq.utils.exceptions import PipelineError
+from hivwholeseq.patients.patients import load_patients, Patient
+from hivwholeseq.patients.pipeline_manifest import plan_pipeline, step_names
+from hivwholeseq.cluster.executors import wait
+
+
+
+# Functions
+def submit_job(job, PCR=1, qual_min=30, VERBOSE=0):
+    '''Submit the job making a stale target
+
+    Returns:
+       jobid (str): the ID of the job for the executor
+    '''
+    from hivwholeseq.cluster import fork_cluster as fc
+
+    step = job['step']
+    sample = job['sample']
+    fragment = job['fragment']
+
+    if step == 'map':
+        from hivwholeseq.store.map_to_initial_reference import \
+                make_output_folders, make_index_and_hash
+        make_output_folders(sample.patient, sample.name, PCR=PCR, VERBOSE=VERBOSE)
+        make_index_and_hash(sample.patient, fragment, VERBOSE=VERBOSE)
+        return fc.fork_map_to_initial_reference(job['samplename_seq'], fragment,
+                                                VERBOSE=VERBOSE)
+
+    elif step == 'filter':
+        return fc.fork_filter_mapped_init(sample.name, fragment,
+                                          VERBOSE=VERBOSE, PCR=PCR)
+
+    elif step == 'decontaminate':
+        return fc.fork_decontaminate_reads_patient(sample.name, fragment,
+                                                   VERBOSE=VERBOSE, PCR=PCR)
+
+    elif step == 'consensus':
+        return fc.fork_build_consensus_patient(sample.name, fragment,
+                                               VERBOSE=VERBOSE, PCR=PCR)
+
+    elif step == 'allele counts':
+        return fc.fork_get_allele_counts_patient(sample.name, fragment,
+                                                 VERBOSE=VERBOSE, PCR=PCR,
+                                                 qual_min=qual_min)
+
+    elif step == 'allele cocounts':
+        return fc.fork_get_cocounts_patient(sample.name, fragment,
+                                            VERBOSE=VERBOSE, PCR=PCR,
+                                            qual_min=qual_min)
+
+    elif step == 'trajectories':
+        return fc.fork_store_trajectories(job['pname'], VERBOSE=VERBOSE,
+                                          qual_min=qual_min)
+
+
+
+# Script
+if __name__ == '__main__':
+
+    # Parse input args
+    parser = argparse.ArgumentParser(description='Update stale pipeline targets',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--patients', action=PatientsAction,
+                        help='Patients to analyze')
+    parser.add_argument('--steps', nargs='+', choices=step_names,
+                        default=step_names,
+                        help='Pipeline steps to update')
+    parser.add_argument('--fragments', nargs='+',
+                        help='Fragments to analyze (e.g. F1 F6)')
+    parser.add_argument('--PCR', type=int, default=1,
+                        help='Analyze only reads from this PCR (e.g. 1)')
+    parser.add_argument('--qualmin', type=int, default=30,
+                        help='Minimal quality of base to call')
+    parser.add_argument('--dry-run', action='store_true', dest='dry',
+                        help='Only print the stale targets')
+    parser.add_argument('--verbose', type=int, default=1,
+                        help='Verbosity level [0-3]')
+
+    args = parser.parse_args()
+    pnames = args.patients
+    steps = args.steps
+    fragments = args.fragments
+    PCR = args.PCR
+    qual_min = args.qualmin
+    dry_run = args.dry
+    VERBOSE = args.verbose
+
+    patients = load_patients()
+    if pnames is not None:
+        patients = patients.loc[patients.index.isin(pnames)]
+
+    plan = []
+    for pname, patient in patients.iterrows():
+        patient = Patient(patient)
+        patient.discard_nonsequenced_samples()
+        plan_pat = plan_pipeline(patient, steps=steps, fragments=fragments,
+                                 PCR=PCR, qual_min=qual_min, VERBOSE=VERBOSE)
+        for job in plan_pat:
+            job['pname'] = pname
+        plan.extend(plan_pat)
+
+    if VERBOSE >= 1:
+        print 'Stale targets:', len(plan)
+        for job in plan:
+            print '{:<16}'.format(job['step']), '{:<4}'.format(job['status']), \
+                    job['target']
+
+    if dry_run:
+        import sys
+        sys.exit()
+
+    # Steps run one after the other, the jobs within each step in parallel
+    for step in step_names:
+        jobs = [job for job in plan if job['step'] == step]
+        if not len(jobs):
+            continue
+
+        if VERBOSE >= 1:
+            print 'Step:', step, '('+str(len(jobs))+' jobs)'
+
+        jobids = [submit_job(job, PCR=PCR, qual_min=qual_min, VERBOSE=VERBOSE)
+                  for job in jobs]
+        exitcodes = wait(jobids)
+        failed = [job['target'] for job, jobid in zip(jobs, jobids)
+                  if exitcodes[jobid] != 0]
+        if len(failed):
+            raise PipelineError('Step '+step+' failed for: '+', '.join(failed))
@@ -0,0 +1,82 @@
+# vim: fdm=indent
+'''
+date:       17/10/26
+content:    Tests for the sparse matrix of allele cocounts.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import shutil
+import tempfile
+import numpy as np
+
+from hivwholeseq.utils.two_site_statistics import CocountMatrix
+
+
+
+# Tests
+class CocountMatrixTest(unittest.TestCase):
+    def setUp(self):
+        '''Symmetric cocounts of 12 sites, zero beyond a distance of 4'''
+        rng = np.random.RandomState(0)
+        (n_alpha, L, self.width) = (3, 12, 5)
+        counts = rng.randint(0, 300, size=(n_alpha, n_alpha, L, L))
+        counts = counts + counts.transpose(1, 0, 3, 2)
+        dist = np.abs(np.subtract.outer(np.arange(L), np.arange(L)))
+        counts[:, :, dist >= self.width] = 0
+        self.counts = counts
+        self.folder = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+    def test_from_dense(self):
+        '''The band width is inferred from the nonzero cocounts'''
+        cm = CocountMatrix.from_dense(self.counts)
+        self.assertEqual(cm.width, self.width)
+        self.assertEqual(cm.shape, self.counts.shape)
+        np.testing.assert_array_equal(cm.todense(), self.counts)
+
+
+    def test_save_load(self):
+        cm = CocountMatrix.from_dense(self.counts)
+        fn = os.path.join(self.folder, 'cocounts.npy')
+        cm.save(fn)
+        for mmap in (True, False):
+            cm_load = CocountMatrix.load(fn, mmap=mmap)
+            np.testing.assert_array_equal(cm_load.todense(), self.counts)
+            np.testing.assert_array_equal(cm_load.todense(3, 9),
+                                          self.counts[:, :, 3: 9, 3: 9])
+
+
+    def test_get_pair(self):
+        '''Pairs in both orders and beyond the band width'''
+        cm = CocountMatrix.from_dense(self.counts)
+        L = self.counts.shape[-1]
+        for pos1 in xrange(L):
+            for pos2 in xrange(L):
+                np.testing.assert_array_equal(cm.get_pair(pos1, pos2),
+                                              self.counts[:, :, pos1, pos2])
+
+
+    def test_narrow(self):
+        '''A narrower band drops the distant pairs'''
+        cm = CocountMatrix.from_dense(self.counts, width=2)
+        counts = self.counts.copy()
+        dist = np.abs(np.subtract.outer(np.arange(counts.shape[-1]),
+                                        np.arange(counts.shape[-1])))
+        counts[:, :, dist >= 2] = 0
+        np.testing.assert_array_equal(cm.todense(), counts)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# vim: fdm=indent
+'''
+date:       17/10/26
+content:    Tests for the decontamination of reads, with and without the k-mer
+            shortlist of the other consensi.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import shutil
+import tempfile
+import numpy as np
+import pysam
+
+from hivwholeseq.store.decontaminate_reads import filter_contamination, \
+        make_kmer_index, get_kmer_candidates
+
+
+
+# Tests
+class KmerShortlist(unittest.TestCase):
+    '''The k-mer shortlist agrees with aligning to all consensi'''
+    def setUp(self):
+        '''Consensi ~15% apart, reads from the own, other, or no consensus'''
+        rng = np.random.RandomState(0)
+        (L, n_cons, read_len) = (300, 8, 100)
+        base = rng.choice(list('ACGT'), L)
+        self.consensi = {}
+        for i in xrange(n_cons):
+            seq = base.copy()
+            ind = rng.rand(L) < 0.1
+            seq[ind] = rng.choice(list('ACGT'), ind.sum())
+            self.consensi['s'+str(i)] = ''.join(seq)
+
+        self.folder = tempfile.mkdtemp()
+        self.bamfilename = os.path.join(self.folder, 'reads.bam')
+        header = {'HD': {'VN': '1.0'}, 'SQ': [{'LN': L, 'SN': 'ref'}]}
+        with pysam.Samfile(self.bamfilename, 'wb', header=header) as bamfile:
+            for irp in xrange(30):
+                u = rng.rand()
+                if u < 0.4:
+                    source = 's0'
+                elif u < 0.8:
+                    source = 's'+str(rng.randint(1, n_cons))
+                else:
+                    source = None
+
+                for isread in (0, 1):
+                    pos = rng.randint(L - read_len)
+                    if source is not None:
+                        seq = np.array(list(self.consensi[source][pos: pos + read_len]))
+                    else:
+                        seq = rng.choice(list('ACGT'), read_len)
+                    ind = rng.rand(read_len) < 0.01
+                    seq[ind] = rng.choice(list('ACGT'), ind.sum())
+
+                    read = pysam.AlignedRead()
+                    read.qname = 'read'+str(irp)
+                    read.seq = ''.join(seq)
+                    read.qual = 'I' * read_len
+                    read.flag = 1 + (64 if isread == 0 else 128)
+                    read.tid = 0
+                    read.pos = pos
+                    read.mapq = 60
+                    read.cigar = [(0, read_len)]
+                    bamfile.write(read)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+    def get_readnames(self, bamfilename):
+        with pysam.Samfile(bamfilename, 'rb') as bamfile:
+            return [read.qname for read in bamfile]
+
+
+    def test_candidates(self):
+        '''The source of a read is the top candidate'''
+        kmer_index = make_kmer_index(self.consensi)
+        for name, seq in self.consensi.iteritems():
+            self.assertEqual(get_kmer_candidates(seq[50: 150], kmer_index,
+                                                 n_candidates=3)[0], name)
+        self.assertEqual(len(get_kmer_candidates(self.consensi['s1'], kmer_index,
+                                                 names=['s2', 's3'])), 2)
+
+
+    def test_agree(self):
+        fn_all = os.path.join(self.folder, 'decontaminated_all.bam')
+        fn_kmer = os.path.join(self.folder, 'decontaminated_kmer.bam')
+        kwargs = {'score_match': 3, 'score_mismatch': -3}
+
+        # The default is the exhaustive search
+        out_all = filter_contamination(self.bamfilename, fn_all, self.consensi,
+                                       's0', **kwargs)
+        out_kmer = filter_contamination(self.bamfilename, fn_kmer, self.consensi,
+                                        's0', n_candidates=2, **kwargs)
+
+        self.assertTrue(len(out_all[1]))
+        self.assertEqual(out_kmer, out_all)
+        for fns in ((fn_all, fn_kmer),
+                    (fn_all[:-4]+'_trashed.bam', fn_kmer[:-4]+'_trashed.bam')):
+            self.assertEqual(*map(self.get_readnames, fns))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# vim: fdm=indent
+'''
+date:       17/10/26
+content:    Tests for the approximate seed search in sequences.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import numpy as np
+
+from hivwholeseq.utils.sequence import get_seed_matches, find_seed, \
+        find_seed_hits, find_seed_imperfect, rfind_seed_imperfect
+
+
+
+# Tests
+class SeedMatches(unittest.TestCase):
+    def setUp(self):
+        self.seq = 'GATTACACCGATTGCA'
+
+
+    def test_all_offsets(self):
+        '''Counts agree with a naive scan, last offset included'''
+        seq = self.seq
+        seed = 'ATTGC'
+        (n_match, n_comparable) = get_seed_matches(seq, seed)
+        n_match_check = [sum(a == b for (a, b) in zip(seq[i: i + len(seed)], seed))
+                         for i in xrange(len(seq) - len(seed) + 1)]
+        np.testing.assert_array_equal(n_match, n_match_check)
+        self.assertEqual(n_comparable, len(seed))
+
+
+    def test_masked(self):
+        '''Ambiguous seed sites are not compared'''
+        (n_match, n_comparable) = get_seed_matches(self.seq, 'ATNRC')
+        self.assertEqual(n_comparable, 3)
+        self.assertEqual(n_match[1], 3)
+
+
+    def test_array(self):
+        '''Sequences can be passed as character arrays'''
+        seqm = np.fromstring(self.seq, 'S1')
+        np.testing.assert_array_equal(get_seed_matches(seqm, 'GATT')[0],
+                                      get_seed_matches(self.seq, 'GATT')[0])
+
+
+    def test_seed_too_long(self):
+        self.assertEqual(len(get_seed_matches('ACG', 'ACGT')[0]), 0)
+        self.assertRaises(ValueError, find_seed, 'ACG', 'ACGT')
+
+
+class FindSeed(unittest.TestCase):
+    def setUp(self):
+        self.seq = 'GATTACACCGATTGCA'
+
+
+    def test_left_right(self):
+        '''Ties go to the leftmost or rightmost match'''
+        self.assertEqual(find_seed(self.seq, 'GATT'), (0, 4, 4))
+        self.assertEqual(find_seed(self.seq, 'GATT', from_right=True), (9, 4, 4))
+
+
+    def test_hits(self):
+        '''Hits above threshold, best first'''
+        hits = find_seed_hits(self.seq, 'GATTA', threshold=0.6)
+        self.assertEqual(list(hits), [0, 9])
+
+
+    def test_imperfect(self):
+        seq = self.seq
+        self.assertEqual(find_seed_imperfect(seq, 'CCGTTT'), 7)
+        self.assertEqual(rfind_seed_imperfect(seq, 'GATA'), 9)
+        self.assertRaises(ValueError, find_seed_imperfect, seq, 'TTTTTT')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
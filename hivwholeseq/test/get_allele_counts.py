@@ -15,7 +15,7 @@ from collections import defaultdict, Counter
 import numpy as np
 
 from miseq import alphal
-from one_site_statistics import get_allele_counts_read
+from one_site_statistics import get_allele_counts_read, get_allele_counts_reads
 
 from test.utils import Read
 
@@ -38,6 +38,13 @@ class TestAlleleCounts(unittest.TestCase):
         read.cigar = [(1, 3), (0, len(read.seq) - 3)]
         self.reads.append(read)
 
+        # Read with a deletion and an insertion, read2 reverse
+        read = Read('AAAGGGTTTCCC', pos=3,
+                    qname='delins',
+                    is_read2=True, is_reverse=True)
+        read.cigar = [(0, 4), (2, 2), (0, 3), (1, 2), (0, 3)]
+        self.reads.append(read)
+
         # TODO: add more complex cases
 
         self.readsdict = {read.qname: read for read in self.reads}
@@ -79,6 +86,27 @@ class TestAlleleCounts(unittest.TestCase):
         np.testing.assert_array_equal(counts, counts_check)
 
 
+    def test_chunk(self):
+        '''Test allele counts from a chunk of reads against single reads'''
+        length = max(len(read.seq) + read.pos + 3 for read in self.reads)
+        counts = np.zeros((4, len(alphal), length), int)
+        inserts = [Counter() for i in xrange(4)]
+
+        # Expected result
+        counts_check = counts.copy()
+        inserts_check = [Counter() for i in xrange(4)]
+        for read in self.reads:
+            js = 2 * read.is_read2 + read.is_reverse
+            get_allele_counts_read(read, counts_check[js], inserts_check[js])
+
+        # Call the function
+        get_allele_counts_reads(self.reads, counts, inserts)
+
+        # Equality test (they are ints)
+        np.testing.assert_array_equal(counts, counts_check)
+        self.assertEqual(inserts, inserts_check)
+
+
 #TODO: write a test class for the filtering function in /patients, because it
 # has a bug with reads that start before the fragment start
 
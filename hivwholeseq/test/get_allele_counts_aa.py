@@ -17,7 +17,8 @@ from collections import defaultdict, Counter
 import numpy as np
 
 from hivwholeseq.utils.sequence import alphaal
-from hivwholeseq.utils.one_site_statistics import get_allele_counts_aa_read
+from hivwholeseq.utils.one_site_statistics import get_allele_counts_aa_read, \
+        get_allele_counts_aa_reads
 
 from hivwholeseq.test.utils import Read
 
@@ -179,6 +180,46 @@ class Indel1(unittest.TestCase):
 
 
 
+class Chunk(unittest.TestCase):
+    def setUp(self):
+        self.reads = []
+
+        read = Read('AAAGGGTTTCCC', pos=1)
+        self.reads.append(read)
+
+        read = Read('AAAGGGTTTCCC', pos=1, is_read2=True)
+        read.cigar = [(0, 3), (1, 2), (0, 7)]
+        self.reads.append(read)
+
+        read = Read('AAAGGGTTTCCC', pos=1, is_reverse=True)
+        read.cigar = [(0, 2), (1, 2), (2, 5), (0, 8)]
+        self.reads.append(read)
+
+        # Read with an ambiguous codon and a low-quality codon
+        read = Read('AANGGGTTTCCCTAA', pos=4, is_read2=True, is_reverse=True,
+                    qual='GGGGGGG#GGGGGGG')
+        self.reads.append(read)
+
+
+    def test(self):
+        '''Test amino acid counts from a chunk of reads against single reads'''
+        for start in (0, 1, 2):
+            counts = np.zeros((4, len(alphaal), 10), int)
+
+            # Expected result
+            counts_check = counts.copy()
+            for read in self.reads:
+                js = 2 * read.is_read2 + read.is_reverse
+                get_allele_counts_aa_read(read, start, start + 30, counts_check[js])
+
+            # Call the function
+            get_allele_counts_aa_reads(self.reads, start, start + 30, counts)
+
+            # Equality test (they are ints)
+            np.testing.assert_array_equal(counts, counts_check)
+
+
+
 if __name__ == '__main__':
     unittest.main()
 
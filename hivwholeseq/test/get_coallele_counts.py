@@ -0,0 +1,113 @@
+# vim: fdm=indent
+'''
+date:       17/10/26
+content:    Tests for the allele calls of read pairs and their cocounts.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import numpy as np
+
+from hivwholeseq.utils.miseq import alpha, alphal
+from hivwholeseq.utils.two_site_statistics import CocountMatrix, \
+        get_coallele_calls_pairs, add_coallele_counts_calls
+from hivwholeseq.test.utils import Read
+
+
+
+# Tests
+class CoalleleCounts(unittest.TestCase):
+    '''Qualities: I = 40, A = 32, ? = 30, 5 = 20 (qual_min is 30)'''
+    def setUp(self):
+        self.L = 20
+        self.read_pairs = []
+        self.calls = []
+
+        # Insertion in read1
+        self.read_pairs.append((Read('ACGTTACG', pos=2,
+                                     cigar=[(0, 3), (1, 2), (0, 3)]),
+                                Read('GGCCA', pos=12)))
+        self.calls.append({2: 'A', 3: 'C', 4: 'G', 5: 'A', 6: 'C', 7: 'G',
+                           12: 'G', 13: 'G', 14: 'C', 15: 'C', 16: 'A'})
+
+        # Deletion in read1, low-quality deletion and base in read2
+        self.read_pairs.append((Read('ACGTAC', pos=0,
+                                     cigar=[(0, 3), (2, 2), (0, 3)]),
+                                Read('ACGTAC', pos=10, qual='III5II',
+                                     cigar=[(0, 3), (2, 1), (0, 3)])))
+        self.calls.append({0: 'A', 1: 'C', 2: 'G', 3: '-', 4: '-',
+                           5: 'T', 6: 'A', 7: 'C',
+                           10: 'A', 11: 'C', 12: 'G', 15: 'A', 16: 'C'})
+
+        # Mate overlap with mismatching calls: a tie goes to read1, else the
+        # highest quality wins, low-quality calls never do
+        self.read_pairs.append((Read('AAAGAA', pos=4, qual='IIII5A'),
+                                Read('ATCCGG', pos=6, qual='II?III')))
+        self.calls.append({4: 'A', 5: 'A', 6: 'A', 7: 'G', 8: 'C', 9: 'C',
+                           10: 'G', 11: 'G'})
+
+        # Low-quality bases on both mates, covered by the other one
+        self.read_pairs.append((Read('ACGTN', pos=14, qual='I5III'),
+                                Read('TGA', pos=15, qual='I5I')))
+        self.calls.append({14: 'A', 15: 'T', 16: 'G', 17: 'T', 18: 'N'})
+
+
+    def get_counts_check(self):
+        '''Dense cocounts from the hand-computed calls'''
+        counts = np.zeros((len(alpha), len(alpha), self.L, self.L), int)
+        for calls in self.calls:
+            for pos1, a1 in calls.iteritems():
+                for pos2, a2 in calls.iteritems():
+                    counts[alphal.index(a1), alphal.index(a2), pos1, pos2] += 1
+        return counts
+
+
+    def test_calls(self):
+        '''Calls match the hand-computed ones, also one pair at a time'''
+        (ipair, pos, aind) = get_coallele_calls_pairs(self.read_pairs)
+        for i, calls in enumerate(self.calls):
+            ind = ipair == i
+            self.assertEqual(dict(zip(pos[ind], [alphal[a] for a in aind[ind]])),
+                             calls)
+            self.assertEqual(list(pos[ind]), sorted(calls))
+
+            (ipair_one, pos_one, aind_one) = get_coallele_calls_pairs([self.read_pairs[i]])
+            np.testing.assert_array_equal(ipair_one, 0)
+            np.testing.assert_array_equal(pos_one, pos[ind])
+            np.testing.assert_array_equal(aind_one, aind[ind])
+
+
+    def test_dense(self):
+        '''Dense cocounts match the hand-computed calls, in any batch size'''
+        counts_check = self.get_counts_check()
+        (ipair, pos, aind) = get_coallele_calls_pairs(self.read_pairs)
+        for maxcombos in (10000000, 150, 1):
+            counts = np.zeros_like(counts_check)
+            add_coallele_counts_calls(counts, ipair, pos, aind,
+                                      maxcombos=maxcombos)
+            np.testing.assert_array_equal(counts, counts_check)
+
+
+    def test_sparse(self):
+        '''The sparse band matches the band of the dense cocounts'''
+        counts_check = self.get_counts_check()
+        (ipair, pos, aind) = get_coallele_calls_pairs(self.read_pairs)
+        dist = np.abs(np.subtract.outer(np.arange(self.L), np.arange(self.L)))
+        for width in (1, 5, self.L):
+            band = np.zeros((self.L, width, len(alpha), len(alpha)), int)
+            add_coallele_counts_calls(band, ipair, pos, aind, sparse=True,
+                                      maxcombos=150)
+            counts = counts_check.copy()
+            counts[:, :, dist >= width] = 0
+            np.testing.assert_array_equal(CocountMatrix(band).todense(), counts)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
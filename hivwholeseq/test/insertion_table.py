@@ -0,0 +1,104 @@
+# vim: fdm=indent
+'''
+date:       17/10/26
+content:    Tests for the columnar table of insertions.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import shutil
+import tempfile
+from collections import Counter
+import numpy as np
+
+from hivwholeseq.utils.one_site_statistics import InsertionTable
+
+
+
+# Functions
+def filter_insertions_counters(inse, start, end, merge_read_types=True):
+    '''Region filter on the pickled Counters, as done before the table'''
+    inse_new = []
+    for ins in inse:
+        ins_new = Counter()
+        for (pos, ins_string), value in ins.iteritems():
+            if (start <= pos < end):
+                ins_new[(pos - start, ins_string)] = value
+        inse_new.append(ins_new)
+    inse = inse_new
+
+    if merge_read_types:
+        inse = sum(inse, Counter())
+    return inse
+
+
+
+# Tests
+class InsertionTableTest(unittest.TestCase):
+    def setUp(self):
+        '''Random insertions, four read types'''
+        rng = np.random.RandomState(0)
+        seqs = ['A', 'C', 'AG', 'TTA', 'GC']
+        self.inse = []
+        for i in xrange(4):
+            ins = Counter()
+            for j in xrange(60):
+                ins[(rng.randint(500), seqs[rng.randint(len(seqs))])] += rng.randint(1, 10)
+            self.inse.append(ins)
+        self.folder = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+    def test_round_trip(self):
+        table = InsertionTable.from_counters(self.inse)
+        self.assertEqual(table.to_counters(merge_read_types=False), self.inse)
+        self.assertEqual(table.to_counters(), sum(self.inse, Counter()))
+
+
+    def test_save_load(self):
+        table = InsertionTable.from_counters(self.inse)
+        fn = os.path.join(self.folder, 'insertions.npz')
+        table.save(fn)
+        table_load = InsertionTable.load(fn)
+        self.assertEqual(len(table_load), len(table))
+        self.assertEqual(table_load.to_counters(merge_read_types=False), self.inse)
+
+
+    def test_region(self):
+        '''Region queries agree with the filtering of the Counters'''
+        fn = os.path.join(self.folder, 'insertions.npz')
+        InsertionTable.from_counters(self.inse).save(fn)
+        table = InsertionTable.load(fn)
+        for (start, end) in ((0, 500), (100, 250), (0, 1), (499, 800), (300, 300)):
+            for merge_read_types in (True, False):
+                region = table.get_region(start, end)
+                if merge_read_types:
+                    region = region.merge_read_types()
+                self.assertEqual(region.to_counters(merge_read_types=merge_read_types),
+                                 filter_insertions_counters(self.inse, start, end,
+                                                            merge_read_types=merge_read_types))
+
+
+    def test_empty(self):
+        fn = os.path.join(self.folder, 'insertions.npz')
+        table = InsertionTable.from_counters([Counter(), Counter()])
+        self.assertEqual(len(table), 0)
+        table.save(fn)
+        table = InsertionTable.load(fn)
+        self.assertEqual(table.get_region(0, 100).to_counters(), Counter())
+        self.assertEqual(table.to_counters(merge_read_types=False),
+                         [Counter(), Counter()])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# vim: fdm=indent
+'''
+date:       17/10/26
+content:    Tests for the staleness checks of the patient pipeline manifest.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import shutil
+import tempfile
+
+import hivwholeseq.patients.filenames as pfilenames
+from hivwholeseq.patients.pipeline_manifest import PipelineManifest
+
+
+
+# Tests
+class TargetStatus(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.get_filename = pfilenames.get_pipeline_manifest_filename
+        folder = self.folder
+        def get_pipeline_manifest_filename(pname):
+            return os.path.join(folder, pname+'_manifest.json')
+        pfilenames.get_pipeline_manifest_filename = get_pipeline_manifest_filename
+
+        self.inputs = [self.write('input1', 'ACGT'), self.write('input2', 'TTTT')]
+        self.target = os.path.join(self.folder, 'target')
+
+
+    def tearDown(self):
+        pfilenames.get_pipeline_manifest_filename = self.get_filename
+        shutil.rmtree(self.folder)
+
+
+    def write(self, name, content, mtime=None):
+        fn = os.path.join(self.folder, name)
+        with open(fn, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(fn, (mtime, mtime))
+        return fn
+
+
+    def test_missing(self):
+        manifest = PipelineManifest('p1')
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs), 'MISS')
+        manifest.record(self.inputs[0], 'map', [])
+        os.remove(self.inputs[0])
+        self.assertEqual(manifest.get_target_status(self.inputs[0], []), 'MISS')
+
+
+    def test_mtime_fallback(self):
+        '''Targets not in the manifest are OK if newer than their inputs'''
+        manifest = PipelineManifest('p1')
+        for fn in self.inputs:
+            os.utime(fn, (1000, 1000))
+        self.write('target', 'result', mtime=2000)
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs), 'OK')
+
+        # Missing inputs are ignored
+        inputs = self.inputs + [os.path.join(self.folder, 'missing')]
+        self.assertEqual(manifest.get_target_status(self.target, inputs), 'OK')
+
+        os.utime(self.inputs[1], (3000, 3000))
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs), 'OLD')
+
+
+    def test_recorded(self):
+        '''Recorded targets are checked by content, not by modification time'''
+        self.write('target', 'result')
+        manifest = PipelineManifest('p1')
+        manifest.record(self.target, 'filter', self.inputs, params={'a': (1, 2)})
+        manifest.save()
+
+        manifest = PipelineManifest('p1')
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs,
+                                                    params={'a': (1, 2)}), 'OK')
+
+        # Touching an input without changing it
+        os.utime(self.inputs[0], (5000, 5000))
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs), 'OK')
+
+        # Parameters
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs,
+                                                    params={'a': (1, 3)}), 'OLD')
+
+        # Content of an input (same size, so the modification time tells)
+        self.write('input2', 'TTTA', mtime=6000)
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs), 'OLD')
+        self.write('input2', 'TTTT', mtime=7000)
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs), 'OK')
+
+        # Content of the target
+        self.write('target', 'edited', mtime=8000)
+        self.assertEqual(manifest.get_target_status(self.target, self.inputs), 'OLD')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# vim: fdm=indent
+'''
+date:       17/10/26
+content:    Tests for the single-pass random subsampling of reads.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import shutil
+import tempfile
+import numpy as np
+import pysam
+
+from hivwholeseq.utils.mapping import reservoir_sample, load_read_count, \
+        extract_mapped_reads_subsample_open
+
+
+
+# Tests
+class ReservoirSample(unittest.TestCase):
+    def test_size_order(self):
+        '''Exact size, distinct items in the order of the iterable'''
+        for n in (1, 7, 100):
+            sample = reservoir_sample(xrange(1000), n, seed=n)
+            self.assertEqual(len(sample), n)
+            self.assertEqual(sample, sorted(set(sample)))
+
+
+    def test_seed(self):
+        '''The same seed gives the same sample, a generator works too'''
+        sample = reservoir_sample(iter(xrange(1000)), 20, seed=42)
+        self.assertEqual(sample, reservoir_sample(xrange(1000), 20, seed=42))
+        self.assertEqual(sample, reservoir_sample(xrange(1000), 20,
+                                                  seed=np.random.RandomState(42)))
+        self.assertNotEqual(sample, reservoir_sample(xrange(1000), 20, seed=43))
+
+
+    def test_few_items(self):
+        '''With no more items than n, all of them are returned'''
+        self.assertEqual(reservoir_sample(xrange(10), 10, seed=0), range(10))
+        self.assertEqual(reservoir_sample(xrange(10), 50, seed=0), range(10))
+        self.assertEqual(reservoir_sample([], 5, seed=0), [])
+        self.assertEqual(reservoir_sample(xrange(10), 0, seed=0), [])
+
+
+    def test_maxitems(self):
+        (sample, n_items) = reservoir_sample(xrange(1000), 20, maxitems=100,
+                                             seed=0, full_output=True)
+        self.assertEqual(n_items, 100)
+        self.assertTrue(max(sample) < 100)
+        self.assertEqual(reservoir_sample(xrange(1000), 20, seed=0,
+                                          full_output=True)[1], 1000)
+
+
+    def test_uniform(self):
+        '''Every item is picked with probability n / N'''
+        rng = np.random.RandomState(0)
+        (N, n, n_rep) = (20, 5, 4000)
+        hits = np.zeros(N, int)
+        for i in xrange(n_rep):
+            hits[reservoir_sample(xrange(N), n, seed=rng)] += 1
+        freqs = 1.0 * hits / n_rep
+        # Binomial standard error is ~0.007, the tolerance is ~6 of them
+        self.assertTrue(np.abs(freqs - 1.0 * n / N).max() < 0.04)
+
+
+
+class ReadCountSidecar(unittest.TestCase):
+    '''The sidecar of a subsampled file has the exact number of reads'''
+    def setUp(self):
+        '''Three read pairs and an unpaired read at the end'''
+        self.folder = tempfile.mkdtemp()
+        self.bamfilename = os.path.join(self.folder, 'reads.bam')
+        header = {'HD': {'VN': '1.0'}, 'SQ': [{'LN': 100, 'SN': 'ref'}]}
+        with pysam.Samfile(self.bamfilename, 'wb', header=header) as bamfile:
+            for ir in xrange(7):
+                read = pysam.AlignedRead()
+                read.qname = 'read'+str(ir // 2)
+                read.seq = 'ACGTACGTAC'
+                read.qual = 'I' * 10
+                read.flag = 1 + (64 if ir % 2 == 0 else 128)
+                read.tid = 0
+                read.pos = ir
+                read.mapq = 60
+                read.cigar = [(0, 10)]
+                bamfile.write(read)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+    def test_pairs(self):
+        '''A pass over pairs does not save the count'''
+        with pysam.Samfile(self.bamfilename, 'rb') as bamfile:
+            pairs = extract_mapped_reads_subsample_open(bamfile, 2, pairs=True,
+                                                        seed=0, sidecar=True)
+        self.assertEqual(len(pairs), 2)
+        self.assertIsNone(load_read_count(self.bamfilename))
+
+
+    def test_reads(self):
+        '''A pass over single reads saves the count, and small files are
+        then read without sampling'''
+        with pysam.Samfile(self.bamfilename, 'rb') as bamfile:
+            reads = extract_mapped_reads_subsample_open(bamfile, 2, pairs=False,
+                                                        seed=0, sidecar=True)
+            self.assertEqual(len(reads), 2)
+            self.assertEqual(load_read_count(self.bamfilename), 7)
+
+            pairs = list(extract_mapped_reads_subsample_open(bamfile, 3,
+                                                             pairs=True, seed=0,
+                                                             sidecar=True))
+            self.assertEqual(len(pairs), 3)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+# vim: fdm=indent
+'''
+date:       17/10/26
+content:    Tests for the patient trajectory store.
+'''
+# Modules
+# NOTE: in theory this is not necessary?
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir,
+                                                os.pardir)))
+
+
+import unittest
+import shutil
+import tempfile
+from collections import Counter
+import numpy as np
+
+import hivwholeseq.patients.filenames as pfilenames
+from hivwholeseq.utils.miseq import alpha
+from hivwholeseq.patients.trajectory_store import TrajectoryStore, \
+        load_trajectory_store, append_to_trajectory_store, append_rows_npy
+from hivwholeseq.patients.one_site_statistics import \
+        get_allele_count_trajectories, get_allele_count_trajectories_aa
+
+
+
+# Tests
+class TrajectoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.get_filename = pfilenames.get_trajectory_store_filename
+        folder = self.folder
+        def get_trajectory_store_filename(pname, qual_min=30):
+            return os.path.join(folder, pname, 'index.json')
+        pfilenames.get_trajectory_store_filename = get_trajectory_store_filename
+
+        rng = np.random.RandomState(0)
+        self.counts = dict((sn, rng.randint(0, 100, size=(2, len(alpha), 10)))
+                           for sn in ('s1', 's2', 's3'))
+
+
+    def tearDown(self):
+        pfilenames.get_trajectory_store_filename = self.get_filename
+        shutil.rmtree(self.folder)
+
+
+    def test_add_counts(self):
+        '''Samples are sorted by time and read types are summed'''
+        store = TrajectoryStore('p1')
+        self.assertFalse(store.has_group('F1'))
+        for (sn, time) in (('s2', 20), ('s1', 10), ('s3', np.nan)):
+            store.add_counts('F1', sn, self.counts[sn], time=time)
+        self.assertTrue(store.has_group('F1'))
+        self.assertFalse(store.has_group('F1', type='aa'))
+        self.assertFalse(store.has_group('F2'))
+
+        (sns, PCRs, times) = store.get_time_axis('F1')
+        self.assertEqual(list(sns), ['s1', 's2', 's3'])
+        (sns, act) = store.get_counts('F1', ['s3', 's1'], start=2, end=7)
+        self.assertEqual(sns, [('s3', 1), ('s1', 1)])
+        np.testing.assert_array_equal(act[1], self.counts['s1'].sum(axis=0)[:, 2: 7])
+
+        # Replace a sample
+        store.add_counts('F1', 's1', self.counts['s2'], time=10)
+        self.assertEqual(len(store.get_time_axis('F1')[0]), 3)
+        np.testing.assert_array_equal(store.get_counts('F1', ['s1'])[1][0],
+                                      self.counts['s2'].sum(axis=0))
+
+        self.assertRaises(ValueError, store.add_counts, 'F1', 's4',
+                          self.counts['s1'][:, :, :5])
+
+
+    def test_PCR(self):
+        store = TrajectoryStore('p1')
+        store.add_counts('F1', 's1', self.counts['s1'], PCR=2, time=10)
+        store.add_counts('F1', 's2', self.counts['s2'], PCR=1, time=20)
+        store.add_counts('F1', 's2', self.counts['s3'], PCR=2, time=20)
+        self.assertEqual(store.get_counts('F1', ['s1', 's2'], use_PCR1=0)[0],
+                         [('s1', 2), ('s2', 1), ('s2', 2)])
+        self.assertEqual(store.get_counts('F1', ['s1', 's2'], use_PCR1=1)[0],
+                         [('s1', 2), ('s2', 1)])
+        self.assertEqual(store.get_counts('F1', ['s1', 's2'], use_PCR1=2)[0],
+                         [('s2', 1)])
+
+
+    def test_append(self):
+        '''Appending creates the store and keeps the other groups'''
+        self.assertIsNone(load_trajectory_store('p1'))
+        append_to_trajectory_store('p1', 's2', 'F1', counts=self.counts['s2'],
+                                   time=20)
+        append_to_trajectory_store('p1', 's1', 'F1', counts=self.counts['s1'],
+                                   time=10)
+        append_to_trajectory_store('p1', 's1', 'F1',
+                                   insertions=Counter({(3, 'AG'): 5}), time=10)
+
+        store = load_trajectory_store('p1')
+        self.assertEqual(store.groups(), [('ins', 'F1'), ('nuc', 'F1')])
+        (sns, act) = store.get_counts('F1')
+        self.assertEqual(sns, [('s1', 1), ('s2', 1)])
+        np.testing.assert_array_equal(act, [self.counts[sn].sum(axis=0)
+                                            for sn in ('s1', 's2')])
+        self.assertEqual(store.get_insertions('F1'),
+                         ([('s1', 1)], [Counter({(3, 'AG'): 5})]))
+
+
+    def test_append_other_groups(self):
+        '''Appending to a region does not touch the arrays of other regions'''
+        append_to_trajectory_store('p1', 's1', 'F1', counts=self.counts['s1'])
+        append_to_trajectory_store('p1', 's1', 'F2', counts=self.counts['s2'])
+        store = load_trajectory_store('p1')
+        fn = store.get_array_filename('F1')
+        st = os.stat(fn)
+        os.utime(fn, (st.st_atime, st.st_mtime - 100))
+        mtime = os.path.getmtime(fn)
+
+        append_to_trajectory_store('p1', 's2', 'F2', counts=self.counts['s3'])
+        self.assertEqual(os.path.getmtime(fn), mtime)
+        store = load_trajectory_store('p1')
+        self.assertEqual(store.get_counts('F1')[0], [('s1', 1)])
+        self.assertEqual(store.get_counts('F2')[0], [('s1', 1), ('s2', 1)])
+
+
+    def test_append_rows(self):
+        '''Many appends give the same array as concatenating the rows'''
+        fn = os.path.join(self.folder, 'rows.npy')
+        rng = np.random.RandomState(1)
+        chunks = [rng.randint(0, 100, size=(rng.randint(1, 4), 3, 5))
+                  for i in xrange(50)]
+        rows = [append_rows_npy(fn, chunk) for chunk in chunks]
+        self.assertEqual(rows, list(np.cumsum([0] + map(len, chunks[:-1]))))
+        np.testing.assert_array_equal(np.load(fn), np.concatenate(chunks))
+
+        self.assertRaises(ValueError, append_rows_npy, fn, chunks[0][:, :2])
+
+
+    def test_insertions_width(self):
+        '''Longer insertions widen the array without losing the old ones'''
+        store = TrajectoryStore('p1')
+        store.add_insertions('F1', 's1', Counter({(3, 'A'): 5, (7, 'GG'): 1}),
+                             time=10)
+        store.add_insertions('F1', 's2', [Counter({(3, 'A'): 2}),
+                                          Counter({(9, 'ACGTACGTAC'): 4})],
+                             time=20)
+        store.add_insertions('F1', 's3', Counter(), time=30)
+        (sns, ics) = store.get_insertions('F1')
+        self.assertEqual(sns, [('s1', 1), ('s2', 1), ('s3', 1)])
+        self.assertEqual(ics, [Counter({(3, 'A'): 5, (7, 'GG'): 1}),
+                               Counter({(3, 'A'): 2, (9, 'ACGTACGTAC'): 4}),
+                               Counter()])
+
+
+class PartialStore(unittest.TestCase):
+    '''The loaders must not trust a store that lags behind the sample files'''
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.patched = {}
+        folder = self.folder
+        def get_initial_reference_filename(pname, fragment, format='fasta'):
+            return os.path.join(folder, 'reference_'+fragment+'.'+format)
+        def get_allele_counts_filename(pname, samplename_pat, fragment, PCR=1,
+                                       qual_min=30, type='nuc'):
+            return os.path.join(folder, '_'.join(['ac', type, samplename_pat,
+                                                  fragment, str(PCR)])+'.npy')
+        def get_trajectory_store_filename(pname, qual_min=30):
+            return os.path.join(folder, 'trajectories', 'index.json')
+        for fun in (get_initial_reference_filename, get_allele_counts_filename,
+                    get_trajectory_store_filename):
+            self.patched[fun.__name__] = getattr(pfilenames, fun.__name__)
+            setattr(pfilenames, fun.__name__, fun)
+
+        self.L = 8
+        with open(get_initial_reference_filename('p1', 'F1'), 'w') as f:
+            f.write('>F1\n'+'A' * self.L+'\n')
+
+        self.samplenames = ['s1', 's2', 's3']
+        self.counts = {}
+        for i, samplename in enumerate(self.samplenames):
+            for type, L in (('nuc', self.L), ('aa', 3)):
+                counts = np.zeros((2, len(alpha), L), int)
+                counts[0, 0] = i + 1
+                self.counts[(samplename, type)] = counts
+                np.save(get_allele_counts_filename('p1', samplename, 'F1',
+                                                   type=type),
+                        counts)
+
+
+    def tearDown(self):
+        for name, fun in self.patched.iteritems():
+            setattr(pfilenames, name, fun)
+        shutil.rmtree(self.folder)
+
+
+    def fill_store(self, samplenames):
+        store = TrajectoryStore('p1')
+        for i, samplename in enumerate(samplenames):
+            for type in ('nuc', 'aa'):
+                store.add_counts('F1', samplename,
+                                 self.counts[(samplename, type)],
+                                 time=i, type=type)
+        store.save()
+
+
+    def test_partial(self):
+        '''A partially filled store falls back to the sample files'''
+        self.fill_store(self.samplenames[:2])
+        store = load_trajectory_store('p1')
+        self.assertTrue(store.has_group('F1'))
+        self.assertFalse(store.has_samples('F1', [(sn, 1) for sn in self.samplenames]))
+
+        (sns, act) = get_allele_count_trajectories('p1', self.samplenames, 'F1')
+        self.assertEqual(sns, [(sn, 1) for sn in self.samplenames])
+        np.testing.assert_array_equal(act[:, 0], [[1] * self.L, [2] * self.L, [3] * self.L])
+
+        (sns, act) = get_allele_count_trajectories_aa('p1', self.samplenames, 'F1')
+        self.assertEqual(sns, [(sn, 1) for sn in self.samplenames])
+        self.assertEqual(len(act), 3)
+
+
+    def test_complete(self):
+        '''A complete store is used, with the same result as the files'''
+        self.fill_store(self.samplenames)
+        for loader in (get_allele_count_trajectories,
+                       get_allele_count_trajectories_aa):
+            (sns, act) = loader('p1', self.samplenames, 'F1')
+            (sns_files, act_files) = loader('p1', self.samplenames, 'F1',
+                                            use_store=False)
+            self.assertEqual(list(sns), sns_files)
+            np.testing.assert_array_equal(act, act_files)
+
+
+    def test_stale(self):
+        '''A sample file changed after it was stored is read from disk'''
+        for i, samplename in enumerate(self.samplenames):
+            fn = pfilenames.get_allele_counts_filename('p1', samplename, 'F1')
+            append_to_trajectory_store('p1', samplename, 'F1',
+                                       counts=self.counts[(samplename, 'nuc')],
+                                       time=i, filename=fn)
+        fns = [pfilenames.get_allele_counts_filename('p1', sn, 'F1')
+               for sn in self.samplenames]
+        store = load_trajectory_store('p1')
+        sns = [(sn, 1) for sn in self.samplenames]
+        self.assertTrue(store.has_samples('F1', sns, filenames=fns))
+
+        counts = self.counts[('s2', 'nuc')].copy()
+        counts[0, 0] = 10
+        np.save(fns[1], counts)
+        st = os.stat(fns[1])
+        os.utime(fns[1], (st.st_atime, st.st_mtime + 100))
+        self.assertFalse(store.has_samples('F1', sns, filenames=fns))
+
+        (sns, act) = get_allele_count_trajectories('p1', self.samplenames, 'F1')
+        np.testing.assert_array_equal(act[:, 0], [[1] * self.L, [10] * self.L, [3] * self.L])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
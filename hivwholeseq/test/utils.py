@@ -12,6 +12,7 @@ class Read(object):
     is_unpaired = True
     is_proper_pair = True
     is_reverse = False
+    is_read2 = False
 
     def __init__(self, seq, pos=0, **kwargs):
         self.seq = seq
@@ -23,3 +23,7 @@ class NoDataWarning(Warning):
     '''Warning in case we have no data covering this situation'''
     pass
 
+
+class OldFormatWarning(Warning):
+    '''Warning in case data is stored in an outdated, slower format'''
+    pass
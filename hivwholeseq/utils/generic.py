@@ -28,7 +28,13 @@ def mkdirs(newdir):
         if head and not os.path.isdir(head):
             mkdirs(head)
         if tail:
-            os.mkdir(newdir)
+            # Another thread or process might create the folder meanwhile
+            try:
+                os.mkdir(newdir)
+            except OSError as e:
+                import errno
+                if (e.errno != errno.EEXIST) or (not os.path.isdir(newdir)):
+                    raise
 
 
 def getchar():
@@ -65,6 +71,13 @@ def modification_date(filename):
     return datetime.datetime.fromtimestamp(t)
 
 
+def is_npy_file(filename):
+    '''Check whether a file is in numpy .npy format (e.g. not a pickle)'''
+    import numpy as np
+    with open(filename, 'rb') as f:
+        return f.read(len(np.lib.format.MAGIC_PREFIX)) == np.lib.format.MAGIC_PREFIX
+
+
 def read_json(file_name):
     '''Read the json file with name file_name into a dict'''
     import json
@@ -107,7 +107,7 @@ all_edges.update(other_edges)
 # Functions
 def find_region_edges(refm, edges, minimal_fraction_match=0.60, shift=10):
     '''Find a region's edges in a sequence'''
-    import numpy as np
+    from hivwholeseq.utils.sequence import find_seed
 
     pos_edge = []
 
@@ -116,18 +116,10 @@ def find_region_edges(refm, edges, minimal_fraction_match=0.60, shift=10):
         start = -shift
         pos_edge.append(None)
     else:
-        seed = np.ma.array(np.fromstring(edges[0], 'S1'))
-        seed[seed == 'N'] = np.ma.masked
-        seed[seed == 'R'] = np.ma.masked
-        seed[seed == 'W'] = np.ma.masked
-        seed[seed == 'Y'] = np.ma.masked
-        sl = len(seed)
-        n_match = np.array([(refm[i: i + sl] == seed).sum()
-                            for i in xrange(len(refm) - sl)], int)
-        pos_seed = np.argmax(n_match)
+        (pos_seed, n_match, n_comparable) = find_seed(refm, edges[0])
         # Check whether a high fraction of the comparable (i.e. not masked)
         # sites match the seed
-        if n_match[pos_seed] > minimal_fraction_match * (-seed.mask).sum():
+        if n_match > minimal_fraction_match * n_comparable:
             start = pos_seed
             pos_edge.append(start)
         else:
@@ -138,16 +130,9 @@ def find_region_edges(refm, edges, minimal_fraction_match=0.60, shift=10):
     if edges[1] is None:
         end = None
     else:
-        seed = np.ma.array(np.fromstring(edges[1], 'S1'))
-        seed[seed == 'N'] = np.ma.masked
-        seed[seed == 'R'] = np.ma.masked
-        seed[seed == 'W'] = np.ma.masked
-        seed[seed == 'Y'] = np.ma.masked
-        sl = len(seed)
-        n_match = np.array([(refm[i: i + sl] == seed).sum()
-                            for i in xrange(start + shift, len(refm) - sl)], int)
-        pos_seed = np.argmax(n_match)
-        if n_match[pos_seed] > minimal_fraction_match * (-seed.mask).sum():
+        sl = len(edges[1])
+        (pos_seed, n_match, n_comparable) = find_seed(refm[start + shift:], edges[1])
+        if n_match > minimal_fraction_match * n_comparable:
             end = pos_seed + start + shift + sl
         else:
             end = None
@@ -183,6 +168,7 @@ def locate_gene(refseq, gene, minimal_fraction_match='auto', VERBOSE=0,
           is found, the gene edge is not found.
     '''
     import numpy as np
+    from hivwholeseq.utils.sequence import find_seed
 
     gene_edge = gene_edges[gene[:3]]
     # Deal with spliced genes: e.g. tat1 takes only the first exon, tat takes all
@@ -238,15 +224,10 @@ def locate_gene(refseq, gene, minimal_fraction_match='auto', VERBOSE=0,
         start = refseq.find(gene_edge[0])
         # If perfect match does not work, try imperfect
         if start == -1:
-            seed = np.ma.array(np.fromstring(gene_edge[0], 'S1'))
-            seed[seed == 'N'] = np.ma.masked
-            sl = len(seed)
-            n_match = np.array([(refm[i: i + sl] == seed).sum()
-                                for i in xrange(len(refm) - sl)], int)
-            pos_seed = np.argmax(n_match)
+            (pos_seed, n_match, n_comparable) = find_seed(refm, gene_edge[0])
             # Check whether a high fraction of the comparable (i.e. not masked)
             # sites match the seed
-            if n_match[pos_seed] > minimal_fraction_match * (-seed.mask).sum():
+            if n_match > minimal_fraction_match * n_comparable:
                 start = pos_seed
             else:
                 start = 0
@@ -258,13 +239,10 @@ def locate_gene(refseq, gene, minimal_fraction_match='auto', VERBOSE=0,
         if end != -1:
             end += len(gene_edge[1])
         else:
-            seed = np.ma.array(np.fromstring(gene_edge[1], 'S1'))
-            seed[seed == 'N'] = np.ma.masked
-            sl = len(seed)
-            n_match = np.array([(refm[i: i + sl] == seed).sum()
-                                for i in xrange(start + 50, len(refm) - sl)], int)
-            pos_seed = np.argmax(n_match)
-            if n_match[pos_seed] > minimal_fraction_match * (-seed.mask).sum():
+            sl = len(gene_edge[1])
+            (pos_seed, n_match, n_comparable) = find_seed(refm[start + 50:],
+                                                          gene_edge[1])
+            if n_match > minimal_fraction_match * n_comparable:
                 end = pos_seed + sl
             else:
                 end = len(refseq) - start - 50
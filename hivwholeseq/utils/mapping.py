@@ -5,7 +5,7 @@ date:       22/08/13
 content:    Settings of stampy used by our mapping scripts.
 '''
 # Modules
-from .sequence import align_muscle
+from .sequence import align_muscle, align_muscle_batch
 
 # Globals
 from hivwholeseq.sequencing.filenames import stampy_bin, bwa_bin, spades_bin
@@ -339,6 +339,241 @@ def index_bam(bamfilename_sorted):
     pysam.index(bamfilename_sorted)
 
 
+def make_sorted_bam(bamfilename, bamfilename_sorted, VERBOSE=0):
+    '''Make a coordinate-sorted, indexed twin of a name-sorted BAM file
+
+    The twin is meant for region queries via fetch, while the name-sorted
+    file is kept for the pair-wise scans of the whole file.
+    '''
+    import os
+
+    # NOTE: the sorted file appears only once complete
+    bamfilename_tmp = bamfilename_sorted[:-4]+'_tmp_'+str(os.getpid())+'.bam'
+    sort_bam(bamfilename_tmp, bamfilename)
+    os.rename(bamfilename_tmp, bamfilename_sorted)
+    index_bam(bamfilename_sorted)
+
+    if VERBOSE >= 2:
+        print 'Sorted and indexed:', bamfilename_sorted
+
+
+def is_sorted_bam_current(bamfilename_sorted, bamfilename):
+    '''Check whether a sorted, indexed twin of a BAM file is up to date'''
+    import os
+
+    fns = [bamfilename, bamfilename_sorted, bamfilename_sorted+'.bai']
+    if not all(map(os.path.isfile, fns)):
+        return False
+
+    mtimes = map(os.path.getmtime, fns)
+    return mtimes == sorted(mtimes)
+
+
+def pair_generator_region(bamfile, start, end, reference=None):
+    '''Generator for pairs with at least one read overlapping a region
+
+    Parameters:
+       bamfile (Samfile): open BAM file, coordinate-sorted and indexed
+       start (int): start of the region
+       end (int): end of the region
+       reference (str): reference name (default: the first in the header)
+
+    Note: only proper pairs are yielded, the first read of the pair first. The
+    mates are fetched from the span of the mate positions, so the cost scales
+    with the coverage of the region rather than the size of the file.
+    '''
+    if reference is None:
+        reference = bamfile.references[0]
+
+    # Reads in the region, and the span of their mates
+    qnames = set()
+    pos_min = start
+    pos_max = end
+    for read in bamfile.fetch(reference, start, end):
+        if (not read.is_proper_pair) or read.is_secondary:
+            continue
+        qnames.add(read.qname)
+        pos_min = min(pos_min, read.mpos)
+        pos_max = max(pos_max, read.mpos + 1)
+
+    if not qnames:
+        return
+
+    # Pair up reads by name in the span
+    mates = {}
+    for read in bamfile.fetch(reference, pos_min, pos_max):
+        if (read.qname not in qnames) or read.is_secondary:
+            continue
+        if read.qname not in mates:
+            mates[read.qname] = read
+            continue
+
+        mate = mates.pop(read.qname)
+        if mate.is_read1:
+            yield (mate, read)
+        else:
+            yield (read, mate)
+
+
+def get_read_name_key(qname):
+    '''Get a sort key for read names, in the natural order of samtools sort -n'''
+    import re
+    return tuple(int(f) if f.isdigit() else f
+                 for f in re.findall(r'\d+|\D+', qname))
+
+
+def merge_bams_by_name(input_filenames, output_filename, VERBOSE=0):
+    '''Merge BAM files sorted by read name with a streaming k-way merge
+
+    Parameters:
+       input_filenames (list): BAM files, each sorted by read name
+       output_filename (str): merged BAM file (header from the first input)
+
+    Returns:
+       n_reads (int): number of reads written
+    '''
+    import heapq
+    import pysam
+
+    def keyed_reads(bamfile, i):
+        for read in bamfile:
+            yield (get_read_name_key(read.qname), i, read)
+
+    bamfiles = [pysam.Samfile(fn, 'rb') for fn in input_filenames]
+    try:
+        with pysam.Samfile(output_filename, 'wb', template=bamfiles[0]) as bamfile_out:
+            n_reads = 0
+            for (_, _, read) in heapq.merge(*[keyed_reads(bamfile, i)
+                                              for i, bamfile in enumerate(bamfiles)]):
+                bamfile_out.write(read)
+                n_reads += 1
+    finally:
+        for bamfile in bamfiles:
+            bamfile.close()
+
+    if VERBOSE >= 2:
+        print 'Merged', len(input_filenames), 'BAM files,', n_reads, 'reads'
+
+    return n_reads
+
+
+def map_part_to_bam(call_list, output_filename, part=1, VERBOSE=0):
+    '''Run one mapper part and encode its SAM stream to a name-sorted BAM
+
+    Parameters:
+       call_list (list): mapper command line, writing SAM to stdout
+       output_filename (str): BAM file of the part
+
+    Returns:
+       stats (dict): part, exitcode, n_reads, start and end times (secs)
+    '''
+    import time
+    import subprocess as sp
+    import pysam
+
+    stats = {'part': part, 'n_reads': 0, 'start': time.time()}
+    if VERBOSE >= 2:
+        print 'Part '+str(part)+':', ' '.join(call_list)
+
+    # NOTE: the SAM stream is never written to disk
+    process = sp.Popen(call_list, stdout=sp.PIPE)
+    is_sorted = True
+    try:
+        try:
+            samfile = pysam.Samfile(process.stdout, 'r')
+        except ValueError:
+            # The mapper failed before writing the SAM header
+            samfile = None
+
+        if samfile is not None:
+            with pysam.Samfile(output_filename, 'wb', template=samfile) as bamfile:
+                key_old = None
+                for read in samfile:
+                    bamfile.write(read)
+                    stats['n_reads'] += 1
+
+                    key = get_read_name_key(read.qname)
+                    if (key_old is not None) and (key < key_old):
+                        is_sorted = False
+                    key_old = key
+
+                    if (VERBOSE >= 3) and (not (stats['n_reads'] % 100000)):
+                        print 'Part '+str(part)+':', stats['n_reads'], 'reads,', \
+                                int(time.time() - stats['start']), 'secs'
+            samfile.close()
+    finally:
+        process.stdout.close()
+        stats['exitcode'] = process.wait()
+
+    if (samfile is None) and (stats['exitcode'] == 0):
+        stats['exitcode'] = 1
+
+    # Stampy keeps the input order, so parts of sorted inputs need no sorting
+    if (stats['exitcode'] == 0) and (not is_sorted):
+        # NOTE: we exclude the extension and the option -f because of a bug in samtools
+        import os
+        output_filename_unsorted = output_filename[:-4]+'_unsorted.bam'
+        os.rename(output_filename, output_filename_unsorted)
+        pysam.sort('-n', output_filename_unsorted, output_filename[:-4])
+        os.remove(output_filename_unsorted)
+
+    stats['end'] = time.time()
+    if VERBOSE >= 1:
+        print 'Part '+str(part)+' done:', stats['n_reads'], 'reads,', \
+                int(stats['end'] - stats['start']), 'secs'
+
+    return stats
+
+
+def map_parts_local(call_lists, part_filenames, output_filename, threads=None,
+                    VERBOSE=0):
+    '''Run mapper parts as local processes and merge them sorted by read name
+
+    Parameters:
+       call_lists (list): one mapper command line per part (e.g. stampy with
+       --processpart), each writing SAM to stdout
+       part_filenames (list): temporary BAM file of each part
+       output_filename (str): name-sorted, merged BAM file
+       threads (int): maximal number of parts mapped at the same time
+       (default: all)
+
+    Returns:
+       stats (list): per-part statistics, see map_part_to_bam
+    '''
+    import subprocess as sp
+    from multiprocessing.pool import ThreadPool
+
+    if threads is None:
+        threads = len(call_lists)
+
+    def map_part(args):
+        (i, call_list) = args
+        return map_part_to_bam(map(str, call_list), part_filenames[i],
+                               part=(i+1), VERBOSE=VERBOSE)
+
+    # Each part has a thread that streams the mapper output into BAM
+    pool = ThreadPool(min(threads, len(call_lists)))
+    try:
+        stats = []
+        for stats_part in pool.imap_unordered(map_part, enumerate(call_lists)):
+            stats.append(stats_part)
+            if VERBOSE >= 1:
+                print 'Parts done:', len(stats), 'of', len(call_lists)
+    finally:
+        pool.close()
+        pool.join()
+    stats.sort(key=lambda x: x['part'])
+
+    for stats_part in stats:
+        if stats_part['exitcode']:
+            raise sp.CalledProcessError(stats_part['exitcode'],
+                                        ' '.join(map(str, call_lists[stats_part['part'] - 1])))
+
+    merge_bams_by_name(part_filenames, output_filename, VERBOSE=VERBOSE)
+
+    return stats
+
+
 def get_number_reads_fastq_open(handle):
     '''Get the number of reads from a fastq file'''
     from Bio.SeqIO.QualityIO import FastqGeneralIterator as FGI
@@ -356,12 +591,71 @@ def get_number_reads_open(bamfile):
     return n_reads
 
 
-def get_number_reads(bamfilename, format='bam'):
-    '''Count the reads (not pairs) in a BAM/SAM file'''
+def get_read_count_filename(bamfilename):
+    '''Get the filename of the read count sidecar of a BAM/SAM file'''
+    return bamfilename+'.count'
+
+
+def load_read_count(bamfilename):
+    '''Load the number of reads of a BAM/SAM file from its sidecar
+
+    Returns:
+       n_reads (int): the number of reads, None if the sidecar is missing or
+       older than the file
+    '''
+    import os
+
+    fn = get_read_count_filename(bamfilename)
+    if not os.path.isfile(fn):
+        return None
+
+    with open(fn, 'r') as f:
+        fields = f.read().split()
+    if len(fields) != 3:
+        return None
+
+    # The sidecar is valid only for the same size and modification time
+    stat = os.stat(bamfilename)
+    if (int(fields[1]) != stat.st_size) or (fields[2] != repr(stat.st_mtime)):
+        return None
+
+    return int(fields[0])
+
+
+def save_read_count(bamfilename, n_reads):
+    '''Save the number of reads of a BAM/SAM file to its sidecar'''
+    import os
+
+    stat = os.stat(bamfilename)
+    try:
+        with open(get_read_count_filename(bamfilename), 'w') as f:
+            f.write(str(n_reads)+'\t'+str(stat.st_size)+'\t'+repr(stat.st_mtime)+'\n')
+    except IOError:
+        # Read-only folders have no sidecars
+        pass
+
+
+def get_number_reads(bamfilename, format='bam', sidecar=False):
+    '''Count the reads (not pairs) in a BAM/SAM file
+
+    Parameters:
+       sidecar (bool): read the count from the sidecar file if up to date,
+       else count and save it there
+    '''
     import pysam
+
+    if sidecar:
+        n_reads = load_read_count(bamfilename)
+        if n_reads is not None:
+            return n_reads
+
     file_modes = {'bam': 'rb', 'sam': 'r'}
     with pysam.Samfile(bamfilename, file_modes[format]) as bamfile:
         n_reads = get_number_reads_open(bamfile)
+
+    if sidecar:
+        save_read_count(bamfilename, n_reads)
+
     return n_reads
 
 
@@ -397,93 +691,128 @@ def get_number_mapped_reads(bamfilename, format='bam'):
     return n_reads
 
 
-def extract_mapped_pairs_subsample_open(bamfile_in, n_reads, maxreads=-1, VERBOSE=0):
-    '''Extract random read pairs (pointers) from an open BAM file'''
+def get_random_state(seed=None):
+    '''Get a random number generator (the global numpy one if no seed)'''
     import numpy as np
 
-    n_pairs_tot = get_number_reads_open(bamfile_in) // 2
+    if seed is None:
+        return np.random.mtrand._rand
+    elif isinstance(seed, np.random.RandomState):
+        return seed
+    else:
+        return np.random.RandomState(seed)
+
 
-    if n_pairs_tot <= n_reads:
-        bamfile_in.reset()
-        return pair_generator(bamfile_in)
+def reservoir_sample(iterable, n, maxitems=-1, seed=None, full_output=False):
+    '''Pick random items from an iterable in a single pass (reservoir sampling)
 
-    # Limit to the first part of the file
-    if maxreads == -1:
-        maxreads = n_pairs_tot
+    Parameters:
+       n (int): number of items to pick
+       maxitems (int): limit to the first items of the iterable (-1 for all)
+       seed (int or RandomState): seed of the random number generator
+       full_output (bool): also return the number of items scanned
+
+    Returns:
+       sample (list): the picked items, in the order of the iterable
+
+    NOTE: this is Li's algorithm L, which draws random numbers only for the
+    items that enter the reservoir.
+    '''
+    from itertools import islice
+    from math import exp, log, floor
+
+    rng = get_random_state(seed)
+
+    def rand_open():
+        u = 0.0
+        while u == 0.0:
+            u = rng.rand()
+        return u
+
+    if maxitems != -1:
+        iterable = islice(iterable, maxitems)
+
+    reservoir = []
+    n_items = 0
+    if n > 0:
+        w = exp(log(rand_open()) / n)
+        i_next = n + int(floor(log(rand_open()) / log(1 - w)))
     else:
-        maxreads = min(n_pairs_tot, maxreads)
+        i_next = -1
+    for i, item in enumerate(iterable):
+        n_items = i + 1
+        if i < n:
+            reservoir.append((i, item))
 
-    # Get the random indices of the reads to store
-    ind_store = np.arange(maxreads)
-    np.random.shuffle(ind_store)
-    ind_store = ind_store[:n_reads]
-    ind_store.sort()
+        elif i == i_next:
+            reservoir[rng.randint(n)] = (i, item)
+            w *= exp(log(rand_open()) / n)
+            i_next += int(floor(log(rand_open()) / log(1 - w))) + 1
 
-    if VERBOSE >= 2:
-        print 'Random indices between '+str(ind_store[0])+' and '+str(ind_store[-1]),
-        print '(pairs is True)'
+    reservoir.sort(key=lambda x: x[0])
+    sample = [item for (_, item) in reservoir]
 
-    output_reads = []
-    n_written = 0
-    for i, (read1, read2) in enumerate(pair_generator(bamfile_in)):
-        if VERBOSE >= 2:
-            if not ((i+1) % 10000):
-                print i+1, n_written, ind_store[n_written]
-    
-        if i == ind_store[n_written]:
-            output_reads.append((read1, read2))
-            n_written += 1
-    
-        if n_written >= n_reads:
-            break
+    if full_output:
+        return (sample, n_items)
+    else:
+        return sample
 
-    bamfile_in.reset()
-    return output_reads
+
+def extract_mapped_pairs_subsample_open(bamfile_in, n_reads, maxreads=-1, VERBOSE=0,
+                                        seed=None, sidecar=False):
+    '''Extract random read pairs (pointers) from an open BAM file
+
+    Parameters:
+       seed (int or RandomState): seed of the random number generator
+       sidecar (bool): use the read count sidecar of the file, if any, to skip
+       sampling of small files, and save it after a full pass
+    '''
+    return extract_mapped_reads_subsample_open(bamfile_in, n_reads,
+                                               maxreads=maxreads,
+                                               VERBOSE=VERBOSE,
+                                               pairs=True,
+                                               seed=seed,
+                                               sidecar=sidecar)
 
 
 def extract_mapped_reads_subsample_open(bamfile_in, n_reads, maxreads=-1, VERBOSE=0,
-                                        pairs=True):
-    '''Extract random reads or read pairs (pointers) from an open BAM file'''
-    import numpy as np
+                                        pairs=True, seed=None, sidecar=False):
+    '''Extract random reads or read pairs (pointers) from an open BAM file
+
+    Parameters:
+       seed (int or RandomState): seed of the random number generator
+       sidecar (bool): use the read count sidecar of the file, if any, to skip
+       sampling of small files, and save it after a full pass over single reads
+
+    NOTE: the sidecar is not saved after a pass over pairs, because an odd
+    read at the end of the file is dropped by pair_generator and the count
+    would be off by one.
+    '''
+    # A file known to be small needs no sampling
+    if sidecar:
+        n_reads_tot = load_read_count(bamfile_in.filename)
+        if (n_reads_tot is not None) and \
+           (n_reads_tot // (1 + pairs) <= n_reads) and (maxreads == -1):
+            bamfile_in.reset()
+            if pairs:
+                return pair_generator(bamfile_in)
+            return bamfile_in
 
     if pairs:
-        return extract_mapped_pairs_subsample_open(bamfile_in, n_reads,
-                                                   maxreads=maxreads,
-                                                   VERBOSE=VERBOSE)
-
-    n_reads_tot = get_number_reads_open(bamfile_in)
-    if n_reads_tot <= n_reads:
-        bamfile_in.reset()
-        return bamfile_in
-
-    # Limit to the first part of the file
-    if maxreads == -1:
-        maxreads = n_reads_tot
+        reads_iter = pair_generator(bamfile_in)
     else:
-        maxreads = min(n_reads_tot, maxreads)
+        reads_iter = bamfile_in
 
-    ind_store = np.arange(maxreads)
-    np.random.shuffle(ind_store)
-    ind_store = ind_store[:n_reads]
-    ind_store.sort()
+    (output_reads, n_scanned) = reservoir_sample(reads_iter, n_reads,
+                                                 maxitems=maxreads, seed=seed,
+                                                 full_output=True)
 
     if VERBOSE >= 2:
-        print 'Random indices between '+str(ind_store[0])+' and '+str(ind_store[-1]),
-        print '(pairs is False)'
+        print 'Random reads picked:', len(output_reads), 'of', n_scanned,
+        print '(pairs is '+str(pairs)+')'
 
-    output_reads = []
-    n_written = 0
-    for i, read in enumerate(bamfile_in):
-        if VERBOSE >= 2:
-            if not ((i+1) % 10000):
-                print i+1, n_written, ind_store[n_written]
-    
-        if i == ind_store[n_written]:
-            output_reads.append(read)
-            n_written += 1
-    
-        if n_written >= n_reads:
-            break
+    if sidecar and (maxreads == -1) and (not pairs):
+        save_read_count(bamfile_in.filename, n_scanned)
 
     bamfile_in.reset()
     return output_reads
@@ -491,115 +820,70 @@ def extract_mapped_reads_subsample_open(bamfile_in, n_reads, maxreads=-1, VERBOS
 
 def extract_mapped_reads_subsample_object(input_filename, n_reads,
                                           maxreads=-1,
-                                          VERBOSE=0):
+                                          VERBOSE=0,
+                                          seed=None):
     '''Extract a subset of read pairs into new objects'''
-    import numpy as np
     import pysam
     file_modes = {'read': {'bam': 'rb', 'sam': 'r'},
                   'write': {'bam': 'wb', 'sam': 'w'}}
     input_format = input_filename[-3:]
 
-    n_reads_tot = get_number_reads(input_filename, input_format) / 2
-
-    # Limit to the first part of the file
-    if maxreads == -1:
-        maxreads = n_reads_tot
-    else:
-        maxreads = min(n_reads_tot, maxreads)
-
-    # Pick random numbers among those
-    # Get the random indices of the reads to store
-    ind_store = np.arange(maxreads)
-    np.random.shuffle(ind_store)
-    ind_store = ind_store[:n_reads]
-    ind_store.sort()
-
-    if VERBOSE >= 2:
-        print 'Random indices between '+str(ind_store[0])+' and '+str(ind_store[-1])
-
     # Copy reads
     output_reads = []
     with pysam.Samfile(input_filename, file_modes['read'][input_format]) as bamfile_in:
+        read_pairs = reservoir_sample(pair_generator(bamfile_in), n_reads,
+                                      maxitems=maxreads, seed=seed)
 
-            n_written = 0
-            for i, (read1, read2) in enumerate(pair_generator(bamfile_in)):
-
-                if VERBOSE >= 2:
-                    if not ((i+1) % 10000):
-                        print i+1, n_written, ind_store[n_written]
-    
-                # If you hit a read pair, add it
-                if i == ind_store[n_written]:
-
-                    read_pair = []
-                    for read in (read1, read2):
-                        read_new = pysam.AlignedRead()
-                        read_new.qname = read.qname
-                        read_new.seq = read.seq
-                        read_new.qual = read.qual
-                        read_new.flag = read.flag
-                        read_new.pos = read.pos
-                        read_new.mapq = read.mapq
-                        read_new.cigar = read.cigar
-                        read_new.mrnm = read.mrnm
-                        read_new.mpos = read.mpos
-                        read_new.isize = read.isize
-                        read_new.tags = read.tags
-                        read_pair.append(read_new)
-
-                    output_reads.append(read_pair)
-                    n_written += 1
-    
-                # Break after the last one
-                if n_written >= n_reads:
-                    break
+        if VERBOSE >= 2:
+            print 'Random read pairs picked:', len(read_pairs)
+
+        for (read1, read2) in read_pairs:
+            read_pair = []
+            for read in (read1, read2):
+                read_new = pysam.AlignedRead()
+                read_new.qname = read.qname
+                read_new.seq = read.seq
+                read_new.qual = read.qual
+                read_new.flag = read.flag
+                read_new.pos = read.pos
+                read_new.mapq = read.mapq
+                read_new.cigar = read.cigar
+                read_new.mrnm = read.mrnm
+                read_new.mpos = read.mpos
+                read_new.isize = read.isize
+                read_new.tags = read.tags
+                read_pair.append(read_new)
+
+            output_reads.append(read_pair)
 
     return output_reads
 
 
 def extract_mapped_reads_subsample(input_filename, output_filename, n_reads,
-                                   VERBOSE=0):
+                                   VERBOSE=0, seed=None):
     '''Extract a subset of reads into a new file'''
-    import numpy as np
     import pysam
     file_modes = {'read': {'bam': 'rb', 'sam': 'r'},
                   'write': {'bam': 'wb', 'sam': 'w'}}
     input_format = input_filename[-3:]
     output_format = output_filename[-3:]
 
-    n_reads_tot = get_number_reads(input_filename, input_format) / 2
-
-    # Pick random numbers among those
-    # Get the random indices of the reads to store
-    ind_store = np.arange(int(0.00 * n_reads_tot), int(1 * n_reads_tot))
-    np.random.shuffle(ind_store)
-    ind_store = ind_store[:n_reads]
-    ind_store.sort()
-
-    if VERBOSE >= 2:
-        print 'Random indices between '+str(ind_store[0])+' and '+str(ind_store[-1])
-
     # Copy reads
     with pysam.Samfile(input_filename, file_modes['read'][input_format]) as bamfile_in:
+        read_pairs = reservoir_sample(pair_generator(bamfile_in), n_reads,
+                                      seed=seed)
+
+        if VERBOSE >= 2:
+            print 'Random read pairs picked:', len(read_pairs)
+
         with pysam.Samfile(output_filename, file_modes['write'][output_format],
                            template=bamfile_in) as bamfile_out:
 
             n_written = 0
-            for i, (read1, read2) in enumerate(pair_generator(bamfile_in)):
-
-                if VERBOSE >= 2:
-                    if not ((i+1) % 10000):
-                        print i+1, n_written, ind_store[n_written]
-    
-                # If you hit a read pair, write it
-                if i == ind_store[n_written]:
-                    bamfile_out.write(read1)
-                    bamfile_out.write(read2)
-                    n_written += 1
-    
-                # Break after the last one
-                if n_written >= n_reads:
-                    break
+            for (read1, read2) in read_pairs:
+                bamfile_out.write(read1)
+                bamfile_out.write(read2)
+                n_written += 1
 
     return n_written
 
@@ -7,16 +7,153 @@ content:    Collection of functions to do single site statistics (allele counts,
 '''
 # Modules
 from collections import defaultdict, Counter
+from itertools import izip, product
 import numpy as np
 import pysam
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet.IUPAC import ambiguous_dna
 
-from .sequence import alpha, alphaa
+from .sequence import alphas, alpha, alphaas, alphaa, find_seed
 from .miseq import read_types
 from .mapping import get_ind_good_cigars
-from .mapping import align_muscle
+from .mapping import align_muscle, align_muscle_batch
+
+
+# Globals
+# Lookup table from ASCII codes to nucleotide alphabet indices (codes outside
+# the alphabet map to len(alpha) and are discarded by the counting engines)
+alpha_index_table = np.repeat(len(alpha), 256)
+alpha_index_table[np.fromstring(alphas, np.uint8)] = np.arange(len(alpha))
+
+# Lookup tables for codons: nucleotides are encoded as 0-3 (ACGT) or 4 (N and
+# anything else), codons as 25 * n1 + 5 * n2 + n3, and translated into amino
+# acid alphabet indices (amino acids outside the alphabet map to len(alphaa))
+codon_nuc_table = np.repeat(4, 256)
+codon_nuc_table[np.fromstring('ACGT', np.uint8)] = np.arange(4)
+codon_aa_table = np.repeat(len(alphaa), 125)
+for _i, _codon in enumerate(product('ACGTN', repeat=3)):
+    _aa = str(Seq(''.join(_codon)).translate())
+    if _aa in alphaas:
+        codon_aa_table[_i] = alphaas.index(_aa)
+
+
+
+# Classes
+class InsertionTable(object):
+    '''Columnar table of insertions
+
+    Each row is an insertion at one position, sorted by position. The table
+    has the columns:
+       - positions: position of the insertion (it comes before that site)
+       - iseqs: index of the inserted sequence in the interned sequence table
+       - counts: number of reads with the insertion, one column per read type
+
+    It is saved as a compressed numpy archive. Region queries are binary
+    searches on the positions, and read types are merged by summing the count
+    columns.
+    '''
+
+    def __init__(self, positions, iseqs, counts, sequences):
+        '''Initialize an insertion table from its columns'''
+        self.positions = positions
+        self.iseqs = iseqs
+        self.counts = counts
+        self.sequences = sequences
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    def __repr__(self):
+        return 'InsertionTable('+str(len(self))+' insertions, '+\
+                str(self.counts.shape[1])+' read types)'
+
+
+    @classmethod
+    def from_counters(cls, inse):
+        '''Make an insertion table from Counters
+
+        Parameters:
+           inse (Counter or list of Counters): insertions keyed by (position,
+           sequence), one Counter per read type
+        '''
+        if isinstance(inse, Counter):
+            inse = [inse]
+
+        keys = sorted(set().union(*inse))
+        sequences = np.array(sorted(set(seq for (_, seq) in keys)), object)
+        seqindex = dict((seq, i) for i, seq in enumerate(sequences))
+
+        positions = np.array([pos for (pos, _) in keys], int)
+        iseqs = np.array([seqindex[seq] for (_, seq) in keys], int)
+        counts = np.array([[ins[key] for ins in inse] for key in keys],
+                          int).reshape((len(keys), len(inse)))
+
+        # Sort by position, then sequence
+        ind = np.lexsort((iseqs, positions))
+        return cls(positions[ind], iseqs[ind], counts[ind], sequences)
+
+
+    def to_counters(self, merge_read_types=True):
+        '''Convert to Counters keyed by (position, sequence)
+
+        Returns:
+           inse: if merge_read_types, a Counter, else a list of Counters
+        '''
+        keys = zip(self.positions.tolist(), self.sequences[self.iseqs].tolist())
+        if merge_read_types:
+            return Counter(dict(zip(keys, self.counts.sum(axis=1).tolist())))
+
+        inse = []
+        for counts in self.counts.T:
+            ind = counts.nonzero()[0]
+            inse.append(Counter(dict(zip([keys[i] for i in ind],
+                                         counts[ind].tolist()))))
+        return inse
+
+
+    def get_region(self, start, end, shift=True):
+        '''Get the insertions at start <= position < end
+
+        Parameters:
+           shift (bool): make positions relative to the region start
+        '''
+        (i1, i2) = np.searchsorted(self.positions, [start, end])
+        positions = self.positions[i1: i2]
+        if shift:
+            positions = positions - start
+        return self.__class__(positions, self.iseqs[i1: i2],
+                              self.counts[i1: i2], self.sequences)
+
+
+    def merge_read_types(self):
+        '''Merge the count columns of all read types'''
+        return self.__class__(self.positions, self.iseqs,
+                              self.counts.sum(axis=1)[:, np.newaxis],
+                              self.sequences)
+
+
+    def save(self, filename):
+        '''Save the table to file'''
+        np.savez_compressed(filename,
+                            positions=self.positions,
+                            iseqs=self.iseqs,
+                            counts=self.counts,
+                            sequences=self.sequences.astype('S'))
+
+
+    @classmethod
+    def load(cls, filename):
+        '''Load a table from file'''
+        data = np.load(filename)
+        sequences = data['sequences']
+        if not len(sequences):
+            sequences = sequences.astype('S1')
+        return cls(data['positions'], data['iseqs'], data['counts'],
+                   sequences.astype(object))
+
 
 
 # Functions
@@ -86,6 +223,111 @@ def get_allele_counts_read(read, counts_out, inserts_out,
             raise ValueError('CIGAR type '+str(block_type)+' not recognized')
 
 
+def get_allele_counts_reads(reads, counts_out, inserts_out, qual_min=30,
+                            VERBOSE=0):
+    '''Get allele counts and insertions from a chunk of reads at once
+
+    Parameters:
+       reads (list): reads to scan
+       counts_out (ndarray, read types x alphabet x sequence length): output
+       data structure for counts
+       inserts_out (list of Counters): output data structures for insertions,
+       one per read type. The key is the signature of the insertion,
+       (position, insertion)
+
+    NOTE: this is the vectorized equivalent of calling get_allele_counts_read
+    on each read. The CIGARs are decoded into flat arrays of (read type,
+    allele, reference position) for the whole chunk, and the counts are
+    accumulated with a single bincount.
+    '''
+    length = counts_out.shape[-1]
+    n_alpha = counts_out.shape[-2]
+    ind_gap = alphas.index('-')
+
+    # Decode CIGARs into blocks: matches and insertions are
+    # (start in chunk sequence, reference position, length, read type),
+    # deletions are (reference position, length, read type)
+    seqs = []
+    quals = []
+    blocks_match = []
+    blocks_ins = []
+    blocks_del = []
+    pos_chunk = 0
+    for read in reads:
+        js = 2 * read.is_read2 + read.is_reverse
+        pos = read.pos
+        pos_read = pos_chunk
+        for (block_type, block_len) in read.cigar:
+
+            # Check for pos: it should never exceed the length of the fragment
+            if (block_type in [0, 1, 2]) and (pos >= length):
+                raise ValueError('Pos exceeded the length of the fragment')
+
+            if block_type == 0:
+                blocks_match.append((pos_read, pos, block_len, js))
+                pos_read += block_len
+                pos += block_len
+
+            elif block_type == 2:
+                blocks_del.append((pos, block_len, js))
+                pos += block_len
+
+            elif block_type == 1:
+                blocks_ins.append((pos_read, pos, block_len, js))
+                pos_read += block_len
+
+            else:
+                raise ValueError('CIGAR type '+str(block_type)+' not recognized')
+
+        seqs.append(read.seq)
+        quals.append(read.qual)
+        pos_chunk += len(read.seq)
+
+    seqs = ''.join(seqs)
+    quals = np.fromstring(''.join(quals), np.uint8)
+    qual_min_ascii = qual_min + 33
+
+    # Expand inline blocks into flat arrays of sites
+    blocks_match = np.array(blocks_match, int).reshape((-1, 4))
+    (starts, poss, lens, jss) = blocks_match.T
+    ind_block = np.repeat(np.arange(len(lens)), lens)
+    offsets = np.arange(lens.sum()) - np.repeat(lens.cumsum() - lens, lens)
+    ind_read = starts[ind_block] + offsets
+    pos_match = poss[ind_block] + offsets
+    if len(pos_match) and (pos_match.max() >= length):
+        raise ValueError('Pos exceeded the length of the fragment')
+
+    all_match = alpha_index_table[np.fromstring(seqs, np.uint8)[ind_read]]
+    ind_good = (all_match < n_alpha) & (quals[ind_read] >= qual_min_ascii)
+    js_match = jss[ind_block][ind_good]
+    all_match = all_match[ind_good]
+    pos_match = pos_match[ind_good]
+
+    # Expand deletions (they are cut at the end of the fragment)
+    blocks_del = np.array(blocks_del, int).reshape((-1, 3))
+    (poss, lens, jss) = blocks_del.T
+    ind_block = np.repeat(np.arange(len(lens)), lens)
+    offsets = np.arange(lens.sum()) - np.repeat(lens.cumsum() - lens, lens)
+    pos_del = poss[ind_block] + offsets
+    ind_good = pos_del < length
+    js_del = jss[ind_block][ind_good]
+    pos_del = pos_del[ind_good]
+    all_del = np.repeat(ind_gap, len(pos_del))
+
+    # Accumulate all counts at once
+    ind_flat = np.concatenate([(js_match * n_alpha + all_match) * length + pos_match,
+                               (js_del * n_alpha + all_del) * length + pos_del])
+    counts_out += np.bincount(ind_flat,
+                              minlength=counts_out.size).reshape(counts_out.shape)
+
+    # Insertions are rare, keep only the high-quality ones
+    # an insert @ pos 391 means that seq[:391] is BEFORE the insert,
+    # THEN the insert, FINALLY comes seq[391:]
+    for (start, pos, block_len, js) in blocks_ins:
+        if (quals[start: start + block_len] >= qual_min_ascii).all():
+            inserts_out[js][(pos, seqs[start: start + block_len])] += 1
+
+
 def get_allele_counts_aa_read(read, start, end, counts_out, qual_min=30,
                               VERBOSE=0):
     '''Get allele counts as amino acids from a single read.
@@ -198,9 +440,116 @@ def get_allele_counts_aa_read(read, start, end, counts_out, qual_min=30,
             return
 
 
+def get_allele_counts_aa_reads(reads, start, end, counts_out, qual_min=30,
+                               VERBOSE=0):
+    '''Get allele counts as amino acids from a chunk of reads at once
+
+    Parameters:
+       reads (list): reads to scan
+       counts_out (ndarray, read types x alphabet x protein length): output
+       data structure for counts
+
+    NOTE: this is the vectorized equivalent of calling get_allele_counts_aa_read
+    on each read. The CIGARs are cut into full codons for the whole chunk,
+    codons are translated via a lookup table, and the counts are accumulated
+    with a single bincount.
+    '''
+    length = counts_out.shape[-1]
+    n_alpha = counts_out.shape[-2]
+    ind_gap = alphaas.index('-')
+
+    # Cut CIGARs into codon blocks as get_allele_counts_aa_read: matches are
+    # (start in chunk sequence, protein position, number of codons, read type),
+    # deletions are (protein position, number of codons, read type)
+    seqs = []
+    quals = []
+    blocks_match = []
+    blocks_del = []
+    pos_chunk = 0
+    for read in reads:
+        js = 2 * read.is_read2 + read.is_reverse
+        pos = read.pos
+        pos_end = pos + sum(bl for (bt, bl) in read.cigar if bt in (0, 2))
+
+        # If the read does not cover, skip
+        if (pos > end - 2) or (pos_end < start):
+            continue
+
+        pos_ref = pos
+        pos_read = pos_chunk
+        for (bt, bl) in read.cigar:
+            if bt == 1:
+                pos_read += bl
+                continue
+
+            if pos_ref + bl >= start:
+                if pos_ref <= start:
+                    startb = start - pos_ref
+                else:
+                    startb = (start - pos_ref) % 3
+                endb = min(bl, end - pos_ref)
+                endb -= (endb - startb) % 3
+                lb = endb - startb
+
+                if lb >= 3:
+                    start_pr = ((pos_ref + startb) - start) // 3
+                    if bt == 2:
+                        blocks_del.append((start_pr, lb // 3, js))
+                    else:
+                        blocks_match.append((pos_read + startb, start_pr, lb // 3, js))
+
+            if bt == 0:
+                pos_read += bl
+            pos_ref += bl
+
+            # Check we are not beyond the end
+            if pos_ref > end - 2:
+                break
+
+        seqs.append(read.seq)
+        quals.append(read.qual)
+        pos_chunk += len(read.seq)
+
+    seqs = np.fromstring(''.join(seqs), np.uint8)
+    quals = np.fromstring(''.join(quals), np.uint8)
+    qual_min_ascii = qual_min + 33
+
+    # Expand inline blocks into flat arrays of codons
+    blocks_match = np.array(blocks_match, int).reshape((-1, 4))
+    (starts, poss, lens, jss) = blocks_match.T
+    ind_block = np.repeat(np.arange(len(lens)), lens)
+    offsets = np.arange(lens.sum()) - np.repeat(lens.cumsum() - lens, lens)
+    ind_read = (starts[ind_block] + 3 * offsets)[:, np.newaxis] + np.arange(3)
+    pos_match = poss[ind_block] + offsets
+
+    # Translate codons and ask for minimal quality at all three codon positions
+    nucs = codon_nuc_table[seqs[ind_read]]
+    all_match = codon_aa_table[25 * nucs[:, 0] + 5 * nucs[:, 1] + nucs[:, 2]]
+    ind_good = (all_match < n_alpha) & (quals[ind_read].min(axis=1) >= qual_min_ascii)
+    js_match = jss[ind_block][ind_good]
+    all_match = all_match[ind_good]
+    pos_match = pos_match[ind_good]
+
+    # Expand deletions
+    blocks_del = np.array(blocks_del, int).reshape((-1, 3))
+    (poss, lens, jss) = blocks_del.T
+    ind_block = np.repeat(np.arange(len(lens)), lens)
+    offsets = np.arange(lens.sum()) - np.repeat(lens.cumsum() - lens, lens)
+    pos_del = poss[ind_block] + offsets
+    js_del = jss[ind_block]
+    all_del = np.repeat(ind_gap, len(pos_del))
+
+    # Accumulate all counts at once
+    ind_flat = np.concatenate([(js_match * n_alpha + all_match) * length + pos_match,
+                               (js_del * n_alpha + all_del) * length + pos_del])
+    counts_out += np.bincount(ind_flat,
+                              minlength=counts_out.size).reshape(counts_out.shape)
+
+
 def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
                                            maxreads=-1, VERBOSE=0,
-                                           merge_read_types=False):
+                                           merge_read_types=False,
+                                           chunksize=10000):
     '''Get the allele counts and insertions
     
     Parameters
@@ -210,6 +559,7 @@ def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
        qual_min (int): minimal PHRED quality of the base to be counted
        maxreads (int): maximal number of reads to scan (-1: all reads)
        VERBOSE (int): verbosity level
+       chunksize (int): number of reads counted together in one vectorized pass
 
     Returns
        counts (matrix): allele count matrix, <alphabet size> x length
@@ -223,6 +573,7 @@ def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
 
     # Note: the reads should already be filtered of unmapped stuff at this point
     with pysam.Samfile(bamfilename, 'rb') as bamfile:
+        chunk = []
         for i, read in enumerate(bamfile):
 
             # Max number of reads
@@ -234,14 +585,18 @@ def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
             # Print output
             if (VERBOSE >= 3) and (not ((i +1) % 1000)):
                 print (i+1)
-        
-            # Divide by read 1/2 and forward/reverse
-            js = 2 * read.is_read2 + read.is_reverse
 
-            get_allele_counts_read(read, counts[js], inserts[js],
-                                   length=length,
-                                   qual_min=qual_min,
-                                   VERBOSE=VERBOSE)
+            chunk.append(read)
+            if len(chunk) == chunksize:
+                get_allele_counts_reads(chunk, counts, inserts,
+                                        qual_min=qual_min,
+                                        VERBOSE=VERBOSE)
+                chunk = []
+
+        if chunk:
+            get_allele_counts_reads(chunk, counts, inserts,
+                                    qual_min=qual_min,
+                                    VERBOSE=VERBOSE)
 
     if merge_read_types:
         counts = counts.sum(axis=0)
@@ -251,8 +606,15 @@ def get_allele_counts_insertions_from_file(bamfilename, length, qual_min=30,
 
 
 def get_allele_counts_aa_from_file(bamfilename, start, end, qual_min=30,
-                                   maxreads=-1, VERBOSE=0):
-    '''Get allele counts for amino acids in a protein'''
+                                   maxreads=-1, VERBOSE=0, chunksize=10000,
+                                   indexed=False):
+    '''Get allele counts for amino acids in a protein
+
+    Parameters:
+       chunksize (int): number of reads counted together in one vectorized pass
+       indexed (bool): the BAM is coordinate-sorted and indexed, so only the
+       reads overlapping the protein are read
+    '''
     if (end - start) % 3:
         raise ValueError('The selected region length is not a multiple of 3')
 
@@ -267,7 +629,13 @@ def get_allele_counts_aa_from_file(bamfilename, start, end, qual_min=30,
         # Iterate over single reads
         #NOTE: we miss a few corner cases, but it's better than trying to merge
         # reads in a pair, which is itself brittle
-        for i, read in enumerate(bamfile):
+        if indexed:
+            reads_iter = bamfile.fetch(bamfile.references[0], start, end)
+        else:
+            reads_iter = bamfile
+
+        chunk = []
+        for i, read in enumerate(reads_iter):
 
             # Max number of reads
             if i == maxreads:
@@ -279,14 +647,17 @@ def get_allele_counts_aa_from_file(bamfilename, start, end, qual_min=30,
             if (VERBOSE >= 2) and (not ((i +1) % 10000)):
                 print (i+1)
         
-            # Divide by read 1/2 and forward/reverse
-            js = 2 * read.is_read2 + read.is_reverse
-
-            get_allele_counts_aa_read(read,
-                                      start, end,
-                                      counts[js],
-                                      qual_min=qual_min,
-                                      VERBOSE=VERBOSE)
+            chunk.append(read)
+            if len(chunk) == chunksize:
+                get_allele_counts_aa_reads(chunk, start, end, counts,
+                                           qual_min=qual_min,
+                                           VERBOSE=VERBOSE)
+                chunk = []
+
+        if chunk:
+            get_allele_counts_aa_reads(chunk, start, end, counts,
+                                       qual_min=qual_min,
+                                       VERBOSE=VERBOSE)
 
     return counts
 
@@ -420,8 +791,15 @@ def get_allele_counts_insertions_from_file_unfiltered(bamfilename, length, qual_
 
 
 def filter_nus(counts, coverage=None, VERBOSE=0):
-    '''Filter allele frequencies from the four read types'''
-    from scipy.stats import chi2_contingency
+    '''Filter allele frequencies from the four read types
+
+    Sites covered by neither fwd nor rev reads are masked. Sites covered by
+    only one of them take the sum over read types. Sites covered by both take
+    the sum unless a chi2 test (with Yates correction and a pseudocount of 1,
+    like scipy.stats.chi2_contingency) finds fwd and rev significantly
+    different, in which case the frequency further from 0.5 is used.
+    '''
+    from scipy.stats import chi2
 
     if coverage is None:
         coverage = counts.sum(axis=1)
@@ -438,51 +816,48 @@ def filter_nus(counts, coverage=None, VERBOSE=0):
     cov_b = coverage[1] + coverage[3]
     ind_low_cov_f = cov_f < 10
     ind_low_cov_b = cov_b < 10
-    ind_high_cov_both = (-ind_low_cov_f) & (-ind_low_cov_b)
+    ind_cov_one = ind_low_cov_f != ind_low_cov_b
+    ind_high_cov_both = (~ind_low_cov_f) & (~ind_low_cov_b)
 
     nu_filtered = np.ma.masked_all((len(alpha), counts.shape[-1]))
 
-    # Iterate over positions
-    for i in xrange(counts.shape[-1]):
-        
-        # 1. if we cover neither fwd nor rev, keep masked
-        if ind_low_cov_f[i] and ind_low_cov_b[i]:
-            if VERBOSE >= 4:
-                print 'pos', i, 'not covered'
-            pass
+    with np.errstate(divide='ignore', invalid='ignore'):
 
-        # 2. if we cover only one of them, well, just take the
-        # arithmetic sum of counts
-        elif ind_low_cov_f[i] != ind_low_cov_b[i]:
-            nu_filtered[:, i] = 1.0 * counts[:, :, i].sum(axis=0) / coverage[:, i].sum()
-            if VERBOSE >= 4:
-                print 'pos', i, 'covered only once'
-                
-        # 3. If we cover both, check whether the counts are significantly different
-        else:
+        # Arithmetic sum of counts
+        nu_sum = 1.0 * counts.sum(axis=0) / coverage.sum(axis=0)
 
-            # Check all alleles
-            for j in xrange(len(alpha)):
-                # To make a table, you must have coverage for both
-                cm = np.array([[counts_f[j, i], nocounts_f[j, i]],
-                               [counts_b[j, i], nocounts_b[j, i]]], int)
-                chi2, pval = chi2_contingency(cm + 1)[:2]
-    
-                # If they are not significantly different, sum the counts
-                if (pval > 1e-6):
-                    nu_filtered[j, i] = 1.0 * counts[:, j, i].sum(axis=0) / coverage[:, i].sum()
-                # If they are different by a significant and reasonable amount, take
-                # the value further away from 0.5
-                else:
-                    nu_f = 1.0 * counts_f[j, i] / cov_f[i]
-                    nu_b = 1.0 * counts_b[j, i] / cov_b[i]
-                    if np.abs(nu_f - 0.5) > np.abs(nu_b - 0.5):
-                        nu_filtered[j, i] = nu_f
-                    else:
-                        nu_filtered[j, i] = nu_b
+        # Contingency tables of all alleles at all sites at once
+        table = np.array([[counts_f, nocounts_f],
+                          [counts_b, nocounts_b]], int) + 1
+        margin_rows = table.sum(axis=1)
+        margin_cols = table.sum(axis=0)
+        total = margin_rows.sum(axis=0)
+        expected = 1.0 * margin_rows[:, np.newaxis] * margin_cols[np.newaxis, :] / total
+
+        # Yates correction
+        diff = expected - table
+        table = table + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+        terms = (table - expected)**2 / expected
+        chi2s = ((terms[0, 0] + terms[0, 1]) + terms[1, 0]) + terms[1, 1]
+        pvals = chi2.sf(chi2s, 1)
+
+        # If they are different by a significant and reasonable amount, take
+        # the value further away from 0.5
+        nu_f = 1.0 * counts_f / cov_f
+        nu_b = 1.0 * counts_b / cov_b
+        nu_diff = np.where(np.abs(nu_f - 0.5) > np.abs(nu_b - 0.5), nu_f, nu_b)
+        nu_both = np.where(pvals > 1e-6, nu_sum, nu_diff)
+
+    # 1. if we cover neither fwd nor rev, keep masked
+    # 2. if we cover only one of them, well, just take the arithmetic sum of counts
+    nu_filtered[:, ind_cov_one] = nu_sum[:, ind_cov_one]
+
+    # 3. If we cover both, check whether the counts are significantly different
+    nu_filtered[:, ind_high_cov_both] = nu_both[:, ind_high_cov_both]
 
-                    if VERBOSE >= 3:
-                        print 'pos', i, 'base', alpha[j], 'nu_f', nu_f, 'nu_b', nu_b
+    if VERBOSE >= 3:
+        for (j, i) in izip(*((pvals <= 1e-6) & ind_high_cov_both).nonzero()):
+            print 'pos', i, 'base', alpha[j], 'nu_f', nu_f[j, i], 'nu_b', nu_b[j, i]
 
     # Renormalize to 1
     nu_filtered /= nu_filtered.sum(axis=0)
@@ -746,17 +1121,21 @@ def build_consensus_from_mapped_reads(bamfilename, maxreads=2000, block_len=100,
     if VERBOSE >= 2:
         print 'Aligning groups and picking consensus blocks'
 
-    # MSA within each group
-    conss = []
-    for irg, read_grouped in enumerate(reads_grouped):
-
-        # Pick a few random ones out (or all if there are less than that)
+    # Pick a few random reads out of each group (or all if there are less than
+    # that), and align all groups at once
+    seqsets = []
+    for read_grouped in reads_grouped:
         ind = np.arange(len(read_grouped))
         np.random.shuffle(ind)
         ind = ind[:min_reads_per_group]
         read_grouped_rnd = [read_grouped[i] for i in ind]
-        ali = align_muscle(*[SeqRecord(Seq(s, ambiguous_dna), id=str(i))
-                             for (i, s) in enumerate(read_grouped_rnd)])
+        seqsets.append([SeqRecord(Seq(s, ambiguous_dna), id=str(i))
+                        for (i, s) in enumerate(read_grouped_rnd)])
+    alis = align_muscle_batch(seqsets)
+
+    # MSA within each group
+    conss = []
+    for irg, ali in enumerate(alis):
 
         # Trim alignment to start from the first common position (this exists
         # because we binned reads according to their start!). In addition, every
@@ -791,14 +1170,10 @@ def build_consensus_from_mapped_reads(bamfilename, maxreads=2000, block_len=100,
         pos_start = cons.find(seed)
         # Allow imperfect matches
         if pos_start == -1:
-            consm = np.fromstring(cons, 'S1')
-            seedm = np.fromstring(seed, 'S1')
-            n_matches = [(consm[i: i + sl] == seedm).sum()
-                         for i in xrange(len(cons) - len(seed))]
-            pos_start = np.argmax(n_matches)
+            (pos_start, n_match, _) = find_seed(cons, seed, masked='')
 
             # Try to only add non-bogus stuff
-            if n_matches[pos_start] < 0.66 * sl:
+            if n_match < 0.66 * sl:
                 pos_start = -1
                 if VERBOSE >= 4:
                     print 'block n.', j, 'not joint!'
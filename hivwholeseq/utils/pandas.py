@@ -11,7 +11,71 @@ import pandas as pd
 
 
 
+# Globals
+_tables = {}
+
+
+
 # Functions
+def read_excel_cached(filename, sheetname, index_col=None, VERBOSE=0):
+    '''Read a sheet of an Excel table, cached in memory and on disk
+
+    Parameters:
+       filename (str): path to the Excel workbook
+       sheetname (str): name of the sheet
+       index_col (int): column to use as index
+
+    Returns:
+       table (pd.DataFrame): a copy of the cached table
+
+    NOTE: the cache is keyed on the path, sheet, index column and modification
+    time of the workbook. The on-disk snapshot is a pickle, regenerated when the
+    workbook changes, so that cold starts avoid parsing the Excel file too.
+    '''
+    import os
+    import cPickle as pickle
+    from ..filenames import get_table_cache_filename
+
+    mtime = os.path.getmtime(filename)
+    key = (os.path.abspath(filename), sheetname, index_col)
+
+    # 1. In memory
+    if (key in _tables) and (_tables[key][0] == mtime):
+        return _tables[key][1].copy()
+
+    # 2. On disk
+    table = None
+    fn_cache = get_table_cache_filename(filename, sheetname, index_col=index_col)
+    if os.path.isfile(fn_cache):
+        try:
+            with open(fn_cache, 'rb') as f:
+                (mtime_cache, table_cache) = pickle.load(f)
+            if mtime_cache == mtime:
+                table = table_cache
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+    # 3. From the workbook, updating the snapshot on disk
+    if table is None:
+        if VERBOSE >= 2:
+            print 'Reading table:', filename, sheetname
+        table = pd.read_excel(filename, sheetname, index_col=index_col)
+
+        try:
+            from .generic import mkdirs
+            mkdirs(os.path.dirname(fn_cache))
+            fn_tmp = fn_cache+'.'+str(os.getpid())+'.tmp'
+            with open(fn_tmp, 'wb') as f:
+                pickle.dump((mtime, table), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(fn_tmp, fn_cache)
+        except (IOError, OSError):
+            if VERBOSE >= 1:
+                print 'WARNING: cannot write table cache:', fn_cache
+
+    _tables[key] = (mtime, table)
+    return table.copy()
+
+
 def add_binned_column(data, name, column, bins=10, clip=False):
     '''Bin the contents of a column and add it as an additional column
     
@@ -21,6 +21,9 @@ alphaas = 'ACDEFGHIKLMNPQRSTVWY*-X'
 alphaal = list(alphaas)
 alphaa = array(alphaal, 'S1')
 
+# Ambiguous nucleotides that are masked (not compared) in seed searches
+seed_masked = 'NRWY'
+
 
 
 # Functions
@@ -60,8 +63,24 @@ def align_pairwise(seq1, seq2, method='global', **kwargs):
     return ali
 
 
+def get_muscle_cache_key(seqs, cline):
+    '''Get the key of a MUSCLE alignment in the cache (hash of inputs and call)'''
+    import hashlib
+    h = hashlib.sha1(str(cline))
+    for seq in seqs:
+        h.update('>'+seq.id+'\n'+str(seq.seq)+'\n')
+    return h.hexdigest()
+
+
 def align_muscle(*seqs, **kwargs):
-    '''Global alignment of sequences via MUSCLE'''
+    '''Global alignment of sequences via MUSCLE
+
+    Parameters:
+       sort (bool): sort the rows as the input sequences
+       cache (bool or str): look up and store the alignment in an on-disk
+       cache (True for the default folder, or a folder)
+    '''
+    import os
     import subprocess as sp
     from Bio import AlignIO, SeqIO
     from Bio.Align.Applications import MuscleCommandline
@@ -81,30 +100,83 @@ def align_muscle(*seqs, **kwargs):
                 for i, s in enumerate(seqs)]
 
     muscle_cline = MuscleCommandline(diags=True, quiet=True)
-    child = sp.Popen(str(muscle_cline),
+
+    cache = kwargs.get('cache', False)
+    if cache:
+        from hivwholeseq.filenames import get_muscle_cache_filename
+        fn_cache = get_muscle_cache_filename(get_muscle_cache_key(seqs, muscle_cline),
+                                             folder=None if cache is True else cache)
+        if os.path.isfile(fn_cache):
+            align = AlignIO.read(fn_cache, 'fasta')
+            return sort_alignment(align, seqs) if kwargs.get('sort', False) else align
+
+    # NOTE: no shell, the command line is split into its arguments
+    child = sp.Popen(str(muscle_cline).split(),
                      stdin=sp.PIPE,
                      stdout=sp.PIPE,
-                     stderr=sp.PIPE,
-                     shell=True)
+                     stderr=sp.PIPE)
     SeqIO.write(seqs, child.stdin, "fasta")
     child.stdin.close()
     align = AlignIO.read(child.stdout, "fasta")
     child.stderr.close()
     child.stdout.close()
+    child.wait()
+
+    if cache:
+        import thread
+        from hivwholeseq.utils.generic import mkdirs
+        mkdirs(os.path.dirname(fn_cache))
+        fn_tmp = fn_cache+'_tmp_'+str(os.getpid())+'_'+str(thread.get_ident())
+        AlignIO.write(align, fn_tmp, 'fasta')
+        os.rename(fn_tmp, fn_cache)
 
-    if ('sort' in kwargs) and kwargs['sort']:
-        from Bio.Align import MultipleSeqAlignment as MSA
-        alisort = []
-        for seq in seqs:
-            for row in align:
-                if row.id == seq.id:
-                    alisort.append(row)
-                    break
-        align = MSA(alisort)
+    if kwargs.get('sort', False):
+        align = sort_alignment(align, seqs)
 
     return align
 
 
+def sort_alignment(align, seqs):
+    '''Sort the rows of an alignment as the input sequences (by id)'''
+    from Bio.Align import MultipleSeqAlignment as MSA
+    rows = {}
+    for row in align:
+        rows.setdefault(row.id, row)
+    return MSA([rows[seq.id] for seq in seqs if seq.id in rows])
+
+
+def align_muscle_batch(seqsets, threads=None, **kwargs):
+    '''Align many independent sets of sequences via MUSCLE in parallel
+
+    Parameters:
+       seqsets (list): sets of sequences, each as the arguments of align_muscle
+       threads (int): number of MUSCLE processes at the same time (default:
+       number of cores)
+       **kwargs: passed to align_muscle (e.g. sort, cache)
+
+    Returns:
+       alis (list): the alignments, in the same order as seqsets
+    '''
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+
+    if threads is None:
+        threads = cpu_count()
+    threads = max(1, min(threads, len(seqsets)))
+
+    if threads == 1:
+        return [align_muscle(*seqs, **kwargs) for seqs in seqsets]
+
+    # MUSCLE runs in subprocesses, so threads are enough to feed them
+    pool = ThreadPool(threads)
+    try:
+        alis = pool.map(lambda seqs: align_muscle(*seqs, **kwargs), seqsets)
+    finally:
+        pool.close()
+        pool.join()
+    return alis
+
+
 def align_codon_pairwise(seqstr, refstr, **kwargs):
     '''Pairwise alignment via codons
     
@@ -262,23 +334,86 @@ def annotate_sequence_genes(seq_rec, fragment='genomewide', genes=genes_all,
         seq_rec.features.append(feature)
 
 
-def find_seed_imperfect(seq, seed, threshold=0.7, VERBOSE=0):
-    '''Imperfect match of a seed to a sequence'''
+def get_seed_matches(seq, seed, masked=seed_masked):
+    '''Count the matches of a seed at all offsets of a sequence
+
+    Parameters:
+       seq (str or S1 array): the sequence to search
+       seed (str): the seed
+       masked (str): seed characters that are masked, i.e. never compared
+
+    Returns:
+       (n_match, n_comparable): the number of matching sites at each offset
+       (int array of length len(seq) - len(seed) + 1) and of unmasked sites
+    '''
     import numpy as np
 
+    if isinstance(seq, np.ndarray):
+        seqm = seq
+    else:
+        seqm = np.fromstring(''.join(seq), 'S1')
+    seedm = np.fromstring(''.join(seed), 'S1')
+    comparable = ~np.in1d(seedm, np.array(list(masked), 'S1'))
+
+    n_off = max(0, len(seqm) - len(seedm) + 1)
+    n_match = np.zeros(n_off, int)
+    if n_off:
+        # One vectorized pass per seed site, over all offsets at once
+        for i in comparable.nonzero()[0]:
+            n_match += seqm[i: i + n_off] == seedm[i]
+
+    return (n_match, comparable.sum())
+
+
+def find_seed(seq, seed, from_right=False, masked=seed_masked):
+    '''Find the best (Hamming) match of a seed in a sequence
+
+    Parameters:
+       from_right (bool): on ties, take the rightmost offset
+       masked (str): seed characters that are not compared
+
+    Returns:
+       (pos, n_match, n_comparable): the best offset, its number of matching
+       sites, and the number of unmasked sites of the seed
+    '''
+    import numpy as np
+
+    (n_match, n_comparable) = get_seed_matches(seq, seed, masked=masked)
+    if not len(n_match):
+        raise ValueError('Seed longer than the sequence')
+
+    if not from_right:
+        pos = np.argmax(n_match)
+    else:
+        pos = len(n_match) - 1 - np.argmax(n_match[::-1])
+
+    return (pos, n_match[pos], n_comparable)
+
+
+def find_seed_hits(seq, seed, threshold=0.7, masked=seed_masked):
+    '''Find all matches of a seed above a threshold
+
+    Returns:
+       hits (int array): offsets with at least this fraction of matching
+       unmasked sites, from the best match down (left to right on ties)
+    '''
+    import numpy as np
+
+    (n_match, n_comparable) = get_seed_matches(seq, seed, masked=masked)
+    hits = (n_match >= threshold * n_comparable).nonzero()[0]
+    return hits[np.argsort(-n_match[hits], kind='mergesort')]
+
+
+def find_seed_imperfect(seq, seed, threshold=0.7, VERBOSE=0):
+    '''Imperfect match of a seed to a sequence'''
     seed = ''.join(seed)
     seq = ''.join(seq)
     pos = seq.find(seed)
     if pos != -1:
         return pos
 
-    seed = np.fromstring(seed, 'S1')
-    seq = np.fromstring(seq, 'S1')
-    sl = len(seed)
-    seql = len(seq)
-    n_match = [(seed == seq[i: i + sl]).sum() for i in xrange(seql - sl)]
-    pos = np.argmax(n_match)
-    if n_match[pos] >= threshold * sl:
+    (pos, n_match, sl) = find_seed(seq, seed, masked='')
+    if n_match >= threshold * sl:
         return pos
 
     raise ValueError('Seed not found at specified threshold ('+str(threshold)+')')
@@ -286,21 +421,14 @@ def find_seed_imperfect(seq, seed, threshold=0.7, VERBOSE=0):
 
 def rfind_seed_imperfect(seq, seed, threshold=0.7, VERBOSE=0):
     '''Imperfect match of a seed to a sequence, from the right'''
-    import numpy as np
-
     seed = ''.join(seed)
     seq = ''.join(seq)
     pos = seq.rfind(seed)
     if pos != -1:
         return pos
 
-    seed = np.fromstring(seed, 'S1')
-    seq = np.fromstring(seq, 'S1')
-    sl = len(seed)
-    seql = len(seq)
-    n_match = [(seed == seq[i: i + sl]).sum() for i in xrange(seql - sl)]
-    pos = len(n_match) - 1 - np.argmax(n_match[::-1])
-    if n_match[pos] >= threshold * sl:
+    (pos, n_match, sl) = find_seed(seq, seed, from_right=True, masked='')
+    if n_match >= threshold * sl:
         return pos
 
     raise ValueError('Seed not found at specified threshold ('+str(threshold)+')')
@@ -430,7 +558,7 @@ def build_msa_haplotypes(haploc, VERBOSE=0, label=''):
             for i, (seq, count) in enumerate(haploc.most_common())]
 
     from hivwholeseq.utils.mapping import align_muscle
-    ali = align_muscle(*seqs, sort=True)
+    ali = align_muscle(*seqs, sort=True, cache=True)
 
     return ali
 
@@ -590,33 +718,19 @@ def trim_to_refseq(seq, refseq):
 def find_fragment(refseq, fragment, threshold=0.7):
     '''Find the coordinate of one fragment in the refseq'''
     import numpy as np
-
-    refs = ''.join(refseq)
-    refm = np.fromstring(refs, 'S1')
-    rl = len(refm)
+    from hivwholeseq.data.primers import primers_PCR
 
     (prfwd, prrev) = primers_PCR[fragment]
 
-    seed = np.ma.array(np.fromstring(prfwd, 'S1'))
-    seed[seed == 'Y'] = np.ma.masked
-    seed[seed == 'R'] = np.ma.masked
-    seed[seed == 'W'] = np.ma.masked
-    seed[seed == 'N'] = np.ma.masked
-    sl = len(seed)
-    n_matches = np.array([(seed == refm[i: i + sl]).sum() for i in xrange(len(refm) - sl)], int)
-    poss_start = np.argsort(n_matches)[::-1][:5]
-    if n_matches[poss_start[0]] < threshold * (-seed.mask).sum():
+    # Try the best few matches of each primer in all combinations
+    (n_matches, n_comparable) = get_seed_matches(refseq, prfwd)
+    poss_start = np.argsort(-n_matches, kind='mergesort')[:5]
+    if n_matches[poss_start[0]] < threshold * n_comparable:
         raise ValueError('Start of fragment not found')
 
-    seed = np.ma.array(np.fromstring(prrev, 'S1'))
-    seed[seed == 'Y'] = np.ma.masked
-    seed[seed == 'R'] = np.ma.masked
-    seed[seed == 'W'] = np.ma.masked
-    seed[seed == 'N'] = np.ma.masked
-    sl = len(seed)
-    n_matches = np.array([(seed == refm[i: i + sl]).sum() for i in xrange(len(refm) - sl)], int)
-    poss_end = np.argsort(n_matches)[::-1][:5]
-    if n_matches[poss_end[0]] < threshold * (-seed.mask).sum():
+    (n_matches, n_comparable) = get_seed_matches(refseq, prrev)
+    poss_end = np.argsort(-n_matches, kind='mergesort')[:5]
+    if n_matches[poss_end[0]] < threshold * n_comparable:
         raise ValueError('End of fragment not found')
 
     found = False
@@ -636,25 +750,9 @@ def find_fragment(refseq, fragment, threshold=0.7):
 
 def find_primer_seq(seq, primer, from_right=False, threshold=0.7):
     '''Find an ambiguous primer in a sequence'''
-    import numpy as np
-
-    refs = ''.join(seq)
-    refm = np.fromstring(refs, 'S1')
-    rl = len(refm)
-
-    seed = np.ma.array(np.fromstring(primer, 'S1'))
-    seed[seed == 'Y'] = np.ma.masked
-    seed[seed == 'R'] = np.ma.masked
-    seed[seed == 'W'] = np.ma.masked
-    seed[seed == 'N'] = np.ma.masked
-    sl = len(seed)
-    n_matches = np.array([(seed == refm[i: i + sl]).sum() for i in xrange(len(refm) - sl)], int)
-    if not from_right:
-        pos_start = np.argmax(n_matches)
-    else:
-        pos_start = len(n_matches) - 1 - np.argmax(n_matches[::-1])
-
-    if n_matches[pos_start] < threshold * (-seed.mask).sum():
+    (pos_start, n_match, n_comparable) = find_seed(seq, primer,
+                                                   from_right=from_right)
+    if n_match < threshold * n_comparable:
         raise ValueError('Start of fragment not found')
 
     return pos_start
@@ -17,129 +17,346 @@ from .mapping import pair_generator
 
 
 
+# Classes
+class CocountMatrix(object):
+    '''Sparse, symmetric matrix of allele cocounts
+
+    Only the upper triangle of site pairs within a maximal distance is kept,
+    i.e. pairs (i, j) with i <= j < i + width, as a band of shape
+    (length, width, alphabet, alphabet). The dense equivalent has shape
+    (alphabet, alphabet, length, length) and is symmetric under the exchange
+    of both the sites and the alleles.
+
+    The band is saved as a plain .npy file, so that it can be memory-mapped
+    and single pairs or submatrices can be accessed without loading it all.
+    '''
+
+    def __init__(self, band):
+        '''Initialize a cocount matrix from its band'''
+        self.band = band
+
+
+    @property
+    def length(self):
+        '''Number of sites'''
+        return self.band.shape[0]
+
+
+    @property
+    def width(self):
+        '''Maximal distance between sites + 1'''
+        return self.band.shape[1]
+
+
+    @property
+    def shape(self):
+        '''Shape of the equivalent dense matrix'''
+        return (self.band.shape[2], self.band.shape[3], self.length, self.length)
+
+
+    @classmethod
+    def from_dense(cls, counts, width=None):
+        '''Make a sparse matrix from a dense one
+
+        Parameters:
+           counts (ndarray): dense cocounts, alphabet x alphabet x length x length
+           width (int): maximal distance between sites + 1 (None: the smallest
+           that keeps all nonzero cocounts)
+        '''
+        length = counts.shape[-1]
+        if width is None:
+            (pos1, pos2) = counts.any(axis=0).any(axis=0).nonzero()
+            dist = pos2 - pos1
+            dist = dist[dist >= 0]
+            width = dist.max() + 1 if len(dist) else 1
+        width = min(width, length)
+
+        pos1 = np.arange(length)[:, np.newaxis]
+        pos2 = pos1 + np.arange(width)
+        ind_out = pos2 >= length
+        pos2[ind_out] = 0
+
+        band = counts[:, :, pos1, pos2].transpose(2, 3, 0, 1)
+        band[ind_out] = 0
+        band = band.astype(np.min_scalar_type(band.max()))
+        return cls(band)
+
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        '''Load a sparse matrix from file
+
+        Parameters:
+           mmap (bool): memory-map the file instead of reading it into memory
+        '''
+        return cls(np.load(filename, mmap_mode='r' if mmap else None))
+
+
+    def save(self, filename):
+        '''Save the sparse matrix to file'''
+        np.save(filename, self.band)
+
+
+    def get_pair(self, pos1, pos2):
+        '''Get the cocounts of a pair of sites, alphabet x alphabet'''
+        if pos1 <= pos2:
+            dist = pos2 - pos1
+            if dist >= self.width:
+                return np.zeros(self.shape[:2], int)
+            return np.array(self.band[pos1, dist], int)
+        else:
+            return self.get_pair(pos2, pos1).T
+
+
+    def get_submatrix(self, start1, end1, start2=None, end2=None):
+        '''Get a dense submatrix between two ranges of sites
+
+        Parameters:
+           start1, end1 (int): range of the first sites
+           start2, end2 (int): range of the second sites (default: same as first)
+
+        Returns:
+           counts (ndarray): alphabet x alphabet x (end1 - start1) x (end2 - start2)
+        '''
+        if start2 is None:
+            (start2, end2) = (start1, end1)
+
+        pos1 = np.arange(start1, end1)[:, np.newaxis]
+        pos2 = np.arange(start2, end2)[np.newaxis, :]
+        ind_swap = pos1 > pos2
+        posl = np.where(ind_swap, pos2, pos1)
+        dist = np.abs(pos2 - pos1)
+        ind_in = dist < self.width
+
+        counts = np.zeros((len(pos1), pos2.shape[1]) + self.shape[:2], int)
+        ind = ind_in & (~ind_swap)
+        counts[ind] = self.band[posl[ind], dist[ind]]
+        ind = ind_in & ind_swap
+        counts[ind] = self.band[posl[ind], dist[ind]].swapaxes(1, 2)
+
+        return counts.transpose(2, 3, 0, 1)
+
+
+    def todense(self, start=0, end=None):
+        '''Get the dense matrix, optionally restricted to a region'''
+        if end is None:
+            end = self.length
+        return self.get_submatrix(start, end)
+
+
+
 # Functions
+def get_coallele_calls_pairs(read_pairs, qual_min=30):
+    '''Get the allele calls of a chunk of read pairs, resolving mate overlaps
+
+    Parameters:
+       read_pairs (list): read pairs to scan
+       qual_min (int): minimal PHRED quality of the base to be called. For
+       deletions, the quality of the two bases after the deletion is used.
+
+    Returns:
+       (ipair, pos, aind): arrays of the index of the read pair, the position
+       and the allele index of each call, sorted by pair and position
+
+    NOTE: paired reads are twice the same biological molecule, so each site is
+    called only once per pair. Where the mates overlap, the call with the
+    highest PHRED quality is kept (the first read of the pair if tied).
+    '''
+    from .one_site_statistics import alpha_index_table
+    ind_gap = alphal.index('-')
+
+    # Decode CIGARs into blocks of (start in chunk sequence, reference
+    # position, length, pair index, read index in pair, end of the read in
+    # chunk sequence)
+    seqs = []
+    quals = []
+    blocks_match = []
+    blocks_del = []
+    pos_chunk = 0
+    for ipair, reads in enumerate(read_pairs):
+        for iread, read in enumerate(reads):
+            pos_ref = read.pos
+            pos_read = pos_chunk
+            end_read = pos_chunk + len(read.seq)
+            for (bt, bl) in read.cigar:
+                if bt == 1:
+                    pos_read += bl
+                elif bt == 2:
+                    # NOTE: no CIGAR can start NOR end with a deletion
+                    blocks_del.append((pos_read, pos_ref, bl, ipair, iread, end_read))
+                    pos_ref += bl
+                elif bt == 0:
+                    blocks_match.append((pos_read, pos_ref, bl, ipair, iread, end_read))
+                    pos_read += bl
+                    pos_ref += bl
+                else:
+                    raise ValueError('CIGAR type '+str(bt)+' not recognized')
+
+            seqs.append(read.seq)
+            quals.append(read.qual)
+            pos_chunk = end_read
+
+    seqs = np.fromstring(''.join(seqs), np.uint8)
+    quals = np.fromstring(''.join(quals), np.uint8).astype(int) - 33
+
+    # Expand blocks into flat arrays of calls
+    calls = []
+    for (blocks, is_del) in ((blocks_match, False), (blocks_del, True)):
+        blocks = np.array(blocks, int).reshape((-1, 6))
+        (starts, poss, lens, ipairs, ireads, ends) = blocks.T
+        ind_block = np.repeat(np.arange(len(lens)), lens)
+        offsets = np.arange(lens.sum()) - np.repeat(lens.cumsum() - lens, lens)
+        pos = poss[ind_block] + offsets
+
+        if is_del:
+            # The quality of a deletion is the min of the next two bases
+            qual = quals[starts]
+            ind_next = (starts + 1 < ends).nonzero()[0]
+            qual[ind_next] = np.minimum(qual[ind_next], quals[starts[ind_next] + 1])
+            qual = qual[ind_block]
+            aind = np.repeat(ind_gap, len(pos))
+            ind_good = qual >= qual_min
+        else:
+            ind_read = starts[ind_block] + offsets
+            qual = quals[ind_read]
+            aind = alpha_index_table[seqs[ind_read]]
+            ind_good = (aind < len(alpha)) & (qual >= qual_min)
+
+        calls.append((ipairs[ind_block][ind_good], ireads[ind_block][ind_good],
+                      pos[ind_good], aind[ind_good], qual[ind_good]))
+
+    (ipair, iread, pos, aind, qual) = map(np.concatenate, zip(*calls))
+
+    # Sort by pair, position, decreasing quality, read, and keep the top call
+    ind = np.lexsort((iread, -qual, pos, ipair))
+    (ipair, pos, aind) = (ipair[ind], pos[ind], aind[ind])
+    ind = np.ones(len(pos), bool)
+    ind[1:] = (ipair[1:] != ipair[:-1]) | (pos[1:] != pos[:-1])
+
+    return (ipair[ind], pos[ind], aind[ind])
+
+
+def add_coallele_counts_calls(counts, ipair, pos, aind, sparse=False,
+                              maxcombos=10000000):
+    '''Add the cocounts of a chunk of allele calls to a matrix
+
+    Parameters:
+       counts (ndarray): output data structure, either a dense matrix
+       (alphabet x alphabet x length x length) or the band of a CocountMatrix
+       (length x width x alphabet x alphabet)
+       ipair, pos, aind (arrays): allele calls, see get_coallele_calls_pairs
+       sparse (bool): whether counts is the band of a CocountMatrix
+       maxcombos (int): maximal number of pairs of calls expanded at once, to
+       limit memory usage
+    '''
+    if not len(pos):
+        return
+
+    # Every call is combined with all calls of the same read pair
+    # (this already takes care of the symmetry)
+    ind_starts = np.concatenate([[0], (np.diff(ipair) != 0).nonzero()[0] + 1])
+    sizes = np.diff(np.concatenate([ind_starts, [len(pos)]]))
+    combos = sizes**2
+    batches = (combos.cumsum() - combos) // maxcombos
+
+    # NOTE: the matrices are too large for bincount, so we reduce by sorting
+    cobra = counts.ravel()
+    n_alpha = len(alpha)
+    for batch in np.unique(batches):
+        ind_groups = (batches == batch).nonzero()[0]
+        start = ind_starts[ind_groups[0]]
+        end = ind_starts[ind_groups[-1]] + sizes[ind_groups[-1]]
+        sizes_call = np.repeat(sizes[ind_groups], sizes[ind_groups])
+        starts_call = np.repeat(ind_starts[ind_groups], sizes[ind_groups])
+
+        ind1 = np.repeat(np.arange(start, end), sizes_call)
+        offsets = (np.arange(sizes_call.sum()) -
+                   np.repeat(sizes_call.cumsum() - sizes_call, sizes_call))
+        ind2 = np.repeat(starts_call, sizes_call) + offsets
+        (pos1, pos2, aind1, aind2) = (pos[ind1], pos[ind2], aind[ind1], aind[ind2])
+
+        if sparse:
+            (length, width) = counts.shape[:2]
+            dist = pos2 - pos1
+            ind = (dist >= 0) & (dist < width)
+            ind_flat = (((pos1[ind] * width + dist[ind]) * n_alpha + aind1[ind]) *
+                        n_alpha + aind2[ind])
+        else:
+            length = counts.shape[-1]
+            ind_flat = ((aind1 * n_alpha + aind2) * length + pos1) * length + pos2
+
+        (ind_flat, n_flat) = np.unique(ind_flat, return_counts=True)
+        cobra[ind_flat] += n_flat
+
+
 def get_coallele_counts_from_file(bamfilename, length, qual_min=30,
                                   maxreads=-1, VERBOSE=0,
-                                  use_tests=False):
-    '''Get counts of join occurence of two alleles'''
-    from .utils.mapping import (test_read_pair_exotic_cigars,
-                                test_read_pair_exceed_reference)
+                                  use_tests=False,
+                                  sparse=False, width=1000,
+                                  chunksize=1000):
+    '''Get counts of join occurence of two alleles
+
+    Parameters:
+       sparse (bool): return a CocountMatrix instead of a dense matrix, which
+       is accumulated directly without ever allocating the dense matrix
+       width (int): for sparse matrices, maximal distance between sites + 1.
+       Pairs of sites further apart than that are discarded.
+       chunksize (int): number of read pairs processed together
+    '''
+    from .mapping import (test_read_pair_exotic_cigars,
+                          test_read_pair_exceed_reference)
 
     if VERBOSE >= 1:
         print 'Getting coallele counts'
 
-
-    # Precompute conversion tables
-    alpha_mapping = {a: alphal.index(a) for a in alphal}
-    SANGER_SCORE_OFFSET = ord("!")
-    q_mapping = dict()
-    for letter in xrange(0, 255):
-        q_mapping[chr(letter)] = letter - SANGER_SCORE_OFFSET
-    
     if VERBOSE >= 2:
         print 'Initializing matrix of cocounts'
 
     # NOTE: we are ignoring fwd/rev and read1/2
-    counts = np.zeros((len(alpha), len(alpha), length, length), int)
-    posall = np.zeros(1000, dtype=[('pos', int), ('aind', int)])
+    if sparse:
+        width = min(width, length)
+        counts = np.zeros((length, width, len(alpha), len(alpha)), int)
+    else:
+        counts = np.zeros((len(alpha), len(alpha), length, length), int)
 
     if VERBOSE >= 2:
         from hivwholeseq.utils.mapping import get_number_reads
         print 'Scanning read pairs ('+str(get_number_reads(bamfilename) // 2)+')'
 
+    def add_chunk(chunk):
+        (ipair, pos, aind) = get_coallele_calls_pairs(chunk, qual_min=qual_min)
+        add_coallele_counts_calls(counts, ipair, pos, aind, sparse=sparse)
+
     # NOTE: the reads should already be filtered of unmapped stuff at this point
     with pysam.Samfile(bamfilename, 'rb') as bamfile:
+        chunk = []
         for ir, reads in enumerate(pair_generator(bamfile)):
             if ir == maxreads:
                 if VERBOSE:
                     print 'Max read number reached:', maxreads
                 break
         
-            if (VERBOSE >= 2) and (not ((ir +1) % 10)):
-                if (VERBOSE == 2) and (ir + 1 != 10):
+            if (VERBOSE >= 2) and (not ((ir +1) % 1000)):
+                if (VERBOSE == 2) and (ir + 1 != 1000):
                     sys.stdout.write("\x1b[1A")
                 print (ir+1) 
 
             if use_tests:
                 if test_read_pair_exotic_cigars(reads):
-                    raise ValueError('CIGAR type '+str(bt)+' not recognized')
+                    raise ValueError('CIGAR type not recognized')
 
                 if test_read_pair_exceed_reference(reads, length):
                     raise ValueError('Read pair exceeds reference length of '+str(length))
 
+            chunk.append(reads)
+            if len(chunk) == chunksize:
+                add_chunk(chunk)
+                chunk = []
+
+        if chunk:
+            add_chunk(chunk)
 
-            # Temp structures
-            posall[:] = (-1, -1)
-            iall = 0
-
-            # Collect alleles
-            for read in reads:
-                alleles_ind = np.fromiter((alpha_mapping[x] for x in read.seq),
-                                          np.uint8, len(read.seq))
-                allqual_ind = np.fromiter((q_mapping[x] for x in read.qual),
-                                          np.uint8, len(read.qual))
-
-                pos_ref = read.pos
-                pos_read = 0
-                for (bt, bl) in read.cigar:
-                    if bt == 1:
-                        pos_read += bl
-                    elif bt == 2:
-                        # NOTE: no CIGAR can start NOR end with a deletion
-                        qual_deletion = allqual_ind[pos_read: pos_read + 2].min()
-                        if qual_deletion >= qual_min:
-                            posall['pos'][iall: iall + bl] = np.arange(pos_ref,
-                                                                       pos_ref + bl)
-                            posall['aind'][iall: iall + bl] = 4
-                            iall += bl
-                        pos_ref += bl
-                    else:
-                        alleles_indb = alleles_ind[pos_read: pos_read + bl]
-                        allqual_indb = allqual_ind[pos_read: pos_read + bl]
-                        for i in xrange(len(alpha)):
-                            aitmp = (alleles_indb == i) & (allqual_indb >= qual_min)
-                            aitmp = aitmp.nonzero()[0] + pos_ref
-                            aitmplen = len(aitmp)
-                            posall['pos'][iall: iall + aitmplen] = aitmp
-                            posall['aind'][iall: iall + aitmplen] = i
-                            iall += aitmplen
-
-                        pos_read += bl
-                        pos_ref += bl
-
-            # Avoid doubles (paired reads are twice the same biological molecule)
-            posall.sort(order=('pos', 'aind'))
-            iall = (posall['pos'] != -1).nonzero()[0][0]
-            while iall < len(posall) - 1:
-                if posall['pos'][iall + 1] == posall['pos'][iall]:
-
-                    # If both reads agree @ an overlap allele, take a single call
-                    if posall['aind'][iall + 1] == posall['aind'][iall]:
-                        posall[iall + 1] = (-1, -1)
-
-                    # else, pick one at random (FIXME: pick the highest phred)
-                    else:
-                        ibin = np.random.randint(2)
-                        posall[iall + ibin] = (-1, -1)
-
-                    iall += 1
-                iall += 1
-
-            # Add allele cocounts to the matrix
-            # NOTE: this already takes care of the symmetry
-            poss = [posall['pos'][posall['aind'] == i1] for i1 in xrange(len(alpha))]
-            for i1 in xrange(len(alpha)):
-                poss1 = poss[i1]
-                if not len(poss1):
-                    continue
-                for i2 in xrange(len(alpha)):
-                    poss2 = poss[i2]
-                    if not len(poss2):
-                        continue
-
-                    # Raveling vodoo for efficiency
-                    cobra = counts[i1, i2].ravel()
-                    ind = poss1.repeat(len(poss2)) * length + np.tile(poss2, len(poss1))
-                    cobra[ind] += 1
+    if sparse:
+        return CocountMatrix(counts.astype(np.min_scalar_type(counts.max())))
 
     return counts